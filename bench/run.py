@@ -0,0 +1,295 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+from bench.server import BenchServer, Faults, expected_sha256, parse_size
+
+# End-to-end Downloader benchmark. Each case runs in a fresh child process so peak RSS,
+# thread count and CPU time belong to that one download; the fault-injecting server
+# lives in this process.
+#
+#   python -m bench.run --sizes 64M,256M --threads 1,8,32 --faults none,lossy --out before.json
+#   python -m bench.run --protocols http1,http2 --faults none,latency      (HTTP/1.1 pool vs HTTP/2 streams)
+#   python -m bench.run --faults rtt --threads 8,32 --no-warmup         (connection setup cost; see time_to_full_speed)
+#   python -m bench.run --compare before.json after.json
+
+PRESETS = {
+    'none': {},
+    'throttled': {'rate': 4 * 1024 * 1024},
+    'latency': {'latency': 0.1},
+    'lossy': {'reset': 0.02, 'truncate': 0.02},
+    'busy': {'error': 0.1, 'max_connections': 16},
+    'stalling': {'stall': 0.05},
+    # Long connection setup and a per-connection cap: full speed needs every segment connected
+    'rtt': {'handshake': 0.2, 'latency': 0.05, 'rate': 8 * 1024 * 1024},
+}
+
+SPEED_WINDOW = 0.25 # Seconds of progress samples per rate estimate
+FULL_SPEED = 0.8 # Fraction of the best windowed rate that counts as full speed
+
+GB = 1024 ** 3
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(8 * 1024 * 1024)
+            if not data:
+                return h.hexdigest()
+            h.update(data)
+
+
+def time_to_full_speed(samples):
+    # samples: (seconds since start, bytes downloaded). Seconds until the rate over a
+    # SPEED_WINDOW first reaches FULL_SPEED of the best such rate in the run.
+    rates = []
+    j = 0
+    for t, done in samples:
+        while samples[j][0] < t - SPEED_WINDOW:
+            j += 1
+        t0, done0 = samples[j]
+        if t - t0 >= SPEED_WINDOW / 2:
+            rates.append((t, (done - done0) / (t - t0)))
+    if not rates:
+        return None
+    best = max(rate for _, rate in rates)
+    return next((round(t, 4) for t, rate in rates if best and rate >= FULL_SPEED * best), None)
+
+
+def run_case(case):
+    # Child side: one download, measured from start() to "completed"
+    from core.downloader import Downloader
+
+    out_dir = tempfile.mkdtemp(prefix='tafim-bench-')
+    path = os.path.join(out_dir, 'bench.bin')
+    result = {'status': None}
+    try:
+        Downloader.warmup = case.get('warmup', True)
+        dl = Downloader(case['url'], path, threads=case['threads'], engine=case['engine'], adaptive=case['adaptive'],
+                        protocol=case.get('protocol', 'http1'))
+        cpu = os.times()
+        began = time.perf_counter()
+        dl.start()
+
+        peak_threads = threading.active_count()
+        final_start = None
+        last_size, last_progress = 0, began
+        progress = [(0.0, 0)]
+        while True:
+            time.sleep(0.02)
+            now = time.perf_counter()
+            progress.append((now - began, dl.downloaded_size))
+            peak_threads = max(peak_threads, threading.active_count())
+            status = dl.status
+            if final_start is None and status in ("verifying", "finalizing"):
+                final_start = now
+            if status in ("completed", "error"):
+                break
+            if dl.downloaded_size != last_size:
+                last_size, last_progress = dl.downloaded_size, now
+            elif now - last_progress > case['stall']:
+                status = "stalled"
+                break
+        elapsed = time.perf_counter() - began
+        cpu_end = os.times()
+        cpu_seconds = (cpu_end.user - cpu.user) + (cpu_end.system - cpu.system)
+
+        result.update({
+            'status': status,
+            'seconds': round(elapsed, 4),
+            'throughput': round(dl.downloaded_size / elapsed, 1) if elapsed > 0 else 0,
+            # There is no merge pass any more; this is what's left of it (verify + rename)
+            'merge_seconds': round(now - final_start, 4) if final_start is not None and status == "completed" else None,
+            'downloaded': dl.downloaded_size,
+            'time_to_full_speed': time_to_full_speed(progress),
+            'peak_rss': peak_rss(),
+            'peak_threads': peak_threads,
+            'cpu_seconds': round(cpu_seconds, 4),
+            'cpu_per_gb': round(cpu_seconds / (case['size'] / GB), 4) if case['size'] else None,
+            'errors': dict(dl.metrics.errors),
+            'retries': dl.metrics.retries,
+            'disk_queue_peak': Downloader.writer.stats()['peak'],
+        })
+        if status == "completed" and case['verify']:
+            result['verified'] = sha256_file(path) == case['sha256']
+        elif status != "completed":
+            dl.cancel()
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return result
+
+
+def spawn_case(case, timeout):
+    cmd = [sys.executable, '-m', 'bench.run', '--child', json.dumps(case)]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        proc = subprocess.run(cmd, cwd=root, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'status': 'timeout'}
+    lines = proc.stdout.strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return {'status': 'crashed', 'stderr': proc.stderr[-2000:]}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_matrix(args):
+    sizes = [parse_size(s) for s in args.sizes.split(',')]
+    threads = [int(t) for t in args.threads.split(',')]
+    engines = args.engines.split(',')
+    presets = args.faults.split(',')
+    protocols = args.protocols.split(',')
+    for name in protocols:
+        if name not in ('http1', 'http2'):
+            sys.exit(f"Unknown protocol {name!r}, choose from http1, http2")
+    for name in presets:
+        if name not in PRESETS:
+            sys.exit(f"Unknown fault preset {name!r}, choose from {', '.join(PRESETS)}")
+
+    results = []
+    for size, preset in itertools.product(sizes, presets):
+        server = BenchServer(size, seed=args.seed, faults=Faults(seed=args.seed, **PRESETS[preset]),
+                             http2='http2' in protocols).start()
+        digest = expected_sha256(size, args.seed) if args.verify else None
+        try:
+            for engine, protocol, count, repeat in itertools.product(engines, protocols, threads, range(args.repeat)):
+                case = {
+                    'url': server.url, 'size': size, 'threads': count, 'engine': engine, 'protocol': protocol,
+                    'adaptive': args.adaptive, 'stall': args.stall, 'verify': args.verify, 'sha256': digest,
+                    'warmup': args.warmup
+                }
+                before = server.stats()
+                result = spawn_case(case, args.timeout)
+                after = server.stats()
+                result['server'] = {k: after[k] - before[k] for k in after}
+                result.update({'size': size, 'threads': count, 'engine': engine, 'protocol': protocol, 'faults': preset,
+                               'repeat': repeat})
+                results.append(result)
+                print(f"{engine:6} {protocol:5} {size / 1024 ** 2:8.0f} MB {count:4} thr {preset:9} "
+                      f"{result['status']:9} {result.get('seconds', 0):8.2f} s "
+                      f"{result.get('throughput', 0) / 1024 ** 2:9.1f} MB/s "
+                      f"{result.get('time_to_full_speed') or 0:6.2f} s to full "
+                      f"{result['server']['connections']:4} conn", flush=True)
+        finally:
+            server.stop()
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'adaptive': args.adaptive,
+            'warmup': args.warmup,
+            'presets': {name: PRESETS[name] for name in presets},
+        },
+        'results': results
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.out}")
+
+
+def summarize(path):
+    # Median of the repeats for each case
+    with open(path) as f:
+        report = json.load(f)
+    grouped = {}
+    for r in report['results']:
+        key = (r['engine'], r.get('protocol', 'http1'), r['size'], r['threads'], r['faults'])
+        grouped.setdefault(key, []).append(r)
+    summary = {}
+    for key, runs in grouped.items():
+        ok = [r for r in runs if r['status'] == 'completed']
+        ttfs = [r['time_to_full_speed'] for r in ok if r.get('time_to_full_speed') is not None]
+        summary[key] = {
+            'ok': len(ok),
+            'runs': len(runs),
+            'throughput': statistics.median(r['throughput'] for r in ok) if ok else 0,
+            'seconds': statistics.median(r['seconds'] for r in ok) if ok else None,
+            'time_to_full_speed': statistics.median(ttfs) if ttfs else None,
+        }
+    return summary
+
+
+def compare(base_path, new_path, threshold):
+    base, new = summarize(base_path), summarize(new_path)
+    regressions = 0
+    for key in sorted(set(base) & set(new)):
+        b, n = base[key], new[key]
+        change = (n['throughput'] - b['throughput']) / b['throughput'] if b['throughput'] else 0
+        flag = ''
+        if n['ok'] < b['ok'] or change < -threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        engine, protocol, size, threads, faults = key
+        print(f"{engine:6} {protocol:5} {size / 1024 ** 2:8.0f} MB {threads:4} thr {faults:9} "
+              f"{b['throughput'] / 1024 ** 2:9.1f} -> {n['throughput'] / 1024 ** 2:9.1f} MB/s {change:+7.1%} "
+              f"full speed {b['time_to_full_speed'] or 0:.2f} -> {n['time_to_full_speed'] or 0:.2f} s "
+              f"ok {b['ok']}/{b['runs']} -> {n['ok']}/{n['runs']} {flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Downloader benchmark")
+    parser.add_argument('--sizes', default='64M,256M')
+    parser.add_argument('--threads', default='1,8,32')
+    parser.add_argument('--engines', default='thread', help="comma separated: thread,async")
+    parser.add_argument('--protocols', default='http1', help="comma separated: http1,http2 (HTTP/2 needs h2)")
+    parser.add_argument('--faults', default='none', help="comma separated presets: " + ','.join(PRESETS))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--adaptive', action='store_true', help="let AIMD pick the thread count (default: fixed)")
+    parser.add_argument('--no-warmup', dest='warmup', action='store_false', help="don't pre-open connections (A/B)")
+    parser.add_argument('--no-verify', dest='verify', action='store_false', help="skip the sha256 check")
+    parser.add_argument('--stall', type=float, default=30.0, help="give up after this many seconds without progress")
+    parser.add_argument('--timeout', type=float, default=600.0, help="hard limit per case")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'))
+    parser.add_argument('--threshold', type=float, default=0.1, help="throughput drop counted as a regression")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_case(json.loads(args.child))))
+        return
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+    run_matrix(args)
+
+
+if __name__ == '__main__':
+    main()
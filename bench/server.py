@@ -0,0 +1,466 @@
+import argparse
+import hashlib
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+# Local range-capable HTTP server for benchmarks, with network fault injection.
+# Content is a seeded 1 MB random block repeated to the requested size, so any
+# size can be served (and checked) without keeping the file in memory or on disk.
+# With --http2 it also speaks cleartext HTTP/2 (prior knowledge) on the same port.
+#
+#   python -m bench.server --size 256M --rate 4M --reset 0.02 --max-connections 16
+
+BLOCK_SIZE = 1024 * 1024
+SEND_SIZE = 64 * 1024
+STALL_SECONDS = 60
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value):
+    # "64M", "1.5G", "4096" -> bytes
+    m = re.fullmatch(r'\s*([\d.]+)\s*([KMG]?)i?B?\s*', str(value), re.I)
+    if not m:
+        raise ValueError(f"Bad size: {value}")
+    return int(float(m.group(1)) * UNITS[m.group(2).upper()])
+
+
+def content_block(seed):
+    return random.Random(seed).randbytes(BLOCK_SIZE)
+
+
+def expected_sha256(size, seed=0):
+    block = content_block(seed)
+    h = hashlib.sha256()
+    for _ in range(size // BLOCK_SIZE):
+        h.update(block)
+    h.update(block[:size % BLOCK_SIZE])
+    return h.hexdigest()
+
+
+class Faults:
+    # Everything is per request (or per connection for rate), chosen with a seeded RNG
+    def __init__(self, rate=0, latency=0.0, reset=0.0, truncate=0.0, error=0.0, max_connections=0, stall=0.0, handshake=0.0,
+                 corrupt=0.0, seed=0):
+        self.rate = rate # Bytes/s per connection, 0 = unthrottled
+        self.latency = latency # Seconds before the response headers
+        self.handshake = handshake # Seconds before a new connection reads its first request (a long TCP+TLS setup)
+        self.reset = reset # Probability of a TCP reset somewhere in the body
+        self.truncate = truncate # Probability of a clean close before the body is complete
+        self.error = error # Probability of answering 429/503 instead of data
+        self.max_connections = max_connections # Concurrent GETs above this get a 429, 0 = no cap
+        self.stall = stall # Probability of the body hanging mid-way (connection left open, no data)
+        self.corrupt = corrupt # Probability of one flipped byte somewhere in the body
+        self.random = random.Random(seed)
+
+    def describe(self):
+        return {k: v for k, v in vars(self).items() if k != 'random'}
+
+
+def parse_range(server, rng, if_range):
+    # (start, end, status) for a Range header, None if it can't be satisfied
+    size = server.size
+    start, end, status = 0, size - 1, 200
+    if rng and (if_range is None or if_range in (server.etag, server.last_modified)):
+        m = re.fullmatch(r'bytes=(\d*)-(\d*)', rng.strip())
+        if m and (m.group(1) or m.group(2)):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            else:
+                start = max(0, size - int(m.group(2)))
+            if start >= size or start > end:
+                return None
+            status = 206
+    return start, end, status
+
+
+def corruption(faults, start, length):
+    # File offset of the byte to flip in this body, or None
+    if faults.corrupt and faults.random.random() < faults.corrupt:
+        return start + faults.random.randrange(length)
+    return None
+
+
+def body_slice(block, pos, n, flip):
+    data = block[pos % BLOCK_SIZE:pos % BLOCK_SIZE + n]
+    if flip is not None and pos <= flip < pos + n:
+        data = bytearray(data)
+        data[flip - pos] ^= 0xff
+    return data
+
+
+def response_headers(server, start, end, status):
+    headers = [
+        ('content-length', str(end - start + 1)),
+        ('accept-ranges', 'bytes'),
+        ('etag', server.etag),
+        ('last-modified', server.last_modified),
+    ]
+    if status == 206:
+        headers.append(('content-range', f'bytes {start}-{end}/{server.size}'))
+    return headers
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        if self.server.faults.handshake:
+            time.sleep(self.server.faults.handshake)
+        # An HTTP/2 client with prior knowledge opens with the connection preface
+        if self.server.http2:
+            head = self.connection.recv(len(H2_PREFACE), socket.MSG_PEEK)
+            while head and len(head) < len(H2_PREFACE) and H2_PREFACE.startswith(head):
+                time.sleep(0.001)
+                head = self.connection.recv(len(H2_PREFACE), socket.MSG_PEEK)
+            if head == H2_PREFACE:
+                H2Session(self.server, self.connection).run()
+                return
+        super().handle()
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        server = self.server
+        faults = server.faults
+        with server.lock:
+            over = faults.max_connections and server.active >= faults.max_connections
+            if not over:
+                server.active += 1
+            server.requests += 1
+        if over:
+            self.refuse(429)
+            return
+        try:
+            if faults.error and faults.random.random() < faults.error:
+                self.refuse(faults.random.choice((429, 503)))
+                return
+            self.respond(body=True)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def refuse(self, status):
+        with self.server.lock:
+            self.server.refused += 1
+        self.send_response(status)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def respond(self, body):
+        server = self.server
+        parsed = parse_range(server, self.headers.get('Range'), self.headers.get('If-Range'))
+        if parsed is None:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{server.size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end, status = parsed
+
+        faults = server.faults
+        if faults.latency:
+            time.sleep(faults.latency)
+        self.send_response(status)
+        for name, value in response_headers(server, start, end, status):
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.send_body(start, end)
+
+    def send_body(self, start, end):
+        server = self.server
+        faults = server.faults
+        length = end - start + 1
+        cut, abort = None, None
+        if faults.reset and faults.random.random() < faults.reset:
+            cut, abort = faults.random.randrange(length), 'reset'
+        elif faults.truncate and faults.random.random() < faults.truncate:
+            cut, abort = faults.random.randrange(length), 'truncate'
+        elif faults.stall and faults.random.random() < faults.stall:
+            cut, abort = faults.random.randrange(length), 'stall'
+        stop = start + cut if cut is not None else end + 1
+        flip = corruption(faults, start, length)
+
+        block = memoryview(server.block)
+        pos, sent, began = start, 0, time.monotonic()
+        try:
+            while pos < stop:
+                offset = pos % BLOCK_SIZE
+                n = min(SEND_SIZE, BLOCK_SIZE - offset, stop - pos)
+                self.wfile.write(body_slice(block, pos, n, flip))
+                pos += n
+                sent += n
+                if faults.rate:
+                    # Sleep off whatever we're ahead of the per-connection rate
+                    ahead = sent / faults.rate - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (ConnectionError, OSError):
+            return
+        with server.lock:
+            server.sent += sent
+        if abort is not None:
+            with server.lock:
+                server.aborted += 1
+            if abort == 'stall':
+                # Hold the connection open without sending until the client gives up
+                self.connection.settimeout(STALL_SECONDS)
+                try:
+                    while self.connection.recv(65536):
+                        pass
+                except OSError:
+                    pass
+            if abort == 'reset':
+                # SO_LINGER 0 turns close() into a RST
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+            self.connection.close()
+
+
+H2_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+
+class H2Session:
+    # One HTTP/2 connection: this thread reads frames, each stream's body is sent
+    # from its own thread as the client's flow-control window allows. Faults apply
+    # per stream; resets and truncation both become RST_STREAM.
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.window_open = threading.Condition(self.lock)
+        self.closed = False
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+
+    def flush(self):
+        # Caller holds self.lock
+        data = self.conn.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def run(self):
+        with self.lock:
+            self.conn.initiate_connection()
+            self.flush()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                with self.lock:
+                    for event in self.conn.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            threading.Thread(target=self.stream, args=(event.stream_id, dict(event.headers)), daemon=True).start()
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            return
+                    self.flush()
+                    self.window_open.notify_all()
+        except (ConnectionError, OSError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            with self.lock:
+                self.closed = True
+                self.window_open.notify_all()
+
+    def stream(self, stream_id, headers):
+        server = self.server
+        faults = server.faults
+        with server.lock:
+            over = faults.max_connections and server.active >= faults.max_connections
+            if not over:
+                server.active += 1
+            server.requests += 1
+        if over:
+            self.refuse(stream_id, 429)
+            return
+        try:
+            if faults.error and faults.random.random() < faults.error:
+                self.refuse(stream_id, faults.random.choice((429, 503)))
+                return
+            self.respond(stream_id, headers)
+        except (ConnectionError, OSError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def refuse(self, stream_id, status):
+        with self.server.lock:
+            self.server.refused += 1
+        with self.lock:
+            self.conn.send_headers(stream_id, [(':status', str(status)), ('retry-after', '1'), ('content-length', '0')], end_stream=True)
+            self.flush()
+
+    def respond(self, stream_id, headers):
+        server = self.server
+        faults = server.faults
+        parsed = parse_range(server, headers.get('range'), headers.get('if-range'))
+        if parsed is None:
+            with self.lock:
+                self.conn.send_headers(stream_id, [(':status', '416'), ('content-range', f'bytes */{server.size}')], end_stream=True)
+                self.flush()
+            return
+        start, end, status = parsed
+        if faults.latency:
+            time.sleep(faults.latency)
+        body = headers.get(':method') != 'HEAD'
+        with self.lock:
+            self.conn.send_headers(stream_id, [(':status', str(status))] + response_headers(server, start, end, status),
+                                   end_stream=not body)
+            self.flush()
+        if not body:
+            return
+
+        length = end - start + 1
+        stop = end + 1
+        stalls = faults.stall and faults.random.random() < faults.stall
+        if stalls or (faults.reset and faults.random.random() < faults.reset) or \
+                (faults.truncate and faults.random.random() < faults.truncate):
+            stop = start + faults.random.randrange(length)
+        flip = corruption(faults, start, length)
+
+        block = memoryview(server.block)
+        pos, sent, began = start, 0, time.monotonic()
+        while pos < stop:
+            with self.lock:
+                window = self.conn.local_flow_control_window(stream_id)
+                while not window and not self.closed:
+                    self.window_open.wait(1.0)
+                    window = self.conn.local_flow_control_window(stream_id)
+                if self.closed:
+                    return
+                offset = pos % BLOCK_SIZE
+                n = min(SEND_SIZE, BLOCK_SIZE - offset, stop - pos, window, self.conn.max_outbound_frame_size)
+                self.conn.send_data(stream_id, bytes(body_slice(block, pos, n, flip)), end_stream=pos + n > end)
+                self.flush()
+            pos += n
+            sent += n
+            if faults.rate:
+                ahead = sent / faults.rate - (time.monotonic() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+        with server.lock:
+            server.sent += sent
+        if stop <= end:
+            with server.lock:
+                server.aborted += 1
+            if stalls:
+                # The stream just goes quiet; the client has to notice and cancel it
+                time.sleep(STALL_SECONDS)
+            with self.lock:
+                self.conn.reset_stream(stream_id, h2.errors.ErrorCodes.INTERNAL_ERROR)
+                self.flush()
+
+
+class BenchServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, size, port=0, host='127.0.0.1', seed=0, faults=None, http2=False):
+        if http2 and h2 is None:
+            raise RuntimeError("HTTP/2 needs the h2 package (pip install h2)")
+        super().__init__((host, port), RangeHandler)
+        self.http2 = http2
+        self.size = size
+        self.seed = seed
+        self.block = content_block(seed)
+        self.faults = faults or Faults(seed=seed)
+        self.etag = f'"bench-{seed}-{size}"'
+        self.last_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        self.lock = threading.Lock()
+        self.active = 0
+        self.connections = 0
+        self.requests = 0
+        self.refused = 0
+        self.aborted = 0
+        self.sent = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/bench-{self.size}.bin'
+
+    def handle_error(self, request, client_address):
+        # Clients dropping pooled keep-alive connections when they exit is expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {'connections': self.connections, 'requests': self.requests, 'refused': self.refused, 'aborted': self.aborted, 'bytes_sent': self.sent}
+
+
+def add_fault_args(parser):
+    parser.add_argument('--rate', default='0', help="per-connection bandwidth, e.g. 4M (bytes/s)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before response headers")
+    parser.add_argument('--reset', type=float, default=0.0, help="probability of a mid-body TCP reset")
+    parser.add_argument('--truncate', type=float, default=0.0, help="probability of a short body")
+    parser.add_argument('--error', type=float, default=0.0, help="probability of a 429/503")
+    parser.add_argument('--max-connections', type=int, default=0, help="concurrent GETs before 429s")
+    parser.add_argument('--stall', type=float, default=0.0, help="probability of a body that hangs mid-way")
+    parser.add_argument('--handshake', type=float, default=0.0, help="seconds of connection setup before the first request")
+    parser.add_argument('--corrupt', type=float, default=0.0, help="probability of a body with one flipped byte")
+
+
+def faults_from_args(args, seed=0):
+    return Faults(rate=parse_size(args.rate), latency=args.latency, reset=args.reset, truncate=args.truncate,
+                  error=args.error, max_connections=args.max_connections, stall=args.stall,
+                  handshake=args.handshake, corrupt=args.corrupt, seed=seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Range-capable HTTP server with fault injection")
+    parser.add_argument('--size', default='256M')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--http2', action='store_true', help="also accept cleartext HTTP/2 (prior knowledge)")
+    add_fault_args(parser)
+    args = parser.parse_args(argv)
+
+    server = BenchServer(parse_size(args.size), args.port, args.host, args.seed, faults_from_args(args, args.seed), args.http2)
+    # First line is machine-readable so the runner can pick up an ephemeral port
+    print(f"URL {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(server.stats(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
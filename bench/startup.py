@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+# Runs as `python bench/startup.py` too, not only with -m
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.server import BenchServer, Faults
+
+# Cold-start budget. Every check runs in a fresh interpreter, best of --repeat, and
+# the run fails (exit 1) if one is over its budget, can't run at all (an import that
+# raises, a daemon that doesn't come up) or an import pulls in something that is
+# supposed to load lazily. Only a missing OPTIONAL package skips a check.
+#
+#   python -m bench.startup                    check against the budgets
+#   python -m bench.startup --scale 2          slower machine: every budget doubled
+#   python -m bench.startup --out startup.json
+#
+# Imports are timed inside the child, so interpreter startup doesn't count. The
+# daemon checks are wall time from spawning `python -m core serve`: until the
+# control API answers, and until a download handed to it has its first bytes.
+
+BUDGETS = {
+    'import core.manager': 0.25,
+    'import core.api': 0.05,
+    'import ui.main_window': 0.6,
+    'api ready': 1.0,
+    'first byte': 1.5,
+}
+
+# Loaded in the background or on first use; importing the module must not drag them in
+LAZY = {
+    'core.manager': ['flask', 'werkzeug', 'asyncio', 'core.aio'],
+    'core.api': ['flask', 'werkzeug', 'requests'],
+    'ui.main_window': ['flask', 'werkzeug', 'flask_cors', 'pystray', 'PIL', 'plyer', 'asyncio', 'core.aio'],
+}
+
+# Packages a check may legitimately lack (the GUI toolkit on a headless box); their
+# absence skips the check instead of failing it
+OPTIONAL = ['customtkinter', 'tkinter', '_tkinter']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Child side. A bare script rather than this module: whatever the harness imports
+# first (urllib, http.server) would be free for the module being timed.
+CHILD = """
+import json, sys, time
+module, lazy, optional = sys.argv[1], json.loads(sys.argv[2]), json.loads(sys.argv[3])
+began = time.perf_counter()
+try:
+    __import__(module)
+except ImportError as e:
+    missing = (e.name or '').split('.')[0]
+    print(json.dumps({'skipped' if missing in optional else 'error': f"{type(e).__name__}: {e}"}))
+except Exception as e:
+    print(json.dumps({'error': f"{type(e).__name__}: {e}"}))
+else:
+    print(json.dumps({'seconds': time.perf_counter() - began, 'eager': [m for m in lazy if m in sys.modules]}))
+"""
+
+
+def spawn_import(module):
+    cmd = [sys.executable, '-c', CHILD, module, json.dumps(LAZY[module]), json.dumps(OPTIONAL)]
+    proc = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True, timeout=60)
+    try:
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return {'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'crashed (exit {proc.returncode})'}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def fetch(url, data=None):
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'} if data else {})
+    with urllib.request.urlopen(req, timeout=2) as r:
+        return json.loads(r.read())
+
+
+def daemon_start(source_url, timeout):
+    # Seconds from spawning the daemon until the API answers, and until a queued download has data
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    out_dir = tempfile.mkdtemp(prefix='tafim-startup-')
+    began = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-m', 'core', 'serve', '--port', str(port), '--dir', out_dir],
+                            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result = {}
+    try:
+        while 'api ready' not in result:
+            if proc.poll() is not None or time.perf_counter() - began > timeout:
+                return {'error': 'daemon did not come up' if proc.poll() is None else f'daemon exited with {proc.returncode}'}
+            try:
+                fetch(f"{base}/status")
+                result['api ready'] = time.perf_counter() - began
+            except OSError:
+                time.sleep(0.005)
+        added = fetch(f"{base}/downloads", json.dumps([{'url': source_url, 'threads': 4}]).encode())
+        download_id = added['results'][0]['id']
+        while 'first byte' not in result:
+            if time.perf_counter() - began > timeout:
+                result['first byte'] = None
+                break
+            if fetch(f"{base}/status?id={download_id}")['downloaded'] > 0:
+                result['first byte'] = time.perf_counter() - began
+            else:
+                time.sleep(0.005)
+    finally:
+        proc.send_signal(signal.SIGTERM if hasattr(signal, 'SIGTERM') else signal.SIGINT)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return result
+
+
+def run_checks(args):
+    samples = {name: [] for name in BUDGETS}
+    eager, skipped, errors = {}, {}, {}
+    # Slow enough per connection that the download is still running when it's checked
+    server = BenchServer(64 * 1024 * 1024, faults=Faults(rate=1024 * 1024)).start()
+    try:
+        for _ in range(args.repeat):
+            for module in LAZY:
+                r = spawn_import(module)
+                name = f'import {module}'
+                if 'skipped' in r or 'error' in r:
+                    (skipped if 'skipped' in r else errors)[name] = r.get('skipped') or r['error']
+                    continue
+                samples[name].append(r['seconds'])
+                if r['eager']:
+                    eager[module] = r['eager']
+            r = daemon_start(server.url, args.timeout)
+            if 'error' in r:
+                errors['api ready'] = errors['first byte'] = r['error']
+                continue
+            for name, seconds in r.items():
+                if seconds is not None:
+                    samples[name].append(seconds)
+    finally:
+        server.stop()
+
+    failures = 0
+    results = {}
+    for name, budget in BUDGETS.items():
+        budget *= args.scale
+        if not samples[name]:
+            if name in skipped:
+                print(f"{name:24} {'skipped':>9}  ({skipped[name]})")
+                results[name] = {'skipped': skipped[name]}
+            else:
+                # Couldn't be measured at all; that's a regression too
+                failures += 1
+                print(f"{name:24} {'FAILED':>9}  ({errors.get(name, 'no samples')})")
+                results[name] = {'error': errors.get(name, 'no samples')}
+            continue
+        best = min(samples[name])
+        over = best > budget
+        failures += over
+        results[name] = {'seconds': round(best, 4), 'budget': budget, 'samples': [round(s, 4) for s in samples[name]]}
+        print(f"{name:24} {best * 1000:7.0f} ms  budget {budget * 1000:5.0f} ms  {'OVER BUDGET' if over else 'ok'}")
+    for module, names in eager.items():
+        failures += 1
+        print(f"import {module} loads {', '.join(names)} eagerly")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                                'platform': platform.platform(), 'scale': args.scale},
+                       'results': results, 'eager': eager}, f, indent=2)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup time budget")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per check; the best one counts")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiply every budget, for slower machines")
+    parser.add_argument('--timeout', type=float, default=30.0, help="give up on the daemon after this many seconds")
+    parser.add_argument('--out', help="write the results as JSON")
+    args = parser.parse_args(argv)
+    sys.exit(1 if run_checks(args) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+
+import requests
+
+# Headless entry point, no GUI imports:
+#   python -m core serve --dir /data/downloads     run the engine + control API as a daemon
+#   python -m core add URL... [-i urls.txt]        queue URLs on a running daemon
+#   python -m core status [ID]                     show what the daemon is doing
+#   python -m core pause|resume|cancel ID...       control queued/running downloads
+#   python -m core get URL                         one-off download in the foreground
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.api import DEFAULT_PORT
+
+BATCH_SIZE = 1000
+
+
+def fmt_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def fmt_eta(seconds):
+    if seconds is None:
+        return "--"
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+
+
+def read_urls(args):
+    urls = list(args.urls)
+    for path in args.input or []:
+        f = sys.stdin if path == '-' else open(path)
+        with f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    urls.append(line)
+    return urls
+
+
+def parse_size(value):
+    # "10G", "512M", "4096" -> bytes
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    unit = value[-1:] if value[-1:] in units else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * units[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad size: {value}")
+
+
+def setup_cache(args):
+    if args.cache:
+        from core.cache import ContentCache
+        from core.downloader import Downloader
+        Downloader.set_cache(ContentCache(os.path.abspath(args.cache), args.cache_size))
+
+
+def retry_policy(args):
+    from core.retry import RetryPolicy
+    return RetryPolicy(max_attempts=args.retries, give_up_after=args.give_up_after or None)
+
+
+def cmd_serve(args):
+    from core.manager import DownloadManager
+    from core.api import create_api
+    from core.store import DownloadStore
+
+    os.makedirs(args.dir, exist_ok=True)
+    setup_cache(args)
+    store = None
+    if not args.no_db:
+        store = DownloadStore(args.db or os.path.join(os.path.abspath(args.dir), '.tafim_tmp', 'downloads.db'))
+    manager = DownloadManager(max_active=args.max_active, max_connections=args.max_connections, engine=args.engine,
+                              retry=retry_policy(args), sync=args.sync, store=store)
+    api = create_api(manager, save_dir=os.path.abspath(args.dir), threads=args.threads)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f"Serving on http://{args.host}:{args.port}, saving to {os.path.abspath(args.dir)}")
+    try:
+        api.run(host=args.host, port=args.port, debug=False, use_reloader=False, threaded=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Pausing active downloads...")
+        manager.shutdown()
+
+
+def cmd_add(args):
+    urls = read_urls(args)
+    if not urls:
+        sys.exit("No URLs given")
+    defaults = {'threads': args.threads, 'priority': args.priority}
+    if args.dir:
+        defaults['dir'] = os.path.abspath(args.dir)
+    if args.checksum:
+        defaults['checksum'] = args.checksum
+    if args.protocol:
+        defaults['protocol'] = args.protocol
+    if args.mirror:
+        # Only makes sense for a single file
+        if len(urls) != 1:
+            sys.exit("--mirror needs exactly one URL")
+        defaults['mirrors'] = args.mirror
+    failed = 0
+    # One request per batch instead of one per URL
+    for i in range(0, len(urls), BATCH_SIZE):
+        batch = urls[i:i + BATCH_SIZE]
+        try:
+            r = requests.post(f"{args.server}/downloads", json={'items': batch, 'defaults': defaults}, timeout=60)
+            results = r.json()['results']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            sys.exit(f"Daemon not reachable at {args.server}: {e}")
+        for url, result in zip(batch, results):
+            if 'id' in result:
+                print(f"{result['id']}\t{url}")
+            else:
+                print(f"Failed to add {url}: {result['error']}", file=sys.stderr)
+                failed += 1
+    if failed:
+        sys.exit(1)
+
+
+def api_get(args, path, params=None):
+    try:
+        r = requests.get(f"{args.server}{path}", params=params, timeout=10)
+    except requests.RequestException as e:
+        sys.exit(f"Daemon not reachable at {args.server}: {e}")
+    if r.status_code == 404:
+        sys.exit(f"No download with id {args.id}")
+    r.raise_for_status()
+    return r.json()
+
+
+def cmd_status(args):
+    if args.id is not None:
+        items = [api_get(args, f"/downloads/{args.id}")]
+    else:
+        items, offset = [], 0
+        while offset is not None:
+            page = api_get(args, "/downloads", {'offset': offset, 'limit': 1000, 'status': args.filter or ''})
+            items += page['items']
+            offset = page['next']
+    if args.json:
+        print(json.dumps(items if args.id is None else items[0], indent=2))
+        return
+    for item in items:
+        print(f"{item['id']:>4}  {item['status']:<11} {item['progress'] * 100:5.1f}%  "
+              f"{fmt_size(item['downloaded']):>10} / {fmt_size(item['size']):>10}  "
+              f"{fmt_size(item['speed'])}/s  eta {fmt_eta(item['eta'])}  {item['file']}")
+
+
+def cmd_control(args):
+    failed = 0
+    for download_id in args.ids:
+        try:
+            r = requests.post(f"{args.server}/downloads/{download_id}/{args.command}", timeout=10)
+        except requests.RequestException as e:
+            sys.exit(f"Daemon not reachable at {args.server}: {e}")
+        if r.status_code != 200:
+            print(f"{download_id}: {r.json().get('error', r.status_code)}", file=sys.stderr)
+            failed += 1
+        else:
+            print(f"{download_id}\t{r.json()['status']}")
+    if failed:
+        sys.exit(1)
+
+
+def cmd_get(args):
+    from core.downloader import Downloader
+
+    setup_cache(args)
+    dl = Downloader(args.url, os.path.abspath(args.output), threads=args.threads, engine=args.engine, checksum=args.checksum,
+                    mirrors=args.mirror, protocol=args.protocol, retry=retry_policy(args), sync=args.sync)
+    dl.start()
+    try:
+        while dl.status not in ("completed", "error"):
+            time.sleep(0.5)
+            if not args.quiet:
+                print(f"\r{dl.get_progress() * 100:5.1f}%  {fmt_size(dl.downloaded_size)}  "
+                      f"{fmt_size(dl.speed)}/s  eta {fmt_eta(dl.get_eta())}   ", end="", flush=True)
+    except KeyboardInterrupt:
+        dl.pause()
+        print("\nPaused, run the same command again to resume")
+        sys.exit(130)
+    if not args.quiet:
+        print()
+    if dl.status != "completed":
+        sys.exit(f"Download failed: {dl.filename}")
+    print(dl.save_path)
+
+
+def add_cache_args(p):
+    p.add_argument('--cache', metavar='DIR', help="reuse identical files from this local cache instead of downloading them")
+    p.add_argument('--cache-size', type=parse_size, default='10G', help="cache size budget, least recently used evicted first")
+
+
+def add_retry_args(p):
+    p.add_argument('--retries', type=int, default=10, help="retries per segment before it counts as failed")
+    p.add_argument('--give-up-after', type=float, default=600, help="fail after this many seconds without progress (0 = never)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m core", description="Tafim Downloader, headless")
+    parser.add_argument('--server', default=f"http://127.0.0.1:{DEFAULT_PORT}", help="daemon address for add/status")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('serve', help="run the download engine and control API")
+    p.add_argument('--dir', default='.', help="default download directory")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=DEFAULT_PORT)
+    p.add_argument('--max-active', type=int, default=3)
+    p.add_argument('--max-connections', type=int, default=128)
+    p.add_argument('--threads', type=int, default=32, help="default threads per download")
+    p.add_argument('--engine', choices=('thread', 'async'), default='thread')
+    p.add_argument('--sync', choices=('none', 'checkpoint', 'always'), default='none',
+                   help="when to fsync downloaded data: never, before each checkpoint, or after every write")
+    p.add_argument('--db', help="queue and history database (default: .tafim_tmp/downloads.db in --dir)")
+    p.add_argument('--no-db', action='store_true', help="keep the queue in memory only; nothing is resumed on restart")
+    add_cache_args(p)
+    add_retry_args(p)
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser('add', help="queue URLs on a running daemon")
+    p.add_argument('urls', nargs='*')
+    p.add_argument('-i', '--input', action='append', help="file with one URL per line ('-' for stdin)")
+    p.add_argument('--dir', help="download directory (default: the daemon's)")
+    p.add_argument('--threads', type=int, default=32)
+    p.add_argument('--checksum', help="expected digest, e.g. sha256:<hex>")
+    p.add_argument('--priority', type=int, default=0, help="higher starts first")
+    p.add_argument('--mirror', action='append', help="another URL for the same file (repeatable)")
+    p.add_argument('--protocol', choices=('auto', 'http1', 'http2'), help="default: HTTP/2 where the server offers it")
+    p.set_defaults(func=cmd_add)
+
+    p = sub.add_parser('status', help="show downloads on a running daemon")
+    p.add_argument('id', nargs='?', type=int)
+    p.add_argument('--filter', help="only these statuses, e.g. downloading,queued")
+    p.add_argument('--json', action='store_true')
+    p.set_defaults(func=cmd_status)
+
+    for action in ('pause', 'resume', 'cancel'):
+        p = sub.add_parser(action, help=f"{action} downloads on a running daemon")
+        p.add_argument('ids', nargs='+', type=int)
+        p.set_defaults(func=cmd_control)
+
+    p = sub.add_parser('get', help="download one URL in the foreground")
+    p.add_argument('url')
+    p.add_argument('-o', '--output', default='.', help="file or directory")
+    p.add_argument('--threads', type=int, default=32)
+    p.add_argument('--engine', choices=('thread', 'async'), default='thread')
+    p.add_argument('--checksum')
+    p.add_argument('--mirror', action='append', help="another URL for the same file (repeatable)")
+    p.add_argument('--protocol', choices=('auto', 'http1', 'http2'), default='auto')
+    p.add_argument('--sync', choices=('none', 'checkpoint', 'always'), default='none',
+                   help="when to fsync downloaded data: never, before each checkpoint, or after every write")
+    add_cache_args(p)
+    add_retry_args(p)
+    p.add_argument('-q', '--quiet', action='store_true')
+    p.set_defaults(func=cmd_get)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
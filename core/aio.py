@@ -0,0 +1,347 @@
+import asyncio
+import ssl
+import threading
+from urllib.parse import urlsplit, urljoin
+
+from core.connections import DNSCache
+from core.integrity import PieceMismatch
+
+# Async engine: every segment of every download runs as a coroutine on one
+# shared event loop instead of one OS thread per segment.
+
+
+class AsyncHTTPError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncResponse:
+    def __init__(self, client, key, reader, writer, status, headers):
+        self.client = client
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.headers = headers
+        self.finished = False
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise AsyncHTTPError(f"Status {self.status}", self.status)
+
+    async def iter_chunks(self, chunk_size, timeout=15):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            async for data in self._iter_chunked(timeout):
+                yield data
+        elif 'content-length' in self.headers:
+            left = int(self.headers['content-length'])
+            while left > 0:
+                data = await asyncio.wait_for(self.reader.readexactly(min(chunk_size, left)), timeout)
+                left -= len(data)
+                yield data
+        else:
+            # No framing: body runs until the server closes the connection
+            self.headers['connection'] = 'close'
+            while True:
+                data = await asyncio.wait_for(self.reader.read(chunk_size), timeout)
+                if not data:
+                    break
+                yield data
+        self.finished = True
+
+    async def _iter_chunked(self, timeout):
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), timeout)
+            size = int(line.split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                # Skip trailers up to the blank line
+                while (await asyncio.wait_for(self.reader.readline(), timeout)) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            yield await asyncio.wait_for(self.reader.readexactly(size), timeout)
+            await asyncio.wait_for(self.reader.readexactly(2), timeout)
+
+    def abort(self):
+        # Called on the loop thread; the pending read fails and the connection is dropped
+        if self.writer is not None:
+            self.writer.transport.abort()
+
+    def close(self):
+        # Fully read keep-alive bodies go back to the pool, anything else is dropped
+        if self.writer is None:
+            return
+        if self.finished and self.headers.get('connection', '').lower() != 'close':
+            self.client.release(self.key, self.reader, self.writer)
+        else:
+            self.writer.close()
+        self.writer = None
+
+
+class AsyncHTTPClient:
+    # Minimal streaming HTTP/1.1 client with per-host keep-alive pooling
+    def __init__(self, max_idle_per_host=64, dns=None):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}
+        self.ssl_context = ssl.create_default_context()
+        self.dns = dns or DNSCache()
+        # Only touched on the loop thread; requests - connections = reused
+        self.requests_sent = 0
+        self.connections_opened = 0
+        self.per_host = {} # host -> {'requests': n, 'connections': n}
+
+    def release(self, key, reader, writer):
+        pool = self.idle.setdefault(key, [])
+        if len(pool) < self.max_idle_per_host and not writer.is_closing():
+            pool.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _connect(self, key, timeout):
+        pool = self.idle.get(key)
+        while pool:
+            reader, writer = pool.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self._open(key, timeout)
+        return reader, writer, False
+
+    def _count(self, host, name):
+        entry = self.per_host.setdefault(host, {'requests': 0, 'connections': 0})
+        entry[name] += 1
+
+    async def _open(self, key, timeout):
+        # New connection to a cached address; the resolver only runs (off the loop) on a miss
+        scheme, host, port = key
+        self.connections_opened += 1
+        self._count(host, 'connections')
+        infos = self.dns.peek(host, port)
+        if infos is None:
+            infos = await asyncio.get_running_loop().run_in_executor(None, self.dns.resolve, host, port)
+        error = None
+        for family, _, _, _, address in infos:
+            try:
+                return await asyncio.wait_for(
+                    asyncio.open_connection(address[0], port, family=family, ssl=self.ssl_context if scheme == 'https' else None,
+                                            server_hostname=host if scheme == 'https' else None),
+                    timeout
+                )
+            except OSError as e:
+                error = e
+        raise error or OSError(f"No addresses for {host}")
+
+    async def warm(self, url, count, pace=0.005, timeout=10):
+        # Tops the idle pool of url's host up to count connections, opened in parallel
+        # pace seconds apart. Returns how many were opened.
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        idle = [conn for conn in self.idle.get(key, []) if not conn[1].is_closing()]
+
+        async def open_one():
+            try:
+                reader, writer = await self._open(key, timeout)
+            except (OSError, asyncio.TimeoutError):
+                return 0
+            self.release(key, reader, writer)
+            return 1
+
+        tasks = []
+        for _ in range(count - len(idle)):
+            tasks.append(asyncio.ensure_future(open_one()))
+            await asyncio.sleep(pace)
+        return sum(await asyncio.gather(*tasks))
+
+    async def get(self, url, headers=None, timeout=15, max_redirects=5):
+        for _ in range(max_redirects + 1):
+            resp = await self._request(url, headers or {}, timeout)
+            location = resp.headers.get('location')
+            if resp.status in (301, 302, 303, 307, 308) and location:
+                resp.writer.close()
+                resp.writer = None
+                url = urljoin(url, location)
+                continue
+            return resp
+        raise AsyncHTTPError("Too many redirects")
+
+    async def _request(self, url, headers, timeout):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+
+        lines = [f'GET {path} HTTP/1.1', f'Host: {parts.netloc}', 'Accept-Encoding: identity', 'Connection: keep-alive']
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        payload = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        for attempt in range(2):
+            reader, writer, reused = await self._connect(key, timeout)
+            self.requests_sent += 1
+            self._count(key[1], 'requests')
+            try:
+                writer.write(payload)
+                await writer.drain()
+                status_line = await asyncio.wait_for(reader.readline(), timeout)
+                if not status_line:
+                    raise ConnectionResetError("Connection closed by server")
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # A pooled connection may have gone stale; retry once on a fresh one
+                if not reused or attempt:
+                    raise
+
+        status = int(status_line.split()[1])
+        resp_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            resp_headers[name.strip().lower()] = value.strip()
+        return AsyncResponse(self, key, reader, writer, status, resp_headers)
+
+
+class AsyncEngine:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        from core.downloader import Downloader
+        self.loop = asyncio.new_event_loop()
+        # Same DNS cache as the thread engine
+        self.client = AsyncHTTPClient(dns=Downloader.dns)
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def launch(self, downloader, stop_event):
+        # Called from any thread; progress bookkeeping runs on the loop
+        return asyncio.run_coroutine_threadsafe(self.monitor(downloader, stop_event), self.loop)
+
+    def warm(self, url, count, pace):
+        # Blocking, from any thread but the loop's
+        return asyncio.run_coroutine_threadsafe(self.client.warm(url, count, pace), self.loop).result()
+
+    def spawn(self, downloader, chunk_index, stop_event, mirror):
+        # Segment workers are coroutines; Downloader.spawn_workers does the accounting
+        return asyncio.run_coroutine_threadsafe(self.worker(downloader, chunk_index, stop_event, mirror), self.loop)
+
+    async def monitor(self, dl, stop_event):
+        dl.reset_speed()
+        while not stop_event.is_set():
+            await asyncio.sleep(0.1)
+            dl.monitor_tick(stop_event)
+
+    async def worker(self, dl, chunk_index, stop_event, mirror):
+        retired = False
+        try:
+            while chunk_index is not None and not stop_event.is_set():
+                if await self.download_chunk(dl, chunk_index, stop_event, mirror):
+                    retired = True
+                    return
+                if dl.chunk_info[chunk_index]['status'] != 'completed':
+                    return
+                if dl.retire_worker():
+                    retired = True
+                    return
+                chunk_index = dl.next_segment()
+        finally:
+            dl.worker_exited(stop_event, retired, mirror)
+
+    async def download_chunk(self, dl, chunk_index, stop_event, mirror):
+        info = dl.chunk_info[chunk_index]
+        if dl.segment_done(info):
+            info['status'] = 'completed'
+            return
+
+        resp = chunks = None
+        dl.stalled.discard(chunk_index)
+        stats = dl.metrics.segment(chunk_index)
+        stats.request_started()
+        try:
+            first = dl.take_first_response(chunk_index, mirror)
+            if first is not None:
+                # Segment 0 carries on from the probe's response (see Downloader.get_file_info)
+                resp = first
+                stats.request_start -= first.elapsed.total_seconds()
+                stats.first_byte()
+                chunks = self.read_blocking(dl, first)
+            else:
+                if mirror.http2:
+                    resp = await dl.http2.aget(mirror.url, dl.segment_headers(info, mirror), timeout=15)
+                else:
+                    resp = await self.client.get(mirror.url, dl.segment_headers(info, mirror), timeout=15)
+                stats.first_byte()
+                resp.raise_for_status()
+                dl.check_segment_response(info, resp.status, resp.headers)
+                chunks = resp.iter_chunks(dl.chunk_size)
+            dl.mirrors.succeeded(mirror)
+            dl.inflight[chunk_index] = resp
+            async for chunk in chunks:
+                if stop_event.is_set():
+                    return
+                delay = dl.reserve_bandwidth(len(chunk), mirror.host)
+                if delay:
+                    await asyncio.sleep(delay)
+                    if stop_event.is_set():
+                        return
+                # The loop can't block on a full write queue; this coroutine waits for room instead
+                if dl.writer.full():
+                    room = dl.writer.room(asyncio.get_running_loop())
+                    while not room.done() and not stop_event.is_set():
+                        await asyncio.wait((room,), timeout=0.25)
+                output = dl.output
+                try:
+                    done = chunk and dl.write_chunk(info, chunk, stats, wait=False)
+                except PieceMismatch as e:
+                    # The segment's queued writes have to land before it is rolled back
+                    if output is not None:
+                        await dl.writer.drained(asyncio.get_running_loop(), output, info)
+                    dl.rewind(info, e)
+                    raise
+                if done:
+                    dl.mirrors.record(mirror, len(chunk))
+                    break
+                dl.mirrors.record(mirror, len(chunk))
+                if dl.retire_worker():
+                    info['status'] = 'pending'
+                    return True
+                if not mirror.healthy():
+                    info['status'] = 'pending'
+                    return False
+            if stop_event.is_set():
+                return
+            if info['end'] != -1 and not dl.segment_done(info):
+                raise ConnectionResetError("Response ended before the end of the segment")
+            info['status'] = 'completed'
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            dl.segment_failed(chunk_index, e, mirror)
+        finally:
+            stats.request_done()
+            dl.inflight.pop(chunk_index, None)
+            if chunks is not None:
+                await chunks.aclose()
+            if resp is not None:
+                resp.close()
+        return False
+
+    async def read_blocking(self, dl, r):
+        # A blocking requests response, read on the executor so the loop never waits on its socket
+        loop = asyncio.get_running_loop()
+        body = dl.read_body(r)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, body, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            body.close()
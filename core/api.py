@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+
+# HTTP control API on top of a DownloadManager. Shared by the GUI and the headless
+# daemon (python -m core); nothing here touches Tk. Flask is only imported by
+# create_api, so the constants here cost nothing at startup and the GUI can bring
+# the server up on a background thread.
+
+DEFAULT_PORT = 5555
+MAX_PAGE = 1000
+ACTIONS = ('pause', 'resume', 'cancel')
+
+
+def create_api(manager, capture=None, save_dir=".", threads=32, on_added=None):
+    # capture(url): hand browser/extension captures to the UI instead of queueing them directly.
+    # on_added(download_id): told about downloads queued through the JSON API.
+    # save_dir and threads are defaults for items that don't say; either may be a callable.
+    from flask import Flask, request, Response, jsonify
+    try:
+        from flask_cors import CORS
+    except ImportError:
+        CORS = None
+
+    api = Flask("tafim")
+    if CORS is not None:
+        CORS(api)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    @api.route('/add')
+    def add():
+        url = request.args.get('url')
+        if not url:
+            return "ERR"
+        if capture is not None:
+            capture(url)
+            return "OK"
+        download_id = manager.add(
+            url,
+            request.args.get('dir') or setting(save_dir),
+            threads=request.args.get('threads', setting(threads), type=int),
+            checksum=request.args.get('checksum')
+        )
+        return str(download_id)
+
+    @api.route('/status')
+    def status():
+        download_id = request.args.get('id', type=int)
+        if download_id is None:
+            return jsonify(manager.status())
+        dl = manager.lookup(download_id)
+        if dl is None:
+            return jsonify({'error': 'not found'}), 404
+        return jsonify(manager.summary(download_id, dl))
+
+    @api.route('/downloads', methods=['POST'])
+    def add_downloads():
+        # Bulk enqueue: a list of items, or {"items": [...], "defaults": {...}}.
+        # Item fields: url, dir, threads, priority, checksum, mirrors, protocol. Results come back in input order.
+        body = request.get_json(silent=True)
+        defaults = {}
+        if isinstance(body, dict):
+            defaults = body.get('defaults') or {}
+            body = body.get('items')
+        if not isinstance(defaults, dict):
+            return jsonify({'error': 'defaults must be an object'}), 400
+        if not isinstance(body, list):
+            return jsonify({'error': 'expected a list of items'}), 400
+
+        items, results, positions = [], [None] * len(body), []
+        for i, raw in enumerate(body):
+            item = dict(defaults, **raw) if isinstance(raw, dict) else dict(defaults, url=raw)
+            error = validate(item)
+            if error:
+                results[i] = {'error': error}
+                continue
+            items.append({
+                'url': item['url'],
+                'save_path': item.get('dir') or setting(save_dir),
+                'threads': int(item.get('threads') or setting(threads)),
+                'priority': int(item.get('priority') or 0),
+                'checksum': item.get('checksum'),
+                'mirrors': item.get('mirrors'),
+                'protocol': item.get('protocol')
+            })
+            positions.append(i)
+        for i, result in zip(positions, manager.add_many(items)):
+            results[i] = result
+            if on_added is not None and 'id' in result:
+                on_added(result['id'])
+        added = sum(1 for r in results if 'id' in r)
+        return jsonify({'added': added, 'results': results}), 201 if added else 400
+
+    @api.route('/downloads')
+    def list_downloads():
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = min(MAX_PAGE, max(1, request.args.get('limit', 100, type=int)))
+        statuses = sorted(set(filter(None, request.args.get('status', '').split(','))))
+        total, items = manager.page(statuses, offset, limit)
+        return jsonify({
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'next': offset + limit if offset + limit < total else None,
+            'items': items
+        })
+
+    @api.route('/downloads/<int:download_id>')
+    def get_download(download_id):
+        dl = manager.lookup(download_id)
+        if dl is None:
+            return jsonify({'error': 'not found'}), 404
+        return jsonify(manager.summary(download_id, dl))
+
+    @api.route('/downloads/<int:download_id>', methods=['DELETE'])
+    def remove_download(download_id):
+        dl = manager.lookup(download_id)
+        if dl is None:
+            return jsonify({'error': 'not found'}), 404
+        if dl.status not in ("completed", "error", "cancelled"):
+            manager.cancel(download_id)
+        manager.remove(download_id)
+        return jsonify({'id': download_id, 'removed': True})
+
+    @api.route('/downloads/<int:download_id>/<action>', methods=['POST'])
+    def control_download(download_id, action):
+        if manager.get(download_id) is None:
+            return jsonify({'error': 'not found'}), 404
+        if action == 'priority':
+            body = request.get_json(silent=True) or {}
+            try:
+                priority = int(body.get('priority', request.args.get('priority')))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'priority must be an integer'}), 400
+            manager.set_priority(download_id, priority)
+        elif action in ACTIONS:
+            getattr(manager, action)(download_id)
+        else:
+            return jsonify({'error': f'unknown action {action}'}), 404
+        return jsonify(manager.summary(download_id, manager.get(download_id)))
+
+    @api.route('/events')
+    def events():
+        # SSE when asked for (Accept: text/event-stream or ?stream=1), long-poll otherwise.
+        # Resume from ?since=<seq> or the Last-Event-ID header.
+        since = request.args.get('since', type=int)
+        if since is None:
+            since = int(request.headers.get('Last-Event-ID', 0) or 0)
+        timeout = min(60.0, request.args.get('timeout', 25.0, type=float))
+        if 'text/event-stream' not in request.headers.get('Accept', '') and not request.args.get('stream'):
+            batch = manager.events.since(since, timeout)
+            return jsonify({'events': batch, 'last': batch[-1]['seq'] if batch else since})
+
+        def stream(seq):
+            yield 'retry: 2000\n\n'
+            while True:
+                batch = manager.events.since(seq, 15)
+                if not batch:
+                    # Keeps proxies from timing out an idle stream
+                    yield ': keep-alive\n\n'
+                    continue
+                for event in batch:
+                    yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                seq = batch[-1]['seq']
+        return Response(stream(since), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    @api.route('/metrics')
+    def metrics():
+        return Response(manager.metrics_text(), mimetype='text/plain; version=0.0.4')
+
+    @api.route('/stats')
+    def stats():
+        return jsonify(manager.stats())
+
+    return api
+
+
+def setting(value):
+    return value() if callable(value) else value
+
+
+def validate(item):
+    url = item.get('url')
+    if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+        return 'url must be an http(s) URL'
+    for key in ('threads', 'priority'):
+        if item.get(key) is not None:
+            try:
+                int(item[key])
+            except (TypeError, ValueError):
+                return f'{key} must be an integer'
+    if item.get('protocol') not in (None, 'auto', 'http1', 'http2'):
+        return 'protocol must be auto, http1 or http2'
+    mirrors = item.get('mirrors')
+    if mirrors is not None and (not isinstance(mirrors, list) or
+                                not all(isinstance(m, str) and m.startswith(('http://', 'https://')) for m in mirrors)):
+        return 'mirrors must be a list of http(s) URLs'
+    if item.get('dir') is not None and not os.path.isdir(item['dir']):
+        return f"directory does not exist: {item['dir']}"
+    return None
@@ -0,0 +1,155 @@
+import mmap
+import os
+import re
+import struct
+import threading
+
+# Completion index of the output file: one bit per fixed-size block, set once
+# the disk writer has put the whole block in the file. Lives in blocks.map next
+# to the journal, memory-mapped, so marking a block is a bit flip in the page
+# cache and a crash loses nothing the kernel already has. On resume it is the
+# authority on what's on disk: any out-of-order ranges written past the last
+# checkpoint survive, and the segment layout is rebuilt from its runs.
+
+HEADER = struct.Struct('<4sIqq') # magic, version, file size, block size
+MAGIC = b'TFBM'
+VERSION = 1
+NOT_FULL = re.compile(b'[^\\xff]')
+NOT_EMPTY = re.compile(b'[^\\x00]')
+
+
+class BlockMap:
+    def __init__(self, path, file_size, block_size):
+        self.path = path
+        self.file_size = file_size
+        self.block_size = block_size
+        self.blocks = -(-file_size // block_size)
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+
+    def open(self, fresh=False):
+        # Returns True if an existing map for this file and block size was loaded
+        length = HEADER.size + -(-self.blocks // 8)
+        loaded = False
+        if not fresh and os.path.exists(self.path) and os.path.getsize(self.path) == length:
+            with open(self.path, 'rb') as f:
+                loaded = f.read(HEADER.size) == HEADER.pack(MAGIC, VERSION, self.file_size, self.block_size)
+        if not loaded:
+            with open(self.path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, self.file_size, self.block_size))
+                f.truncate(length)
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), length)
+        return loaded
+
+    def span(self, start, end, whole):
+        # Block indexes [first, last) inside the byte range [start, end); with whole=False
+        # also the ones it only touches. The short last block counts as whole at the file end.
+        bs = self.block_size
+        if whole:
+            first = -(-start // bs)
+            last = self.blocks if end >= self.file_size else end // bs
+        else:
+            first, last = start // bs, min(self.blocks, -(-end // bs))
+        return first, last
+
+    def mark(self, start, end):
+        first, last = self.span(start, end, True)
+        self._set(first, last, True)
+
+    def clear(self, start, end):
+        # Anything touching the range, e.g. a piece that failed its hash
+        first, last = self.span(start, end, False)
+        self._set(first, last, False)
+
+    def _set(self, first, last, value):
+        if first >= last:
+            return
+        m = self.map
+        with self.lock:
+            i = first
+            while i < last:
+                if i % 8 == 0 and last - i >= 8:
+                    # Whole bytes at a time through the middle
+                    n = (last - i) // 8
+                    pos = HEADER.size + i // 8
+                    m[pos:pos + n] = (b'\xff' if value else b'\x00') * n
+                    i += n * 8
+                    continue
+                pos = HEADER.size + i // 8
+                if value:
+                    m[pos] |= 1 << (i % 8)
+                else:
+                    m[pos] &= ~(1 << (i % 8)) & 0xff
+                i += 1
+
+    def done(self, index):
+        return bool(self.map[HEADER.size + index // 8] & (1 << (index % 8)))
+
+    def count(self):
+        bits = self.map[HEADER.size:]
+        return sum(bin(b).count('1') for b in bits.translate(None, b'\x00\xff')) + 8 * bits.count(b'\xff')
+
+    def runs(self):
+        # (start, end, done) byte ranges, end inclusive, alternating and covering the file.
+        # Whole bytes in the current state are skipped in C, so a mostly uniform map is cheap.
+        bits = self.map[HEADER.size:]
+        runs = []
+        i, run_start = 0, 0
+        state = self.blocks > 0 and self.done(0)
+        while i < self.blocks:
+            if i % 8 == 0:
+                match = (NOT_FULL if state else NOT_EMPTY).search(bits, i // 8)
+                nxt = match.start() * 8 if match else self.blocks
+                if nxt > i:
+                    i = min(nxt, self.blocks)
+                    continue
+            if self.done(i) != state:
+                runs.append((run_start * self.block_size, i * self.block_size - 1, state))
+                state, run_start = not state, i
+            i += 1
+        if self.blocks:
+            runs.append((run_start * self.block_size, self.file_size - 1, state))
+        return runs
+
+    def check(self, part_file, size):
+        # Startup check against the file itself: blocks past the end it had (size, before
+        # any preallocation), or in holes the filesystem knows were never written, are
+        # cleared. Returns the number of blocks cleared.
+        before = self.count()
+        if size < self.file_size:
+            self.clear(size, self.file_size)
+        if hasattr(os, 'SEEK_HOLE') and size and os.path.exists(part_file):
+            fd = os.open(part_file, os.O_RDONLY)
+            try:
+                pos = 0
+                while pos < min(size, self.file_size):
+                    hole = os.lseek(fd, pos, os.SEEK_HOLE)
+                    if hole >= self.file_size:
+                        break
+                    try:
+                        pos = os.lseek(fd, hole, os.SEEK_DATA)
+                    except OSError:
+                        # No data after this hole
+                        pos = size
+                    # A written block has no holes at all
+                    self.clear(hole, pos)
+            except OSError:
+                pass # Filesystem can't tell
+            finally:
+                os.close(fd)
+        return before - self.count()
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,81 @@
+import threading
+
+# Bounded pool of reusable receive buffers shared by every download. Segments
+# read straight from the socket into a pooled buffer (readinto) and hand it to
+# the disk writer, which gives it back once it's written; the hot loop allocates
+# nothing and the total held in buffers never exceeds max_bytes, however many
+# segments run or however far the disk falls behind.
+
+
+class Block:
+    # One read's worth of a pooled buffer. Exactly one party gives it back: the
+    # disk writer once it's written, or the reader if it never got queued.
+    __slots__ = ('pool', 'buf', 'data', 'queued')
+
+    def __init__(self, pool, buf):
+        self.pool = pool
+        self.buf = buf
+        self.data = None # memoryview of the bytes read
+        self.queued = False
+
+    def __len__(self):
+        return len(self.data)
+
+    def release(self):
+        if self.buf is not None:
+            buf, self.buf, self.data = self.buf, None, None
+            self.pool.release(buf)
+
+
+class BufferPool:
+    def __init__(self, buffer_size=256 * 1024, max_bytes=64 * 1024 * 1024):
+        self.buffer_size = buffer_size
+        self.max_buffers = max(1, max_bytes // buffer_size)
+        self.cond = threading.Condition()
+        self.free = []
+        self.created = 0 # Allocated lazily, up to max_buffers
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0 # Times a segment had to wait for a buffer
+
+    def acquire(self, timeout=None):
+        # Blocks while the pool is exhausted; None if timeout runs out first
+        with self.cond:
+            if not self.free and self.created >= self.max_buffers:
+                self.waits += 1
+                if not self.cond.wait_for(lambda: self.free or self.created < self.max_buffers, timeout):
+                    return None
+            if self.free:
+                buf = self.free.pop()
+            else:
+                buf = bytearray(self.buffer_size)
+                self.created += 1
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+            return buf
+
+    def block(self):
+        return Block(self, self.acquire())
+
+    def release(self, buf):
+        with self.cond:
+            self.in_use -= 1
+            if len(self.free) + self.in_use < self.max_buffers:
+                self.free.append(buf)
+            else:
+                # Pool was shrunk while this one was out
+                self.created -= 1
+            self.cond.notify()
+
+    def resize(self, max_bytes):
+        with self.cond:
+            self.max_buffers = max(1, max_bytes // self.buffer_size)
+            while self.free and self.created > self.max_buffers:
+                self.free.pop()
+                self.created -= 1
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {'buffer_size': self.buffer_size, 'capacity': self.max_buffers, 'allocated': self.created,
+                    'in_use': self.in_use, 'peak': self.peak, 'waits': self.waits}
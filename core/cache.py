@@ -0,0 +1,213 @@
+import errno
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from core.store import normalize_url
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+# Opt-in local cache of finished downloads, content-addressed by sha256 under
+# objects/. Two kinds of keys point at an object: the URL with the validator and
+# size the server sent (a strong ETag, else Last-Modified; without either nothing
+# proves the file is unchanged), and any known checksum ("md5:<hex>"). The
+# downloader looks it up during its probe, before a single segment starts; a hit
+# is put in place by reflink, hardlink or plain copy, in that order, with no
+# network transfer. Objects past the size budget are evicted least recently used.
+#
+# A hardlinked file shares its data with the cached object. Objects remember
+# their size and mtime, so one that was modified through a link is noticed and
+# dropped instead of being handed out again.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used);
+CREATE TABLE IF NOT EXISTS keys (
+    key TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS keys_digest ON keys (digest);
+"""
+
+FICLONE = 0x40049409 # Linux ioctl: share the extents of another file (btrfs, XFS, ...)
+READ_SIZE = 8 * 1024 * 1024
+
+
+def url_key(url, etag, last_modified, size):
+    # None when the response can't tell a changed file from the same one
+    validator = etag if etag and not etag.startswith('W/') else last_modified
+    if not validator or not size:
+        return None
+    return f"url:{normalize_url(url)}|{validator}|{size}"
+
+
+def checksum_key(algo, digest):
+    return f"{algo}:{digest.lower()}"
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                return h.hexdigest()
+            h.update(data)
+
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported")
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dst)
+            raise
+
+
+def clone(src, dst):
+    # Cheapest way to make dst hold src's bytes; returns how it was done
+    tmp = dst + '.tafim-cache'
+    for method, fn in (('reflink', reflink), ('hardlink', os.link), ('copy', shutil.copyfile)):
+        try:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            fn(src, tmp)
+        except OSError:
+            if method == 'copy':
+                raise
+            continue
+        os.replace(tmp, dst)
+        return method
+
+
+class ContentCache:
+    def __init__(self, directory, max_bytes=10 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self.methods = {} # reflink / hardlink / copy -> hits served that way
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def lookup(self, keys, size=None):
+        # Digest of a usable object for the first key that has one, else None
+        with self.lock:
+            for key in keys:
+                if key is None:
+                    continue
+                row = self.db.execute("SELECT o.digest, o.size, o.mtime_ns FROM keys k JOIN objects o ON o.digest = k.digest "
+                                      "WHERE k.key = ?", (key,)).fetchone()
+                if row is None:
+                    continue
+                digest, obj_size, mtime_ns = row
+                try:
+                    st = os.stat(self.object_path(digest))
+                except OSError:
+                    st = None
+                if st is None or st.st_size != obj_size or st.st_mtime_ns != mtime_ns or (size and size != obj_size):
+                    # Gone, or changed behind our back (e.g. edited through a hardlink)
+                    self.drop(digest)
+                    continue
+                return digest
+            self.misses += 1
+            return None
+
+    def materialize(self, digest, dest):
+        # Puts a copy of the object at dest; returns the method, or None if it couldn't
+        path = self.object_path(digest)
+        try:
+            method = clone(path, dest)
+        except OSError as e:
+            print(f"Warning: could not use cached copy of {os.path.basename(dest)}: {e}")
+            return None
+        size = os.path.getsize(dest)
+        with self.lock:
+            self.db.execute("UPDATE objects SET last_used = ? WHERE digest = ?", (time.time(), digest))
+            self.db.commit()
+            self.hits += 1
+            self.bytes_saved += size
+            self.methods[method] = self.methods.get(method, 0) + 1
+        return method
+
+    def add(self, path, keys, digest=None):
+        # Adds a finished file under its content hash, plus keys pointing at it. digest
+        # (sha256) skips hashing when the download already verified it.
+        keys = [k for k in keys if k]
+        size = os.path.getsize(path)
+        if size > self.max_bytes or not keys:
+            return None
+        digest = digest or file_digest(path)
+        target = self.object_path(digest)
+        with self.lock:
+            known = self.db.execute("SELECT 1 FROM objects WHERE digest = ?", (digest,)).fetchone()
+        if not known or not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            clone(path, target)
+        st = os.stat(target)
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO objects (digest, size, mtime_ns, last_used) VALUES (?, ?, ?, ?)",
+                                (digest, st.st_size, st.st_mtime_ns, time.time()))
+                self.db.executemany("INSERT OR REPLACE INTO keys (key, digest) VALUES (?, ?)",
+                                    [(k, digest) for k in keys + [checksum_key('sha256', digest)]])
+            self.evict()
+        return digest
+
+    def evict(self):
+        # Caller holds self.lock. Least recently used first, down to the budget.
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self.db.execute("SELECT digest, size FROM objects ORDER BY last_used LIMIT 16").fetchall()
+            if not rows:
+                break
+            for digest, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self.drop(digest)
+                self.evictions += 1
+                total -= size
+
+    def drop(self, digest):
+        # Caller holds self.lock
+        with self.db:
+            self.db.execute("DELETE FROM keys WHERE digest = ?", (digest,))
+            self.db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+        try:
+            os.unlink(self.object_path(digest))
+        except OSError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            count, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects").fetchone()
+            return {'objects': count, 'bytes': total, 'capacity': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'bytes_saved': self.bytes_saved, 'evictions': self.evictions,
+                    'methods': dict(self.methods)}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,134 @@
+import json
+import os
+import struct
+import time
+import zlib
+
+# Crash-safe resume state.
+#   state.json        small metadata (url, size, ...), rewritten atomically and only when it changes
+#   segments.journal  append-only fixed-size records, one per segment that moved since the last
+#                     checkpoint; compacted into a fresh file via atomic replace when it grows
+# Each record carries a CRC so a torn tail write is simply ignored on load.
+
+RECORD = struct.Struct('<IqqqB')
+CRC = struct.Struct('<I')
+RECORD_SIZE = RECORD.size + CRC.size
+
+STATUS_CODES = {'pending': 0, 'downloading': 1, 'completed': 2, 'error': 3}
+STATUS_NAMES = {v: k for k, v in STATUS_CODES.items()}
+
+
+def atomic_write(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Checkpoint:
+    def __init__(self, directory, fsync_interval=1.0, compact_records=4096, before_sync=None):
+        self.meta_file = os.path.join(directory, "state.json")
+        self.journal_file = os.path.join(directory, "segments.journal")
+        # Seconds between fsyncs of the journal; 0 syncs every checkpoint, None never does
+        self.fsync_interval = fsync_interval
+        self.compact_records = compact_records
+        # Called before every journal fsync, e.g. to fsync the data the records point at
+        self.before_sync = before_sync
+        self.journal = None
+        self.records = 0
+        self.written = []
+        self.meta_blob = None
+        self.last_sync = time.monotonic()
+
+    def encode(self, index, c):
+        body = RECORD.pack(index, c[0], c[1], c[2], STATUS_CODES.get(c[3], 0))
+        return body + CRC.pack(zlib.crc32(body))
+
+    def load(self):
+        # Returns (meta, chunks) or None if there is nothing usable to resume from
+        try:
+            with open(self.meta_file, 'rb') as f:
+                meta = json.loads(f.read())
+        except Exception:
+            return None
+
+        # Pre-journal state.json carried the chunk list inline
+        if 'chunks' in meta:
+            return meta, meta.pop('chunks')
+
+        latest = {}
+        try:
+            with open(self.journal_file, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = b''
+        for pos in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            body = data[pos:pos + RECORD.size]
+            crc, = CRC.unpack_from(data, pos + RECORD.size)
+            if zlib.crc32(body) != crc:
+                break
+            index, start, end, current, status = RECORD.unpack(body)
+            latest[index] = {'start': start, 'end': end, 'current': current, 'status': STATUS_NAMES.get(status, 'pending')}
+        if not latest:
+            return None
+        chunks = [latest[i] for i in sorted(latest)]
+        return meta, chunks
+
+    def save(self, meta, chunks):
+        # chunks: list of (start, end, current, status) tuples
+        blob = json.dumps(meta, sort_keys=True).encode()
+        if blob != self.meta_blob:
+            atomic_write(self.meta_file, blob)
+            self.meta_blob = blob
+
+        if self.journal is None:
+            # Start every run from a compacted journal holding exactly the current layout
+            self.compact(chunks)
+            return
+
+        out = []
+        written = self.written
+        for i, c in enumerate(chunks):
+            if i >= len(written) or written[i] != c:
+                out.append(self.encode(i, c))
+        if out:
+            self.written = list(chunks)
+            self.journal.write(b''.join(out))
+            self.records += len(out)
+            if self.records > max(self.compact_records, 4 * len(chunks)):
+                self.compact(chunks)
+                return
+            self.journal.flush()
+        self.maybe_sync()
+
+    def compact(self, chunks):
+        if self.journal is not None:
+            self.journal.close()
+        if self.before_sync is not None:
+            self.before_sync()
+        atomic_write(self.journal_file, b''.join(self.encode(i, c) for i, c in enumerate(chunks)))
+        self.journal = open(self.journal_file, 'ab')
+        self.records = len(chunks)
+        self.written = list(chunks)
+        self.last_sync = time.monotonic()
+
+    def maybe_sync(self, force=False):
+        if self.journal is None or (self.fsync_interval is None and not force):
+            return
+        now = time.monotonic()
+        if force or now - self.last_sync >= self.fsync_interval:
+            if self.before_sync is not None:
+                self.before_sync()
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.last_sync = now
+
+    def close(self):
+        if self.journal is not None:
+            try:
+                self.maybe_sync(force=True)
+            finally:
+                self.journal.close()
+                self.journal = None
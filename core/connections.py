@@ -0,0 +1,184 @@
+import socket
+import sys
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+try:
+    from urllib3.exceptions import NameResolutionError
+except ImportError:
+    NameResolutionError = None
+
+# Connection setup for segment fan-out. Every new connection resolves its host
+# through one shared DNS cache (concurrent lookups of a name wait for the first
+# one instead of all asking the resolver), and warm_pool opens the connections a
+# download is about to need ahead of time, in parallel but a few milliseconds
+# apart, into the pool its segments take them from. The system resolver doesn't
+# report record TTLs, so entries live for a fixed ttl.
+#
+# Both hook into urllib3 below its public API (HTTPConnection._new_conn and
+# _dns_host, HTTPConnectionPool._get_conn/_put_conn), as of the urllib3 2.x that
+# requirements.txt pins. Where those aren't there, pools stay urllib3's own: no
+# shared DNS cache and no warm-up, but downloads work as before.
+HOOKS = (NameResolutionError is not None and hasattr(HTTPConnection, '_new_conn')
+         and hasattr(HTTPConnectionPool, '_get_conn') and hasattr(HTTPConnectionPool, '_put_conn'))
+
+
+class DNSCache:
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self.entries = {} # (host, port) -> (expires, getaddrinfo results)
+        self.pending = {} # (host, port) -> Event, set when the lookup in flight is done
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def peek(self, host, port):
+        # Cached addresses, or None; never blocks on the resolver
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+        return None
+
+    def resolve(self, host, port):
+        key = (host, port)
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self.hits += 1
+                    return entry[1]
+                event = self.pending.get(key)
+                owner = event is None
+                if owner:
+                    event = self.pending[key] = threading.Event()
+            if not owner:
+                # Someone is already asking; use their answer (or ask again if theirs failed)
+                event.wait()
+                continue
+            try:
+                infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+                with self.lock:
+                    self.lookups += 1
+                    self.entries[key] = (time.monotonic() + self.ttl, infos)
+                return infos
+            finally:
+                with self.lock:
+                    self.pending.pop(key, None)
+                event.set()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'lookups': self.lookups, 'hits': self.hits, 'ttl': self.ttl}
+
+
+def connect(infos, timeout, source_address=None, socket_options=None):
+    # socket.create_connection over already resolved addresses, first one that answers
+    error = None
+    for family, kind, proto, _, address in infos:
+        sock = None
+        try:
+            sock = socket.socket(family, kind, proto)
+            for option in socket_options or ():
+                sock.setsockopt(*option)
+            if timeout is None or isinstance(timeout, (int, float)):
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            error = e
+            if sock is not None:
+                sock.close()
+    raise error or OSError("getaddrinfo returned no addresses")
+
+
+class CachedDNSMixin:
+    dns = None
+
+    def dns_host(self):
+        # urllib3 keeps the name to resolve (IPv6 literal without brackets) in _dns_host
+        return getattr(self, '_dns_host', None) or self.host.strip('[]')
+
+    def _new_conn(self):
+        # urllib3's own _new_conn, with the lookup going through the cache
+        try:
+            sock = connect(self.dns.resolve(self.dns_host(), self.port), self.timeout, self.source_address, self.socket_options)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        except socket.timeout as e:
+            raise ConnectTimeoutError(self, f"Connection to {self.host} timed out. (connect timeout={self.timeout})") from e
+        except OSError as e:
+            raise NewConnectionError(self, f"Failed to establish a new connection: {e}") from e
+        sys.audit("http.client.connect", self, self.host, self.port)
+        return sock
+
+
+class CachingAdapter(HTTPAdapter):
+    # requests adapter whose pools open connections through dns
+    def __init__(self, dns, **kwargs):
+        self.dns = dns
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        if not HOOKS:
+            return
+        dns = self.dns
+        http = type('CachedHTTPConnection', (CachedDNSMixin, HTTPConnection), {'dns': dns})
+        https = type('CachedHTTPSConnection', (CachedDNSMixin, HTTPSConnection), {'dns': dns})
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('CachedHTTPConnectionPool', (HTTPConnectionPool,), {'ConnectionCls': http}),
+            'https': type('CachedHTTPSConnectionPool', (HTTPSConnectionPool,), {'ConnectionCls': https}),
+        }
+
+
+def warm_pool(pool, count, pace=0.005, timeout=10):
+    # Makes sure count connections of the pool are open and idle. Missing ones are
+    # connected in parallel, started pace seconds apart so the handshakes don't all
+    # hit the server in the same instant. Returns how many were opened.
+    if not HOOKS:
+        return 0
+    conns = [pool._get_conn() for _ in range(count)]
+    cold = [conn for conn in conns if not getattr(conn, 'is_connected', True)]
+
+    def open_conn(conn):
+        conn.timeout = timeout
+        try:
+            conn.connect()
+        except Exception:
+            # The segment that gets it connects again, and reports the error if there is one
+            conn.close()
+
+    threads = []
+    for conn in cold:
+        t = threading.Thread(target=open_conn, args=(conn,), daemon=True)
+        t.start()
+        threads.append(t)
+        if pace:
+            time.sleep(pace)
+    for t in threads:
+        t.join()
+    for conn in conns:
+        pool._put_conn(conn)
+    return sum(1 for conn in cold if conn.is_connected)
+
+
+def pool_stats(poolmanager):
+    # {host: {'requests': n, 'connections': n}} over the urllib3 pools; requests - connections were reused
+    stats = {}
+    pools = poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is not None:
+            entry = stats.setdefault(pool.host, {'requests': 0, 'connections': 0})
+            entry['requests'] += pool.num_requests
+            entry['connections'] += pool.num_connections
+    return stats
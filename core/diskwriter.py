@@ -0,0 +1,291 @@
+import os
+import threading
+import time
+from collections import deque
+
+# Write-behind stage between the network and the disk. Segment workers queue
+# what they received and go straight back to their sockets; a few writer threads
+# drain the queue, merging back-to-back pieces of a segment into one vectored
+# write. A full queue makes the workers wait, so a slow disk (network share,
+# antivirus scan) throttles the reads gradually instead of freezing them inside
+# a write call.
+
+# 'none': the OS decides when data reaches the disk. 'checkpoint': the part file
+# is fsynced right before each journal fsync, so after a power cut the journal
+# never points past the data. 'always': fsync after every write.
+SYNC_POLICIES = ('none', 'checkpoint', 'always')
+
+MAX_PIECES = 64 # Per vectored write, well below IOV_MAX
+
+
+class WriteFailed(OSError):
+    pass
+
+
+def settle(future):
+    # On the future's own loop; it may have been given up on meanwhile
+    if not future.done():
+        future.set_result(None)
+
+
+class Lane:
+    # Writes of one segment, in order: a piece that is re-fetched (bad hash,
+    # server restart) always lands after the copy it replaces
+    __slots__ = ('owner', 'jobs', 'busy')
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.jobs = deque() # (offset, data, block)
+        self.busy = False
+
+
+class OutputFile:
+    # One download's part file, as the writer threads see it
+    def __init__(self, writer, path, sync='none', metrics=None, on_written=None):
+        if sync not in SYNC_POLICIES:
+            raise ValueError(f"Unknown sync policy {sync!r}")
+        self.writer = writer
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        self.sync_policy = sync
+        self.metrics = metrics # DownloadMetrics: write latency
+        self.on_written = on_written # on_written(owner, end) after each write, end = file offset reached
+        self.lanes = {}
+        self.pending = 0 # Bytes queued or being written
+        self.error = None
+        self.closed = False
+        self.seek_lock = threading.Lock() # Only used where there is no pwrite
+
+    def sync(self):
+        # 'checkpoint' policy: called before the journal is fsynced
+        fd = self.fd
+        if self.sync_policy == 'checkpoint' and fd is not None:
+            os.fsync(fd)
+            self.writer.fsyncs += 1
+
+    def close(self, discard=False):
+        # Stops accepting data, then waits for what's queued to be written (or dropped)
+        return self.writer.close(self, discard)
+
+
+class DiskWriter:
+    def __init__(self, threads=2, max_bytes=32 * 1024 * 1024, max_write=8 * 1024 * 1024):
+        self.thread_count = threads
+        self.max_bytes = max_bytes # Queue depth at which segments have to wait
+        self.max_write = max_write # Largest merged write
+        self.cond = threading.Condition()
+        self.ready = deque() # (output, lane) with queued writes and no thread on them
+        self.slots = [] # (loop, future) of coroutines waiting for room in the queue
+        self.drains = [] # (loop, future, lane) of coroutines waiting for a segment's writes
+        self.threads = []
+        self.queued = 0
+        self.peak = 0
+        self.waits = 0 # Times a segment had to wait for room in the queue
+        self.writes = 0
+        self.pieces = 0 # pieces / writes = how much got merged
+        self.written = 0
+        self.fsyncs = 0
+
+    def open(self, path, sync='none', metrics=None, on_written=None):
+        return OutputFile(self, path, sync, metrics, on_written)
+
+    def full(self):
+        return self.queued >= self.max_bytes
+
+    def room(self, loop):
+        # For the event loop: a future on loop that is done once the queue has room
+        # (right away if it has). Writer threads complete it when they drain the queue.
+        future = loop.create_future()
+        with self.cond:
+            if self.queued < self.max_bytes:
+                future.set_result(None)
+            else:
+                self.waits += 1
+                self.slots.append((loop, future))
+        return future
+
+    def drained(self, loop, output, owner):
+        # drain() for the event loop: a future on loop that is done once everything
+        # queued for one segment has been written
+        future = loop.create_future()
+        lane = output.lanes.get(id(owner))
+        with self.cond:
+            if lane is None or (not lane.jobs and not lane.busy):
+                future.set_result(None)
+            else:
+                self.drains.append((loop, future, lane))
+        return future
+
+    def wake(self):
+        # Caller holds self.cond. Completes the futures of room() and drained() that are due.
+        due = []
+        if self.slots and self.queued < self.max_bytes:
+            due, self.slots = self.slots, []
+        if self.drains:
+            waiting = []
+            for loop, future, lane in self.drains:
+                if lane.jobs or lane.busy:
+                    waiting.append((loop, future, lane))
+                else:
+                    due.append((loop, future))
+            self.drains = waiting
+        for loop, future in due:
+            try:
+                loop.call_soon_threadsafe(settle, future)
+            except RuntimeError:
+                pass # Loop already closed
+
+    def submit(self, output, owner, offset, data, block=None, wait=True):
+        # Takes over data (and its pooled block). wait=False never blocks, for the
+        # event loop, which waits for room itself; the queue may overshoot by a read.
+        if block is not None:
+            block.queued = True
+        size = len(data)
+        with self.cond:
+            if wait and self.queued >= self.max_bytes and not output.closed:
+                self.waits += 1
+                self.cond.wait_for(lambda: self.queued < self.max_bytes or output.closed or output.error)
+            if output.error is not None or output.closed or not size:
+                if block is not None:
+                    block.release()
+                if output.error is not None:
+                    raise WriteFailed(f"Could not write {output.path}: {output.error}")
+                return
+            lane = output.lanes.get(id(owner))
+            if lane is None:
+                lane = output.lanes[id(owner)] = Lane(owner)
+            lane.jobs.append((offset, data, block))
+            if not lane.busy and len(lane.jobs) == 1:
+                self.ready.append((output, lane))
+                self.cond.notify()
+            output.pending += size
+            self.queued += size
+            self.peak = max(self.peak, self.queued)
+            if len(self.threads) < self.thread_count:
+                t = threading.Thread(target=self.run, daemon=True)
+                self.threads.append(t)
+                t.start()
+
+    def drain(self, output, owner):
+        # Waits until everything queued for one segment has been written
+        lane = output.lanes.get(id(owner))
+        if lane is None:
+            return
+        with self.cond:
+            self.cond.wait_for(lambda: not lane.jobs and not lane.busy)
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.ready)
+                output, lane = self.ready.popleft()
+                batch = self.take(lane)
+                lane.busy = True
+            offset = batch[0][0]
+            pieces = [data for _, data, _ in batch]
+            size = sum(len(p) for p in pieces)
+            if output.error is None:
+                started = time.perf_counter()
+                try:
+                    self.write(output, offset, pieces)
+                    if output.sync_policy == 'always':
+                        os.fsync(output.fd)
+                        self.fsyncs += 1
+                except OSError as e:
+                    output.error = e
+                else:
+                    if output.metrics is not None:
+                        output.metrics.record_write(size, time.perf_counter() - started)
+                    if output.on_written is not None:
+                        try:
+                            output.on_written(lane.owner, offset + size)
+                        except Exception as e:
+                            # Bookkeeping only; the writer thread has to survive it
+                            print(f"Warning: write callback failed: {e}")
+            for _, _, block in batch:
+                if block is not None:
+                    block.release()
+            with self.cond:
+                lane.busy = False
+                if lane.jobs:
+                    self.ready.append((output, lane))
+                output.pending -= size
+                self.queued -= size
+                self.writes += 1
+                self.pieces += len(batch)
+                self.written += size
+                self.cond.notify_all()
+                self.wake()
+
+    def take(self, lane):
+        # Caller holds self.cond. Everything queued back to back, up to max_write
+        batch = [lane.jobs.popleft()]
+        end = batch[0][0] + len(batch[0][1])
+        size = len(batch[0][1])
+        while lane.jobs and len(batch) < MAX_PIECES:
+            offset, data, _ = lane.jobs[0]
+            if offset != end or size + len(data) > self.max_write:
+                break
+            batch.append(lane.jobs.popleft())
+            end += len(data)
+            size += len(data)
+        return batch
+
+    def write(self, output, offset, pieces):
+        pieces = [memoryview(p) for p in pieces]
+        if hasattr(os, 'pwritev'):
+            while pieces:
+                n = os.pwritev(output.fd, pieces, offset)
+                offset += n
+                # Short write: drop what made it and go again with the rest
+                while n:
+                    if n >= len(pieces[0]):
+                        n -= len(pieces.pop(0))
+                    else:
+                        pieces[0] = pieces[0][n:]
+                        n = 0
+        elif hasattr(os, 'pwrite'):
+            for p in pieces:
+                while p:
+                    n = os.pwrite(output.fd, p, offset)
+                    p, offset = p[n:], offset + n
+        else:
+            # Windows: the file position is shared, so seek and write together
+            with output.seek_lock:
+                os.lseek(output.fd, offset, os.SEEK_SET)
+                for p in pieces:
+                    while p:
+                        p = p[os.write(output.fd, p):]
+
+    def close(self, output, discard=False):
+        # Returns the write error, if any
+        with self.cond:
+            output.closed = True
+            if discard:
+                for lane in output.lanes.values():
+                    while lane.jobs:
+                        _, data, block = lane.jobs.popleft()
+                        output.pending -= len(data)
+                        self.queued -= len(data)
+                        if block is not None:
+                            block.release()
+                self.ready = deque(item for item in self.ready if item[0] is not output)
+                self.cond.notify_all()
+                self.wake()
+            self.cond.wait_for(lambda: output.pending <= 0)
+            fd, output.fd = output.fd, None
+        if fd is not None:
+            try:
+                if output.sync_policy != 'none' and output.error is None and not discard:
+                    os.fsync(fd)
+            except OSError as e:
+                output.error = e
+            finally:
+                os.close(fd)
+        return output.error
+
+    def stats(self):
+        with self.cond:
+            return {'threads': len(self.threads), 'queued': self.queued, 'capacity': self.max_bytes, 'peak': self.peak,
+                    'waits': self.waits, 'writes': self.writes, 'pieces': self.pieces, 'bytes': self.written,
+                    'fsyncs': self.fsyncs}
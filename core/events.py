@@ -0,0 +1,33 @@
+import threading
+import time
+from collections import deque
+
+# Numbered event log behind the API's SSE stream and long-poll. Readers keep the
+# last seq they saw and ask for everything after it, so a reconnecting client
+# picks up where it left off (as long as it's still in the ring buffer).
+
+
+class EventLog:
+    def __init__(self, maxlen=10000):
+        self.events = deque(maxlen=maxlen)
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def publish(self, kind, **data):
+        with self.cond:
+            self.seq += 1
+            data.update({'seq': self.seq, 'type': kind, 'time': time.time()})
+            self.events.append(data)
+            self.cond.notify_all()
+
+    def since(self, seq, timeout=None):
+        # Events newer than seq; with a timeout, blocks until there is at least one
+        with self.cond:
+            if timeout and self.seq <= seq:
+                self.cond.wait_for(lambda: self.seq > seq, timeout)
+            if not self.events or self.seq <= seq:
+                return []
+            # seqs in the buffer are contiguous, so slice instead of scanning
+            first = self.events[0]['seq']
+            skip = max(0, seq + 1 - first)
+            return [self.events[i] for i in range(skip, len(self.events))]
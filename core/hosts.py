@@ -0,0 +1,68 @@
+import threading
+
+from core.ratelimit import TokenBucket
+from core.retry import CircuitBreaker
+
+# Per-host bookkeeping shared by every download: a hard connection cap that
+# applies across downloads, error counters the AIMD controller reads, and a
+# circuit breaker that stops new requests while the host is down.
+
+
+class HostState:
+    def __init__(self, host, max_connections):
+        self.host = host
+        self.max_connections = max_connections
+        self.connections = 0
+        self.errors = {'throttle': 0, 'reset': 0, 'other': 0}
+        self.warmed = 0 # Connections opened ahead of the segments that used them
+        self.limiter = TokenBucket() # Per-host bandwidth cap, unlimited by default
+        self.breaker = CircuitBreaker()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.connections >= self.max_connections:
+                return False
+            self.connections += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.connections = max(0, self.connections - 1)
+
+    def record_error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def record_warmed(self, n):
+        with self.lock:
+            self.warmed += n
+
+    def congestion_events(self):
+        # Throttling and resets are what AIMD backs off on; other errors aren't load related
+        return self.errors['throttle'] + self.errors['reset']
+
+
+class HostRegistry:
+    def __init__(self, default_max_connections=64):
+        self.default_max_connections = default_max_connections
+        self.hosts = {}
+        self.caps = {}
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = HostState(host, self.caps.get(host, self.default_max_connections))
+                self.hosts[host] = state
+            return state
+
+    def set_speed_limit(self, host, rate):
+        self.get(host).limiter.set_rate(rate)
+
+    def set_cap(self, host, max_connections):
+        with self.lock:
+            self.caps[host] = max_connections
+            if host in self.hosts:
+                self.hosts[host].max_connections = max_connections
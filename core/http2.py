@@ -0,0 +1,427 @@
+import select
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit, urljoin
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+# HTTP/2 transport: every segment of a download runs as a stream over a handful
+# of shared connections instead of one TCP+TLS connection per segment. Built on
+# the h2 state machine (optional dependency, pip install h2); https negotiates it
+# with ALPN, plain http needs prior knowledge (h2c).
+#
+# Flow control: each stream gets a receive window large enough to keep a 1 MB read
+# in flight, the connection window covers all of them. Received data is only
+# acknowledged once the segment worker has consumed it, so a slow disk or a rate
+# limit pushes back on the server instead of piling up in memory.
+
+
+class HTTP2Error(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class HTTP2Unavailable(Exception):
+    # The server (or this install) doesn't do HTTP/2; use HTTP/1.1 instead
+    pass
+
+
+class H2Stream:
+    def __init__(self, conn, stream_id):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.cond = threading.Condition()
+        self.status = None
+        self.headers = {}
+        self.chunks = deque() # (data, flow controlled length)
+        self.buffered = 0
+        self.ended = False
+        self.error = None
+        self.waiters = [] # (loop, future) of async readers
+
+    def notify(self):
+        # Caller holds self.cond
+        self.cond.notify_all()
+        for loop, fut in self.waiters:
+            loop.call_soon_threadsafe(_wake, fut)
+        self.waiters = []
+
+    def ready(self, want):
+        if self.error is not None:
+            raise self.error
+        if want is None:
+            return self.status is not None
+        return self.buffered >= want or self.ended
+
+    def take(self, max_bytes):
+        # Caller holds self.cond. Whole frames only, so the ack matches what the server counted.
+        parts, size, flow = [], 0, 0
+        while self.chunks and (not parts or size < max_bytes):
+            data, n = self.chunks.popleft()
+            parts.append(data)
+            size += len(data)
+            flow += n
+        self.buffered -= size
+        return b''.join(parts), flow
+
+    def wait(self, want, timeout):
+        # Block until headers (want=None) or want bytes / end of stream are here
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.ready(want), timeout):
+                raise TimeoutError(f"HTTP/2 stream {self.stream_id} timed out")
+
+    async def wait_async(self, want, timeout):
+        import asyncio # Only the async engine gets here; keeps it off the startup path
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.cond:
+                if self.ready(want):
+                    return
+                fut = asyncio.get_running_loop().create_future()
+                self.waiters.append((asyncio.get_running_loop(), fut))
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TimeoutError(f"HTTP/2 stream {self.stream_id} timed out")
+            try:
+                await asyncio.wait_for(fut, left)
+            except asyncio.TimeoutError:
+                pass
+
+    def read(self, chunk_size):
+        with self.cond:
+            data, flow = self.take(chunk_size)
+        self.conn.consumed(self.stream_id, flow)
+        return data
+
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+class H2Connection:
+    def __init__(self, client, key, sock):
+        self.client = client
+        self.key = key
+        self.sock = sock
+        self.lock = threading.Lock() # h2 state and socket writes
+        self.streams = {}
+        self.closed = False
+        config = h2.config.H2Configuration(client_side=True, header_encoding='utf-8')
+        self.h2 = h2.connection.H2Connection(config=config)
+        with self.lock:
+            self.h2.initiate_connection()
+            self.h2.update_settings({
+                h2.settings.SettingCodes.ENABLE_PUSH: 0,
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: client.stream_window,
+                h2.settings.SettingCodes.MAX_FRAME_SIZE: client.max_frame_size,
+            })
+            # The connection window starts at 64 KB like every stream's; open it up once
+            self.h2.increment_flow_control_window(client.connection_window - 65535)
+            self.flush()
+        threading.Thread(target=self.reader, daemon=True).start()
+
+    def has_capacity(self):
+        limit = min(self.client.max_streams, self.h2.remote_settings.max_concurrent_streams)
+        return not self.closed and len(self.streams) < limit
+
+    def send(self, data):
+        # Caller holds self.lock; the socket is non-blocking so the reader never stalls a writer
+        view = memoryview(data)
+        while view:
+            try:
+                n = self.sock.send(view)
+                view = view[n:]
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                select.select([], [self.sock], [], 1.0)
+
+    def flush(self):
+        data = self.h2.data_to_send()
+        if data:
+            self.send(data)
+
+    def open_stream(self, parts, headers):
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request = [(':method', 'GET'), (':scheme', parts.scheme), (':authority', parts.netloc), (':path', path)]
+        request += [(k.lower(), v) for k, v in headers.items() if k.lower() not in ('host', 'connection')]
+        with self.lock:
+            if self.closed:
+                raise ConnectionResetError("HTTP/2 connection closed")
+            stream_id = self.h2.get_next_available_stream_id()
+            stream = H2Stream(self, stream_id)
+            self.streams[stream_id] = stream
+            self.h2.send_headers(stream_id, request, end_stream=True)
+            self.flush()
+        return stream
+
+    def consumed(self, stream_id, n):
+        # Give the window back once the data has actually been used
+        if not n:
+            return
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.h2.acknowledge_received_data(n, stream_id)
+                self.flush()
+            except (h2.exceptions.ProtocolError, OSError):
+                pass
+
+    def close_stream(self, stream):
+        with self.lock:
+            if self.streams.pop(stream.stream_id, None) is None or self.closed:
+                return
+            if not stream.ended:
+                try:
+                    self.h2.reset_stream(stream.stream_id, h2.errors.ErrorCodes.CANCEL)
+                    self.flush()
+                except (h2.exceptions.ProtocolError, OSError):
+                    pass
+
+    def reader(self):
+        try:
+            while not self.closed:
+                # SSL may already hold decrypted bytes the socket won't signal for
+                pending = isinstance(self.sock, ssl.SSLSocket) and self.sock.pending()
+                if not pending and not select.select([self.sock], [], [], 1.0)[0]:
+                    continue
+                with self.lock:
+                    try:
+                        data = self.sock.recv(262144)
+                    except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                        continue
+                    if not data:
+                        raise ConnectionResetError("HTTP/2 connection closed by server")
+                    events = self.h2.receive_data(data)
+                    for event in events:
+                        self.dispatch(event)
+                    self.flush()
+        except Exception as e:
+            self.fail(e if isinstance(e, ConnectionError) else ConnectionResetError(f"HTTP/2 connection lost: {e}"))
+
+    def dispatch(self, event):
+        # Caller holds self.lock
+        if isinstance(event, h2.events.ConnectionTerminated):
+            raise ConnectionResetError(f"HTTP/2 connection terminated ({event.error_code})")
+        stream = self.streams.get(getattr(event, 'stream_id', None))
+        if stream is None:
+            if isinstance(event, h2.events.DataReceived):
+                # Late data for a stream we already dropped still counts against the connection window
+                self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            return
+        with stream.cond:
+            if isinstance(event, h2.events.ResponseReceived):
+                headers = dict(event.headers)
+                stream.status = int(headers.pop(':status'))
+                stream.headers = headers
+            elif isinstance(event, h2.events.DataReceived):
+                stream.chunks.append((event.data, event.flow_controlled_length))
+                stream.buffered += len(event.data)
+            elif isinstance(event, h2.events.StreamEnded):
+                stream.ended = True
+            elif isinstance(event, h2.events.StreamReset):
+                stream.error = ConnectionResetError(f"HTTP/2 stream reset by server ({event.error_code})")
+            else:
+                return
+            stream.notify()
+
+    def fail(self, error):
+        with self.lock:
+            self.closed = True
+            streams = list(self.streams.values())
+            self.streams.clear()
+        self.client.forget(self)
+        for stream in streams:
+            with stream.cond:
+                stream.error = error
+                stream.notify()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class HTTP2Response:
+    def __init__(self, stream, url):
+        self.stream = stream
+        self.url = url
+        self.status_code = self.status = stream.status
+        self.headers = stream.headers
+        self.timeout = None
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTP2Error(f"Status {self.status_code}", self.status_code)
+
+    def iter_content(self, chunk_size=1024 * 1024):
+        # Like requests: full chunk_size reads until the body runs out
+        stream = self.stream
+        while True:
+            stream.wait(chunk_size, self.timeout)
+            data = stream.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    async def iter_chunks(self, chunk_size, timeout=15):
+        stream = self.stream
+        while True:
+            await stream.wait_async(chunk_size, timeout)
+            data = stream.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    def abort(self):
+        # From another thread: fail the pending read and cancel the stream
+        with self.stream.cond:
+            self.stream.error = ConnectionResetError("HTTP/2 stream abandoned")
+            self.stream.notify()
+        self.close()
+
+    def close(self):
+        self.stream.conn.close_stream(self.stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HTTP2Client:
+    available = h2 is not None
+
+    def __init__(self, max_streams=100, stream_window=4 * 1024 * 1024, connection_window=64 * 1024 * 1024,
+                 max_frame_size=1024 * 1024):
+        self.max_streams = max_streams
+        self.stream_window = stream_window
+        self.connection_window = connection_window
+        self.max_frame_size = max_frame_size
+        self.lock = threading.Lock() # Guards conns and connecting, never held over network I/O
+        self.conns = {}
+        self.connecting = {} # key -> Lock held while a connection to that host is being opened
+        self.http1_only = set() # Hosts whose ALPN said no
+        self.requests_sent = 0
+        self.connections_opened = 0
+
+    def key(self, url):
+        parts = urlsplit(url)
+        return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+    def connect(self, key, timeout):
+        scheme, host, port = key
+        sock = socket.create_connection((host, port), timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if scheme == 'https':
+            context = ssl.create_default_context()
+            context.set_alpn_protocols(['h2', 'http/1.1'])
+            sock = context.wrap_socket(sock, server_hostname=host)
+            if sock.selected_alpn_protocol() != 'h2':
+                sock.close()
+                self.http1_only.add(key)
+                raise HTTP2Unavailable(f"{host} did not negotiate h2")
+        sock.setblocking(False)
+        return H2Connection(self, key, sock)
+
+    def connection(self, key, timeout):
+        if not self.available:
+            raise HTTP2Unavailable("the h2 package is not installed")
+        if key in self.http1_only:
+            raise HTTP2Unavailable(f"{key[1]} did not negotiate h2")
+        with self.lock:
+            conn = self.pooled(key)
+            if conn is not None:
+                return conn
+            connecting = self.connecting.setdefault(key, threading.Lock())
+        # One connect per host at a time, so a burst of new segments lands on the same
+        # connection instead of each opening its own; other hosts aren't held up by it
+        with connecting:
+            if key in self.http1_only:
+                raise HTTP2Unavailable(f"{key[1]} did not negotiate h2")
+            with self.lock:
+                conn = self.pooled(key)
+                if conn is not None:
+                    return conn
+            conn = self.connect(key, timeout)
+            with self.lock:
+                self.conns.setdefault(key, []).append(conn)
+                self.connections_opened += 1
+            return conn
+
+    def pooled(self, key):
+        # Caller holds self.lock
+        for conn in self.conns.get(key, []):
+            if conn.has_capacity():
+                return conn
+        return None
+
+    def forget(self, conn):
+        with self.lock:
+            pool = self.conns.get(conn.key, [])
+            if conn in pool:
+                pool.remove(conn)
+
+    def supports(self, url, timeout=5):
+        # ALPN check; the connection stays pooled for the segments that follow
+        try:
+            self.connection(self.key(url), timeout)
+            return True
+        except (HTTP2Unavailable, OSError):
+            return False
+
+    def request(self, url, headers, timeout):
+        parts = urlsplit(url)
+        conn = self.connection(self.key(url), timeout)
+        self.requests_sent += 1
+        return conn.open_stream(parts, headers)
+
+    def get(self, url, headers=None, timeout=15, stream=True, max_redirects=5):
+        # requests-compatible enough for Downloader.download_chunk
+        for _ in range(max_redirects + 1):
+            s = self.request(url, headers or {}, timeout)
+            try:
+                s.wait(None, timeout)
+            except Exception:
+                s.conn.close_stream(s)
+                raise
+            location = s.headers.get('location')
+            if s.status in (301, 302, 303, 307, 308) and location:
+                s.conn.close_stream(s)
+                url = urljoin(url, location)
+                continue
+            resp = HTTP2Response(s, url)
+            resp.timeout = timeout
+            return resp
+        raise HTTP2Error("Too many redirects")
+
+    async def aget(self, url, headers=None, timeout=15, max_redirects=5):
+        # Same for the async engine; only a brand new connection blocks, and that's in an executor
+        import asyncio
+        loop = asyncio.get_running_loop()
+        for _ in range(max_redirects + 1):
+            s = await loop.run_in_executor(None, self.request, url, headers or {}, timeout)
+            try:
+                await s.wait_async(None, timeout)
+            except BaseException:
+                s.conn.close_stream(s)
+                raise
+            location = s.headers.get('location')
+            if s.status in (301, 302, 303, 307, 308) and location:
+                s.conn.close_stream(s)
+                url = urljoin(url, location)
+                continue
+            return HTTP2Response(s, url)
+        raise HTTP2Error("Too many redirects")
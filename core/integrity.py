@@ -0,0 +1,455 @@
+import ctypes
+import ctypes.util
+import glob
+import hashlib
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+
+# Streaming integrity checks.
+#  - Piece hashes (from Metalink) are computed in memory as data arrives. Segment
+#    boundaries are aligned to the piece length so every piece is fed by exactly one
+#    segment, in order. A bad piece is re-fetched on the spot.
+#  - The whole-file digest is computed in order too: bytes that arrive right at the
+#    hashed frontier are hashed in memory as they are fed, and only ranges that
+#    arrived ahead of it (other segments) are read back from the part file once the
+#    gap before them is filled. With piece hashes it never runs past a piece that
+#    isn't verified yet, and is taken back to the piece start if one fails.
+#  - Its running state goes into the checkpoint, so a resumed download carries on
+#    hashing where it stopped. That takes OpenSSL's low-level hash functions, whose
+#    context is a plain struct. A saved state from another libcrypto version, or one
+#    that doesn't reproduce the digest it was saved with, is dropped, and the digest
+#    is rebuilt by reading back what is on disk; so is one without any libcrypto.
+
+ALGO_NAMES = {
+    'md5': 'md5', 'sha1': 'sha1', 'sha-1': 'sha1', 'sha256': 'sha256', 'sha-256': 'sha256',
+    'sha512': 'sha512', 'sha-512': 'sha512'
+}
+HEX_LENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+SIDECARS = (('.sha256', 'sha256'), ('.sha256sum', 'sha256'), ('.md5', 'md5'))
+METALINKS = ('.meta4', '.metalink')
+READ_SIZE = 8 * 1024 * 1024
+SNAPSHOT_EVERY = 64 * 1024 * 1024 # Hashed bytes between digest states saved in the checkpoint
+
+# algo -> (function prefix, digest size, size of its context struct)
+LOW_LEVEL = {'md5': ('MD5', 16, 92), 'sha1': ('SHA1', 20, 96), 'sha256': ('SHA256', 32, 112), 'sha512': ('SHA512', 64, 216)}
+CTX_ROOM = 512 # Allocated per context, well past any of those structs
+
+_libcrypto = None
+
+
+def crypto_candidates():
+    # The libcrypto next to Python's own _ssl module first (the Windows installer ships
+    # one there, and find_library rarely finds any on Windows), then the system's
+    try:
+        import _ssl
+        yield from sorted(glob.glob(os.path.join(os.path.dirname(_ssl.__file__), 'libcrypto*')), reverse=True)
+    except (ImportError, AttributeError):
+        pass
+    for name in ('crypto', 'libcrypto-3-x64', 'libcrypto-3'):
+        path = ctypes.util.find_library(name)
+        if path:
+            yield path
+
+
+def libcrypto():
+    # Loaded on first use; None where there is none
+    global _libcrypto
+    if _libcrypto is None:
+        _libcrypto = False
+        for path in crypto_candidates():
+            try:
+                lib = ctypes.CDLL(path)
+                version = lib.OpenSSL_version_num
+            except (OSError, AttributeError):
+                continue
+            version.restype = ctypes.c_ulong
+            _libcrypto = (lib, version())
+            break
+    return _libcrypto or None
+
+
+class ResumableHash:
+    # hashlib-style hasher whose running state can be saved and restored. The state is
+    # the raw context struct, so it is only taken back by the same libcrypto version,
+    # and only if it still produces the digest it was saved with.
+    def __init__(self, algo, state=None):
+        lib, self.version = libcrypto()
+        prefix, self.digest_size, self.ctx_size = LOW_LEVEL[algo]
+        self.algo = algo
+        self._init = getattr(lib, prefix + '_Init')
+        self._update = getattr(lib, prefix + '_Update')
+        self._final = getattr(lib, prefix + '_Final')
+        self.ctx = ctypes.create_string_buffer(CTX_ROOM)
+        if state is not None:
+            ctypes.memmove(self.ctx, state, len(state))
+        else:
+            self._init(self.ctx)
+
+    @classmethod
+    def restore(cls, algo, saved):
+        # A hasher from snapshot(), or None if it doesn't belong to this libcrypto
+        crypto = libcrypto()
+        if crypto is None or algo not in LOW_LEVEL or saved.get('algo') != algo or saved.get('lib') != crypto[1]:
+            return None
+        try:
+            state = bytes.fromhex(saved['state'])
+            if len(state) != LOW_LEVEL[algo][2]:
+                return None
+            hasher = cls(algo, state)
+            return hasher if hasher.hexdigest() == saved['check'] else None
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None
+
+    def snapshot(self, upto):
+        return {'algo': self.algo, 'upto': upto, 'lib': self.version, 'state': self.state().hex(), 'check': self.hexdigest()}
+
+    def update(self, data):
+        if not isinstance(data, bytes):
+            view = memoryview(data)
+            data = view.tobytes() if view.readonly else (ctypes.c_char * view.nbytes).from_buffer(view)
+        self._update(self.ctx, data, ctypes.c_size_t(len(data)))
+
+    def state(self):
+        return self.ctx.raw[:self.ctx_size]
+
+    def copy(self):
+        return ResumableHash(self.algo, self.state())
+
+    def hexdigest(self):
+        # Final destroys the context, so finish a copy
+        ctx = ctypes.create_string_buffer(self.ctx.raw, CTX_ROOM)
+        out = ctypes.create_string_buffer(self.digest_size)
+        self._final(out, ctx)
+        return out.raw.hex()
+
+
+def new_hasher(algo):
+    # A ResumableHash where libcrypto has one for algo, else plain hashlib
+    crypto = libcrypto()
+    if crypto is not None and algo in LOW_LEVEL and hasattr(crypto[0], LOW_LEVEL[algo][0] + '_Init'):
+        return ResumableHash(algo)
+    return hashlib.new(algo)
+
+
+class PieceMismatch(Exception):
+    def __init__(self, index, start):
+        super().__init__(f"Piece {index} failed verification")
+        self.index = index
+        self.start = start
+        self.offset = None # Where the segment was; set by whoever rolls it back
+
+
+class IntegrityError(Exception):
+    pass
+
+
+def parse_checksum(value):
+    # "sha256:abcd...", "md5=...", or a bare hex digest (algorithm from its length)
+    if not value:
+        return None
+    algo, sep, digest = value.replace('=', ':').partition(':')
+    if not sep:
+        algo, digest = HEX_LENGTHS.get(len(value.strip())), value
+    algo = ALGO_NAMES.get(algo.lower()) if algo else None
+    digest = digest.strip().lower()
+    if not algo or not re.fullmatch(r'[0-9a-f]+', digest):
+        return None
+    return algo, digest
+
+
+def parse_sidecar(text, algo, filename):
+    # Handles "<hex>  name", "<hex> *name", "ALGO (name) = <hex>" and bare "<hex>"
+    size = hashlib.new(algo).digest_size * 2
+    fallback = None
+    for line in text.splitlines():
+        m = re.search(r'\b([0-9a-fA-F]{%d})\b' % size, line)
+        if not m:
+            continue
+        if filename and filename in line:
+            return m.group(1).lower()
+        fallback = fallback or m.group(1).lower()
+    return fallback
+
+
+def parse_metalink(text, filename):
+    # Metalink 4 (RFC 5854) and 3.0; namespaces are ignored
+    root = ET.fromstring(text)
+    def local(el):
+        return el.tag.rsplit('}', 1)[-1]
+    files = [el for el in root.iter() if local(el) == 'file']
+    if not files:
+        return None
+    entry = next((f for f in files if f.get('name') == filename), files[0])
+
+    info = {'urls': []}
+    for el in entry.iter():
+        tag = local(el)
+        if tag == 'hash' and el.get('type') and 'algo' not in info:
+            algo = ALGO_NAMES.get(el.get('type').lower())
+            if algo and el.text:
+                info['algo'], info['digest'] = algo, el.text.strip().lower()
+        elif tag == 'pieces':
+            algo = ALGO_NAMES.get((el.get('type') or '').lower())
+            hashes = [h.text.strip().lower() for h in el if local(h) == 'hash' and h.text]
+            if algo and hashes:
+                info['piece_algo'] = algo
+                info['piece_length'] = int(el.get('length'))
+                info['pieces'] = hashes
+        elif tag == 'url' and el.text:
+            info['urls'].append(el.text.strip())
+    return info
+
+
+def discover_checksum(session, url, filename, headers=None, timeout=5):
+    # Look for a Metalink first (it may carry piece hashes), then plain digest sidecars
+    base = url.split('?', 1)[0].split('#', 1)[0]
+    for suffix in METALINKS:
+        try:
+            r = session.get(base + suffix, headers=headers, timeout=timeout)
+            if r.status_code == 200 and len(r.content) < 16 * 1024 * 1024:
+                info = parse_metalink(r.content, filename)
+                if info and ('digest' in info or 'pieces' in info):
+                    return info
+        except Exception:
+            pass
+    for suffix, algo in SIDECARS:
+        try:
+            r = session.get(base + suffix, headers=headers, timeout=timeout)
+            if r.status_code == 200 and len(r.content) < 1024 * 1024:
+                digest = parse_sidecar(r.text, algo, filename)
+                if digest:
+                    return {'algo': algo, 'digest': digest}
+        except Exception:
+            pass
+    return None
+
+
+class Verifier:
+    def __init__(self, part_file, state_dir, file_size, info, saved=None):
+        self.part_file = part_file
+        self.store_file = os.path.join(state_dir, "pieces.bin")
+        self.file_size = file_size
+        self.algo = info.get('algo')
+        self.digest = info.get('digest')
+        self.piece_algo = info.get('piece_algo')
+        self.piece_length = info.get('piece_length') or 0
+        self.expected = info.get('pieces')
+        if self.expected and self.file_size and len(self.expected) != -(-self.file_size // self.piece_length):
+            # Piece list doesn't describe this file; fall back to the whole-file digest
+            self.expected = None
+        self.lock = threading.Lock()
+
+        # Running piece hashers: piece index -> [hasher, bytes fed]
+        self.active = {}
+        self.failures = {}
+        self.verified = None
+        self.store = None
+        if self.expected:
+            self.verified = bytearray(len(self.expected))
+
+        # In-order whole-file digest over the verified prefix
+        self.file_hasher = new_hasher(self.algo) if self.algo else None
+        self.hashed_upto = 0
+        self.digest_lock = threading.Lock()
+        self.saved = saved # Digest state from the checkpoint, used by open() unless the file is new
+        self.mark = None # (offset, hasher copy) at the start of the piece being hashed
+        self.snapshot = None # Last digest state handed to the checkpoint
+        self.read_back = 0 # Bytes the whole-file digest had to read from disk
+
+    @property
+    def align(self):
+        return self.piece_length if self.expected else 1
+
+    def open(self, fresh):
+        # One byte per piece: set once that piece verified. Survives restarts so
+        # resumed downloads don't re-hash completed pieces. fresh=True means the
+        # output file was recreated and any old verdicts are meaningless.
+        saved, self.saved = self.saved, None
+        if not fresh and saved and self.file_hasher is not None:
+            hasher = ResumableHash.restore(self.algo, saved)
+            if hasher is not None:
+                self.file_hasher = hasher
+                self.hashed_upto = saved['upto']
+                self.snapshot = saved
+        if not self.expected:
+            return
+        path = self.store_file
+        if not fresh and os.path.exists(path) and os.path.getsize(path) == len(self.verified):
+            with open(path, 'rb') as f:
+                self.verified[:] = f.read()
+            self.store = open(path, 'r+b')
+        else:
+            self.store = open(path, 'w+b')
+            self.store.write(bytes(len(self.verified)))
+            self.store.flush()
+
+    def piece_range(self, index):
+        start = index * self.piece_length
+        return start, min(start + self.piece_length, self.file_size) - 1
+
+    def feed(self, offset, data):
+        # Called by the segment that owns these bytes, before they are written
+        if self.expected:
+            self.feed_pieces(offset, data)
+        if self.file_hasher is not None and offset <= self.hashed_upto < offset + len(data):
+            with self.digest_lock:
+                skip = self.hashed_upto - offset
+                if 0 <= skip < len(data):
+                    self.hash_in_order(memoryview(data)[skip:])
+
+    def hash_in_order(self, view):
+        # Caller holds digest_lock; view starts at hashed_upto
+        while view:
+            take = len(view)
+            if self.expected:
+                # Remember the state at every piece start, to take a failed piece back out
+                into = self.hashed_upto % self.piece_length
+                if into == 0:
+                    self.mark = (self.hashed_upto, self.file_hasher.copy())
+                take = min(take, self.piece_length - into)
+            self.file_hasher.update(view[:take])
+            self.hashed_upto += take
+            view = view[take:]
+
+    def unhash(self, start):
+        # A piece from start failed: the digest goes back to where that piece began
+        with self.digest_lock:
+            if self.hashed_upto > start and self.mark is not None and self.mark[0] == start:
+                self.file_hasher = self.mark[1].copy()
+                self.hashed_upto = start
+
+    def feed_pieces(self, offset, data):
+        view = memoryview(data)
+        while view:
+            index = offset // self.piece_length
+            start, end = self.piece_range(index)
+            take = min(len(view), end - offset + 1)
+            state = self.active.get(index)
+            if state is None or start + state[1] != offset:
+                if offset != start:
+                    # Resumed mid-piece without priming; can't verify, re-fetch the piece
+                    self.unhash(start)
+                    raise PieceMismatch(index, start)
+                state = self.active[index] = [hashlib.new(self.piece_algo), 0]
+            state[0].update(view[:take])
+            state[1] += take
+            offset += take
+            view = view[take:]
+            if start + state[1] > end:
+                del self.active[index]
+                self.check_piece(index, state[0].hexdigest())
+
+    def check_piece(self, index, digest):
+        if digest == self.expected[index]:
+            self.mark_verified(index)
+            return
+        start = self.piece_range(index)[0]
+        with self.lock:
+            self.failures[index] = self.failures.get(index, 0) + 1
+            if self.failures[index] > 3:
+                raise IntegrityError(f"Piece {index} failed verification {self.failures[index]} times")
+        self.unhash(start)
+        raise PieceMismatch(index, start)
+
+    def mark_verified(self, index):
+        with self.lock:
+            self.verified[index] = 1
+            self.store.seek(index)
+            self.store.write(b'\x01')
+            self.store.flush()
+
+    def prime(self, seg_start, pos):
+        # Resume: hash only what a segment needs from disk. That's pieces it finished
+        # whose verdict was lost in a crash, plus the partial piece it resumes in.
+        if not self.expected or pos <= seg_start:
+            return
+        with open(self.part_file, 'rb') as f:
+            index = seg_start // self.piece_length
+            while True:
+                start, end = self.piece_range(index)
+                if start >= pos:
+                    break
+                if end < pos and self.verified[index]:
+                    index += 1
+                    continue
+                hasher = hashlib.new(self.piece_algo)
+                f.seek(start)
+                hasher.update(f.read(min(end + 1, pos) - start))
+                if end < pos:
+                    if hasher.hexdigest() == self.expected[index]:
+                        self.mark_verified(index)
+                    else:
+                        # Finished piece is bad: caller rewinds the segment to here
+                        return start
+                else:
+                    self.active[index] = [hasher, pos - start]
+                index += 1
+        return None
+
+    def verified_prefix(self, frontier):
+        # The in-order digest may only consume bytes that can no longer be re-fetched
+        if not self.expected:
+            return frontier
+        index = self.hashed_upto // self.piece_length
+        while index < len(self.verified) and self.verified[index]:
+            index += 1
+        return min(frontier, index * self.piece_length)
+
+    def advance(self, frontier, limit=None):
+        # Reads back what arrived ahead of the hashed frontier, up to the contiguous written
+        # frontier. The lock is only held per read, so feed() doesn't wait on the disk long.
+        if self.file_hasher is None:
+            return
+        done = 0
+        with open(self.part_file, 'rb') as f:
+            while limit is None or done < limit:
+                with self.digest_lock:
+                    target = self.verified_prefix(frontier)
+                    if target <= self.hashed_upto:
+                        return
+                    f.seek(self.hashed_upto)
+                    data = f.read(min(READ_SIZE, target - self.hashed_upto))
+                    if not data:
+                        return
+                    self.hash_in_order(memoryview(data))
+                    self.read_back += len(data)
+                    done += len(data)
+
+    def checkpoint(self, force=False):
+        # Digest state for the checkpoint: refreshed every SNAPSHOT_EVERY bytes (or when
+        # forced), so state.json isn't rewritten on every tick. None if it can't be resumed.
+        if not isinstance(self.file_hasher, ResumableHash):
+            return None
+        with self.digest_lock:
+            if self.expected:
+                # Only a piece boundary is safe: the piece after it may still fail
+                if self.mark is None:
+                    return self.snapshot
+                upto, hasher = self.mark
+            else:
+                upto, hasher = self.hashed_upto, self.file_hasher
+            last = self.snapshot['upto'] if self.snapshot else 0
+            if upto > last and (force or upto - last >= SNAPSHOT_EVERY):
+                self.snapshot = hasher.snapshot(upto)
+            return self.snapshot
+
+    def finish(self, size):
+        # Hash the remaining tail and compare. Returns True if everything checks out.
+        if self.expected and not all(self.verified):
+            return False
+        if self.file_hasher is None:
+            return True
+        self.advance(size)
+        # No expected digest: only hashing for someone else (the content cache)
+        return self.hashed_upto == size and (self.digest is None or self.file_hasher.hexdigest() == self.digest)
+
+    def hexdigest(self):
+        # Whole-file digest once finish() has hashed everything
+        return self.file_hasher.hexdigest() if self.file_hasher is not None else None
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
@@ -0,0 +1,428 @@
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+from core.downloader import Downloader
+from core.events import EventLog
+from core.metrics import render_prometheus
+from core.store import Record, normalize_url
+
+# Statuses that still hold an active slot
+ACTIVE_STATUSES = ("starting", "downloading", "restarting", "verifying", "finalizing")
+# A capture of a URL with a download in one of these is a duplicate; cancelled and failed ones may be added again
+DEDUP_STATUSES = ("queued", "paused", "completed") + ACTIVE_STATUSES
+
+
+class DownloadManager:
+    # Owns every Downloader: a bounded number run at once, the rest wait in a queue
+    # (highest priority first, FIFO within a priority), and a global connection cap
+    # is shared out across the active ones.
+    # Pure core, no UI imports, so it runs headless too.
+    # With a DownloadStore the queue and history outlive the process: unfinished
+    # downloads are picked up again on the next start.
+    def __init__(self, max_active=3, max_connections=128, engine="thread", retry=None, sync="none", store=None):
+        self.max_active = max_active
+        self.max_connections = max_connections
+        self.engine = engine
+        self.retry = retry # RetryPolicy for every download, None for the default
+        self.sync = sync # fsync policy for every download's part file
+        self.downloads = {}
+        self.requested_threads = {}
+        self.priorities = {}
+        self.by_url = {} # Normalized URL -> id, live downloads only
+        self.store = store
+        self.closing = False
+        self.queue = deque()
+        self.active = set()
+        self.lock = threading.RLock()
+        self.ids = itertools.count(store.max_id() + 1 if store is not None else 1)
+        # Status changes and progress samples for API clients (SSE / long-poll)
+        self.events = EventLog()
+        self.last_status = {}
+
+        if store is not None:
+            self.restore()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def create(self, url, save_path, threads, options):
+        return Downloader(url, save_path, threads=threads, engine=self.engine, checksum=options.get('checksum'),
+                          verify=options.get('verify', False), mirrors=options.get('mirrors'),
+                          protocol=options.get('protocol') or "auto", retry=self.retry, sync=self.sync)
+
+    def add(self, url, save_path, threads=32, checksum=None, verify=False, priority=0, mirrors=None, protocol="auto"):
+        options = {'checksum': checksum, 'verify': verify, 'mirrors': mirrors, 'protocol': protocol}
+        dl = self.create(url, save_path, threads, options)
+        download_id = self.register(dl, threads, priority, options)
+        self.schedule()
+        return download_id
+
+    def add_many(self, items):
+        # items: dicts with url and save_path, optionally threads/checksum/verify/priority/mirrors/protocol.
+        # One scheduling pass for the whole batch; returns {'id': n} or {'error': msg} per item.
+        results = []
+        for item in items:
+            threads = item.get('threads') or 32
+            options = {k: item.get(k) for k in ('checksum', 'verify', 'mirrors', 'protocol')}
+            try:
+                dl = self.create(item['url'], item['save_path'], threads, options)
+            except Exception as e:
+                results.append({'error': str(e)})
+                continue
+            results.append({'id': self.register(dl, threads, item.get('priority') or 0, options)})
+        self.schedule()
+        return results
+
+    def register(self, dl, threads, priority, options=None, download_id=None, queued=True):
+        # options: how it was asked for, so a restart can recreate it; only new downloads are saved
+        if queued:
+            dl.status = "queued"
+        with self.lock:
+            if download_id is None:
+                download_id = next(self.ids)
+                self.claim_target(dl)
+            self.downloads[download_id] = dl
+            self.requested_threads[download_id] = threads
+            self.priorities[download_id] = priority
+            self.last_status[download_id] = dl.status
+            self.by_url[normalize_url(dl.url)] = download_id
+            if queued:
+                self.enqueue(download_id)
+        if self.store is not None and options is not None:
+            self.store.add(download_id, dl.url, dl.original_save_path, threads=threads, priority=priority, options=options,
+                           path=dl.save_path, file=dl.filename, status=dl.status)
+        self.events.publish('added', id=download_id, url=dl.url, file=dl.filename, priority=priority)
+        return download_id
+
+    def claim_target(self, dl):
+        # Caller holds self.lock. Two live downloads can't share a file: they'd share its
+        # .part file, journal and temp dir too. A clash (e.g. two URLs with the same name
+        # in one batch) gets " (1)", " (2)", ... before the extension.
+        taken = {os.path.normcase(other.save_path) for other in self.downloads.values()
+                 if other.status not in ("completed", "cancelled")}
+        if os.path.normcase(dl.save_path) not in taken:
+            return
+        base, ext = os.path.splitext(dl.filename)
+        folder = os.path.dirname(dl.save_path)
+        n = 1
+        while os.path.normcase(os.path.join(folder, f"{base} ({n}){ext}")) in taken:
+            n += 1
+        dl.rename(f"{base} ({n}){ext}")
+        # Saved with the full name, so a restart recreates it under the same one
+        dl.original_save_path = dl.save_path
+
+    def restore(self):
+        # Unfinished downloads from the last run, under their old ids. Whatever was queued or
+        # running goes back in the queue and resumes from its checkpoint; paused and failed
+        # ones wait for the user.
+        for row in self.store.unfinished():
+            try:
+                dl = self.create(row['url'], row['save_path'], row['threads'], row['options'])
+            except Exception as e:
+                print(f"Could not restore download {row['id']} ({row['url']}): {e}")
+                continue
+            queued = row['status'] not in ("paused", "error")
+            if not queued:
+                dl.status = row['status']
+            # Shown until start() reads the checkpoint
+            dl.file_size, dl.downloaded_size = row['size'], row['downloaded']
+            self.register(dl, row['threads'], row['priority'], download_id=row['id'], queued=queued)
+        self.schedule()
+
+    def record(self, download_id, dl):
+        # Where a download got to, for the store; batched with everything else that changed
+        if self.store is not None and not self.closing:
+            self.store.update(download_id, status=dl.status, size=dl.file_size, downloaded=dl.downloaded_size,
+                              path=dl.save_path, file=dl.filename)
+
+    def find(self, url, statuses=None):
+        # Id of a download of this URL (normalized), running or from the history, optionally
+        # only one in these statuses; None if there's none
+        with self.lock:
+            download_id = self.by_url.get(normalize_url(url))
+            dl = self.downloads.get(download_id)
+            if statuses and (dl is None or dl.status not in statuses):
+                download_id = None
+        if download_id is None and self.store is not None:
+            row = self.store.find(url, statuses)
+            if row is not None:
+                download_id = row['id']
+        return download_id
+
+    def history(self, statuses=("completed",)):
+        # (id, Record) for stored downloads that aren't loaded in this session
+        if self.store is None:
+            return []
+        _, rows = self.store.page(statuses)
+        with self.lock:
+            return [(row['id'], Record(row)) for row in rows if row['id'] not in self.downloads]
+
+    def page(self, statuses=None, offset=0, limit=100):
+        # (total, summaries) for the API; with a store, history included and filtered by its index
+        if self.store is None:
+            items = self.items()
+            if statuses:
+                items = [(i, dl) for i, dl in items if dl.status in statuses]
+            return len(items), [self.summary(i, dl) for i, dl in items[offset:offset + limit]]
+        total, rows = self.store.page(statuses, offset, limit)
+        summaries = []
+        for row in rows:
+            dl = self.get(row['id'])
+            summaries.append(self.summary(row['id'], dl if dl is not None else Record(row)))
+        return total, summaries
+
+    def enqueue(self, download_id):
+        # Caller holds self.lock. Behind everything of the same or higher priority;
+        # scanning from the back keeps the common equal-priority case O(1).
+        priority = self.priorities.get(download_id, 0)
+        pos = len(self.queue)
+        while pos and self.priorities.get(self.queue[pos - 1], 0) < priority:
+            pos -= 1
+        self.queue.insert(pos, download_id)
+
+    def set_priority(self, download_id, priority):
+        with self.lock:
+            if download_id not in self.downloads:
+                return False
+            self.priorities[download_id] = priority
+            if download_id in self.queue:
+                self.queue.remove(download_id)
+                self.enqueue(download_id)
+        if self.store is not None:
+            self.store.update(download_id, priority=priority)
+        self.events.publish('priority', id=download_id, priority=priority)
+        return True
+
+    def get(self, download_id):
+        return self.downloads.get(download_id)
+
+    def lookup(self, download_id):
+        # The live Downloader, or a Record if it's only in the store (history from an earlier session)
+        dl = self.downloads.get(download_id)
+        if dl is None and self.store is not None:
+            row = self.store.get(download_id)
+            if row is not None:
+                dl = Record(row)
+        return dl
+
+    def items(self):
+        with self.lock:
+            return list(self.downloads.items())
+
+    def pause(self, download_id):
+        with self.lock:
+            dl = self.downloads.get(download_id)
+            if dl is None:
+                return
+            if download_id in self.queue:
+                self.queue.remove(download_id)
+            self.active.discard(download_id)
+            stop = dl.status not in ("completed", "error", "cancelled")
+        # Outside the lock: pausing waits for queued writes and the checkpoint
+        if stop:
+            dl.pause()
+        self.record(download_id, dl)
+        self.schedule()
+
+    def resume(self, download_id):
+        with self.lock:
+            dl = self.downloads.get(download_id)
+            if dl is None or download_id in self.active or download_id in self.queue:
+                return
+            if dl.status in ("completed", "cancelled"):
+                return
+            dl.status = "queued"
+            self.enqueue(download_id)
+            self.record(download_id, dl)
+        self.schedule()
+
+    def cancel(self, download_id):
+        with self.lock:
+            dl = self.downloads.get(download_id)
+            if dl is None:
+                return
+            if download_id in self.queue:
+                self.queue.remove(download_id)
+            self.active.discard(download_id)
+        dl.cancel()
+        self.record(download_id, dl)
+        self.schedule()
+
+    def remove(self, download_id):
+        with self.lock:
+            if download_id in self.queue:
+                self.queue.remove(download_id)
+            self.active.discard(download_id)
+            dl = self.downloads.pop(download_id, None)
+            self.requested_threads.pop(download_id, None)
+            self.priorities.pop(download_id, None)
+            self.last_status.pop(download_id, None)
+            if dl is not None and self.by_url.get(normalize_url(dl.url)) == download_id:
+                del self.by_url[normalize_url(dl.url)]
+        if self.store is not None:
+            self.store.delete(download_id)
+        if dl is not None:
+            self.events.publish('removed', id=download_id)
+        self.schedule()
+
+    def set_limits(self, max_active=None, max_connections=None):
+        with self.lock:
+            if max_active is not None:
+                self.max_active = max(1, max_active)
+            if max_connections is not None:
+                self.max_connections = max(1, max_connections)
+        self.schedule()
+
+    def set_speed_limit(self, download_id, rate):
+        dl = self.downloads.get(download_id)
+        if dl is not None:
+            dl.set_speed_limit(rate)
+
+    def set_global_speed_limit(self, rate):
+        Downloader.set_global_speed_limit(rate)
+
+    def set_host_speed_limit(self, host, rate):
+        Downloader.hosts.set_speed_limit(host, rate)
+
+    def connection_stats(self):
+        connections = {'thread': Downloader.connection_stats()}
+        from core.aio import AsyncEngine
+        engine = AsyncEngine._instance
+        if engine is not None:
+            connections['async'] = {'requests': engine.client.requests_sent, 'connections': engine.client.connections_opened}
+        if Downloader.http2.requests_sent:
+            connections['http2'] = {'requests': Downloader.http2.requests_sent, 'connections': Downloader.http2.connections_opened}
+        return connections
+
+    def host_connections(self):
+        # {host: {'requests': n, 'connections': n}} summed over the HTTP/1.1 engines
+        hosts = Downloader.host_connection_stats()
+        from core.aio import AsyncEngine
+        engine = AsyncEngine._instance
+        if engine is not None:
+            for host, counts in list(engine.client.per_host.items()):
+                entry = hosts.setdefault(host, {'requests': 0, 'connections': 0})
+                entry['requests'] += counts['requests']
+                entry['connections'] += counts['connections']
+        return hosts
+
+    def metrics_text(self):
+        # Prometheus text format for every download, host and connection pool
+        cache = Downloader.cache.stats() if Downloader.cache is not None else None
+        return render_prometheus(self.items(), Downloader.hosts, self.connection_stats(), Downloader.buffers.stats(),
+                                 Downloader.writer.stats(), cache, self.host_connections(), Downloader.dns.stats())
+
+    def summary(self, download_id, dl):
+        return {
+            'id': download_id,
+            'url': dl.url,
+            'file': dl.filename,
+            'path': dl.save_path,
+            'status': dl.status,
+            'size': dl.file_size,
+            'downloaded': dl.downloaded_size,
+            'progress': dl.get_progress(),
+            'speed': dl.speed,
+            'eta': dl.get_eta(),
+            'connections': dl.active_workers,
+            'priority': self.priorities.get(download_id, 0),
+            'cached': dl.from_cache,
+            'mirrors': dl.mirrors.describe() if dl.mirrors is not None else []
+        }
+
+    def status(self):
+        return [self.summary(download_id, dl) for download_id, dl in self.items()]
+
+    def stats(self):
+        # Same data as metrics_text, as a JSON-friendly dict
+        downloads = {}
+        for download_id, dl in self.items():
+            entry = dl.metrics.snapshot()
+            entry.update(self.summary(download_id, dl))
+            entry['disk_write']['queued'] = dl.pending_writes()
+            downloads[download_id] = entry
+        hosts = {}
+        with Downloader.hosts.lock:
+            states = list(Downloader.hosts.hosts.values())
+        reuse = self.host_connections()
+        for state in states:
+            counts = reuse.get(state.host, {'requests': 0, 'connections': 0})
+            hosts[state.host] = {'connections': state.connections, 'cap': state.max_connections, 'errors': dict(state.errors),
+                                 'requests': counts['requests'], 'opened': counts['connections'], 'warmed': state.warmed}
+        stats = {'downloads': downloads, 'hosts': hosts, 'connections': self.connection_stats(), 'buffers': Downloader.buffers.stats(),
+                 'disk': Downloader.writer.stats(), 'dns': Downloader.dns.stats()}
+        if Downloader.cache is not None:
+            stats['cache'] = Downloader.cache.stats()
+        return stats
+
+    def shutdown(self):
+        # Checkpoint everything that's running so a restart can resume it. The store keeps
+        # the status they had, so they're queued again next time instead of left paused.
+        with self.lock:
+            for download_id, dl in self.downloads.items():
+                self.record(download_id, dl)
+            self.closing = True
+            self.queue.clear()
+            active = [self.downloads[download_id] for download_id in self.active]
+            self.active.clear()
+        for dl in active:
+            if dl.status not in ("completed", "error", "cancelled"):
+                dl.pause()
+        if self.store is not None:
+            self.store.close()
+
+    def schedule(self):
+        with self.lock:
+            # Free the slots of anything that finished, failed or was paused
+            for download_id in list(self.active):
+                dl = self.downloads.get(download_id)
+                if dl is None or dl.status not in ACTIVE_STATUSES:
+                    self.active.discard(download_id)
+
+            started = []
+            while self.queue and len(self.active) < self.max_active:
+                download_id = self.queue.popleft()
+                self.active.add(download_id)
+                started.append(download_id)
+
+            self.rebalance()
+
+            for download_id in started:
+                dl = self.downloads[download_id]
+                dl.status = "starting"
+                # start() probes the server, keep that off the caller's thread
+                threading.Thread(target=dl.start, daemon=True).start()
+
+    def rebalance(self):
+        # Caller holds self.lock. Even share of the global cap, never above what was asked for.
+        if not self.active:
+            return
+        share = max(1, self.max_connections // len(self.active))
+        for download_id in self.active:
+            dl = self.downloads[download_id]
+            threads = min(self.requested_threads[download_id], share)
+            if threads != dl.max_threads:
+                dl.set_max_threads(threads)
+
+    def publish_changes(self):
+        # Status transitions since the last tick, plus a progress sample for everything running
+        for download_id, dl in self.items():
+            status = dl.status
+            if self.last_status.get(download_id) != status:
+                self.last_status[download_id] = status
+                self.events.publish('status', id=download_id, status=status)
+                self.record(download_id, dl)
+            elif status in ACTIVE_STATUSES:
+                self.record(download_id, dl)
+            if status in ACTIVE_STATUSES:
+                self.events.publish('progress', id=download_id, downloaded=dl.downloaded_size, size=dl.file_size,
+                                    speed=dl.speed, eta=dl.get_eta())
+
+    def run(self):
+        while True:
+            time.sleep(0.5)
+            self.schedule()
+            self.publish_changes()
+            if self.store is not None:
+                self.store.maybe_flush()
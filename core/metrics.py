@@ -0,0 +1,258 @@
+import bisect
+import math
+import threading
+import time
+
+# Download instrumentation. Each segment worker only ever touches its own
+# SegmentStats, so the per-chunk path takes no lock; totals are summed from the
+# shards when someone asks. Rare events (errors, retries) go through a lock.
+
+# Upper bounds (seconds) of the disk write latency histogram
+WRITE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class SegmentStats:
+    __slots__ = ('bytes', 'requests', 'request_start', 'request_bytes', 'last_write', 'ttfb', 'ttfb_total', 'active_time')
+
+    def __init__(self):
+        self.bytes = 0
+        self.requests = 0
+        self.request_start = None
+        self.request_bytes = 0 # bytes when the current request started
+        self.last_write = None # monotonic time of the last write (or request start), for stall detection
+        self.ttfb = None # Last request's time to first byte
+        self.ttfb_total = 0.0
+        self.active_time = 0.0 # Seconds spent inside finished requests
+
+    def request_started(self):
+        self.requests += 1
+        self.request_start = self.last_write = time.monotonic()
+        self.request_bytes = self.bytes
+
+    def first_byte(self):
+        if self.request_start is not None:
+            self.ttfb = time.monotonic() - self.request_start
+            self.ttfb_total += self.ttfb
+
+    def request_done(self):
+        if self.request_start is not None:
+            self.active_time += time.monotonic() - self.request_start
+            self.request_start = None
+
+    def wrote(self, n):
+        # Handed to the disk writer; how long the disk takes is tracked per download
+        self.last_write = time.monotonic()
+        self.bytes += n
+
+    def throughput(self):
+        elapsed = self.active_time
+        if self.request_start is not None:
+            elapsed += time.monotonic() - self.request_start
+        return self.bytes / elapsed if elapsed > 0 else 0
+
+
+class DownloadMetrics:
+    def __init__(self, speed_window=1.0, eta_window=5.0):
+        self.lock = threading.Lock()
+        self.segments = {}
+        self.errors = {}
+        self.retries = 0
+        # EWMA time constants: a short one for the displayed speed, a longer one so ETA doesn't jump around
+        self.speed_window = speed_window
+        self.eta_window = eta_window
+        self.speed = 0.0
+        self.eta_speed = 0.0
+        # Disk writes, recorded by the writer threads
+        self.writes = 0
+        self.write_bytes = 0
+        self.write_time = 0.0
+        self.write_max = 0.0
+        self.write_buckets = [0] * (len(WRITE_BUCKETS) + 1)
+
+    def segment(self, index):
+        stats = self.segments.get(index)
+        if stats is None:
+            with self.lock:
+                stats = self.segments.setdefault(index, SegmentStats())
+        return stats
+
+    def record_error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def update_speed(self, instant, elapsed):
+        # Time-weighted EWMA, so irregular tick spacing doesn't skew it
+        if elapsed <= 0:
+            return self.speed
+        if not self.speed and not self.eta_speed:
+            self.speed = self.eta_speed = instant
+        else:
+            self.speed += (1 - math.exp(-elapsed / self.speed_window)) * (instant - self.speed)
+            self.eta_speed += (1 - math.exp(-elapsed / self.eta_window)) * (instant - self.eta_speed)
+        return self.speed
+
+    def reset_speed(self):
+        self.speed = self.eta_speed = 0.0
+
+    def eta(self, remaining):
+        # Seconds left, or None while the rate (or the size) is unknown
+        if remaining is None or remaining < 0 or self.eta_speed <= 0:
+            return None
+        return remaining / self.eta_speed
+
+    def record_write(self, n, seconds):
+        with self.lock:
+            self.writes += 1
+            self.write_bytes += n
+            self.write_time += seconds
+            if seconds > self.write_max:
+                self.write_max = seconds
+            self.write_buckets[bisect.bisect_left(WRITE_BUCKETS, seconds)] += 1
+
+    def write_histogram(self):
+        with self.lock:
+            return list(self.write_buckets), self.write_time, self.writes, self.write_max
+
+    def snapshot(self):
+        segments = {}
+        for index, stats in sorted(self.segments.items()):
+            segments[index] = {
+                'bytes': stats.bytes,
+                'requests': stats.requests,
+                'throughput': stats.throughput(),
+                'ttfb': stats.ttfb,
+                'ttfb_avg': stats.ttfb_total / stats.requests if stats.requests else None
+            }
+        buckets, total, count, worst = self.write_histogram()
+        with self.lock:
+            errors = dict(self.errors)
+            retries = self.retries
+        return {
+            'segments': segments,
+            'errors': errors,
+            'retries': retries,
+            'disk_write': {
+                'count': count,
+                'bytes': self.write_bytes,
+                'seconds': total,
+                'avg': total / count if count else None,
+                'max': worst,
+                'buckets': dict(zip([str(b) for b in WRITE_BUCKETS] + ['+Inf'], buckets))
+            }
+        }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def render_prometheus(downloads, hosts=None, connections=None, buffers=None, disk=None, cache=None, host_connections=None, dns=None):
+    # Prometheus text exposition (format 0.0.4).
+    # downloads: iterable of (download_id, Downloader); hosts: HostRegistry;
+    # connections: {engine: {'requests': n, 'connections': n}}; buffers: BufferPool.stats(); disk: DiskWriter.stats();
+    # cache: ContentCache.stats(), if the cache is on; host_connections: {host: {'requests': n, 'connections': n}};
+    # dns: DNSCache.stats()
+    # Samples are grouped per family, as the format requires
+    families = {}
+
+    def metric(name, metric_type, help_text, value, family=None, **labels):
+        family = family or name
+        if family not in families:
+            families[family] = [f'# HELP {family} {help_text}', f'# TYPE {family} {metric_type}']
+        families[family].append(f'{name}{_labels(**labels) if labels else ""} {value}')
+
+    for download_id, dl in downloads:
+        m = dl.metrics
+        base = {'id': download_id, 'file': dl.filename}
+        metric('tafim_download_info', 'gauge', 'Download status (always 1).', 1, status=dl.status, **base)
+        metric('tafim_download_bytes', 'gauge', 'Bytes downloaded so far.', dl.downloaded_size, **base)
+        metric('tafim_download_size_bytes', 'gauge', 'Total size in bytes, 0 if unknown.', dl.file_size, **base)
+        metric('tafim_download_speed_bytes_per_second', 'gauge', 'Smoothed download speed.', round(dl.speed, 1), **base)
+        eta = dl.get_eta()
+        if eta is not None:
+            metric('tafim_download_eta_seconds', 'gauge', 'Estimated seconds to completion.', round(eta, 1), **base)
+        metric('tafim_download_connections', 'gauge', 'Segment workers currently running.', dl.active_workers, **base)
+        metric('tafim_download_retries_total', 'counter', 'Segments handed back for another attempt.', m.retries, **base)
+        with m.lock:
+            errors = dict(m.errors)
+        for kind, n in sorted(errors.items()):
+            metric('tafim_download_errors_total', 'counter', 'Segment failures by type.', n, kind=kind, **base)
+
+        buckets, total, count, _ = m.write_histogram()
+        cumulative = 0
+        for bound, n in zip([str(b) for b in WRITE_BUCKETS] + ['+Inf'], buckets):
+            cumulative += n
+            metric('tafim_disk_write_seconds_bucket', 'histogram', 'Latency of (merged) writes to the part file.', cumulative,
+                   family='tafim_disk_write_seconds', le=bound, **base)
+        metric('tafim_disk_write_seconds_sum', 'histogram', '', round(total, 6), family='tafim_disk_write_seconds', **base)
+        metric('tafim_disk_write_seconds_count', 'histogram', '', count, family='tafim_disk_write_seconds', **base)
+        metric('tafim_download_write_queue_bytes', 'gauge', 'Received bytes waiting for the disk writer.', dl.pending_writes(), **base)
+
+        for mirror in dl.mirrors.describe():
+            labels = dict(base, mirror=mirror['url'], state=mirror['state'])
+            metric('tafim_mirror_bytes_total', 'counter', 'Bytes received per mirror.', mirror['bytes'], **labels)
+            metric('tafim_mirror_connections', 'gauge', 'Segment workers on each mirror.', mirror['connections'], **labels)
+            metric('tafim_mirror_speed_bytes_per_second', 'gauge', 'Smoothed per-connection throughput of each mirror.',
+                   round(mirror['speed'], 1), **labels)
+
+        for index, stats in sorted(m.segments.items()):
+            seg = dict(base, segment=index)
+            metric('tafim_segment_bytes_total', 'counter', 'Bytes received per segment.', stats.bytes, **seg)
+            metric('tafim_segment_requests_total', 'counter', 'HTTP requests issued per segment.', stats.requests, **seg)
+            metric('tafim_segment_throughput_bytes_per_second', 'gauge', 'Average segment throughput while active.', round(stats.throughput(), 1), **seg)
+            if stats.ttfb is not None:
+                metric('tafim_segment_ttfb_seconds', 'gauge', 'Time to first byte of the latest request.', round(stats.ttfb, 4), **seg)
+
+    if hosts is not None:
+        with hosts.lock:
+            states = list(hosts.hosts.values())
+        for state in states:
+            metric('tafim_host_connections', 'gauge', 'Open connections per host across downloads.', state.connections, host=state.host)
+            metric('tafim_host_connection_cap', 'gauge', 'Per-host connection cap.', state.max_connections, host=state.host)
+            for kind, n in sorted(state.errors.items()):
+                metric('tafim_host_errors_total', 'counter', 'Errors per host by type.', n, host=state.host, kind=kind)
+            metric('tafim_host_connections_warmed_total', 'counter', 'Connections opened ahead of the segments that used them.', state.warmed, host=state.host)
+
+    for host, counts in sorted((host_connections or {}).items()):
+        metric('tafim_host_requests_total', 'counter', 'HTTP/1.1 requests per host across downloads.', counts['requests'], host=host)
+        metric('tafim_host_connections_opened_total', 'counter', 'New connections per host; the rest of the requests reused one.', counts['connections'], host=host)
+
+    for engine, stats in sorted((connections or {}).items()):
+        metric('tafim_http_requests_total', 'counter', 'HTTP requests sent.', stats['requests'], engine=engine)
+        metric('tafim_http_connections_opened_total', 'counter', 'New TCP connections opened; the rest reused a pooled one.', stats['connections'], engine=engine)
+
+    if dns is not None:
+        metric('tafim_dns_lookups_total', 'counter', 'Host lookups that went to the resolver.', dns['lookups'])
+        metric('tafim_dns_cache_hits_total', 'counter', 'Host lookups answered from the DNS cache.', dns['hits'])
+
+    if buffers is not None:
+        metric('tafim_buffer_pool_capacity_bytes', 'gauge', 'Most memory the receive buffer pool may hold.', buffers['capacity'] * buffers['buffer_size'])
+        metric('tafim_buffer_pool_allocated_bytes', 'gauge', 'Memory held by receive buffers.', buffers['allocated'] * buffers['buffer_size'])
+        metric('tafim_buffer_pool_in_use', 'gauge', 'Receive buffers currently lent to segments.', buffers['in_use'])
+        metric('tafim_buffer_pool_waits_total', 'counter', 'Times a segment waited for a free receive buffer.', buffers['waits'])
+
+    if disk is not None:
+        metric('tafim_disk_queue_bytes', 'gauge', 'Bytes queued for the disk writer across downloads.', disk['queued'])
+        metric('tafim_disk_queue_capacity_bytes', 'gauge', 'Queue depth at which segments wait for the disk.', disk['capacity'])
+        metric('tafim_disk_queue_waits_total', 'counter', 'Times a segment waited for room in the write queue.', disk['waits'])
+        metric('tafim_disk_writes_total', 'counter', 'Write calls issued by the disk writer.', disk['writes'])
+        metric('tafim_disk_write_pieces_total', 'counter', 'Received pieces those writes carried.', disk['pieces'])
+        metric('tafim_disk_fsyncs_total', 'counter', 'fsync calls on part files.', disk['fsyncs'])
+
+    if cache is not None:
+        metric('tafim_cache_hits_total', 'counter', 'Downloads served from the local cache.', cache['hits'])
+        metric('tafim_cache_misses_total', 'counter', 'Cache lookups that found nothing usable.', cache['misses'])
+        metric('tafim_cache_saved_bytes_total', 'counter', 'Bytes put in place from the cache instead of downloaded.', cache['bytes_saved'])
+        metric('tafim_cache_evictions_total', 'counter', 'Objects evicted to stay within the size budget.', cache['evictions'])
+        metric('tafim_cache_bytes', 'gauge', 'Size of the cached objects.', cache['bytes'])
+        metric('tafim_cache_capacity_bytes', 'gauge', 'Size budget of the cache.', cache['capacity'])
+
+    return '\n'.join(line for lines in families.values() for line in lines) + '\n'
@@ -0,0 +1,188 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+# Several URLs serving the same file. Each segment worker is pinned to one mirror
+# for its lifetime; new workers go to the mirror with the most per-connection
+# throughput to spare. Failing mirrors are backed off, mirrors that fall far
+# behind the best one are demoted (their workers hand the rest of their range
+# back), and mirrors whose content doesn't match are dropped for good.
+
+
+class Mirror:
+    def __init__(self, url, host):
+        self.url = url
+        self.host = host # Shared HostState: connection cap, limiter, error counters
+        self.etag = None
+        self.last_modified = None
+        self.disabled = None # Reason, once this mirror is out for good
+        self.http2 = False # Segments go over the shared HTTP/2 connections
+        self.connections = 0
+        self.bytes = 0
+        self.last_bytes = 0
+        # Connection-seconds so far: a mirror that finished its ranges between two
+        # updates still gets a fair sample
+        self.busy = 0.0
+        self.last_busy = 0.0
+        self.stamp = time.monotonic()
+        self.speed = 0.0 # EWMA bytes/s per connection
+        self.failures = 0 # Consecutive
+        self.demoted_until = 0.0
+
+    @property
+    def validator(self):
+        # If-Range needs a strong ETag; weak ones fall back to Last-Modified
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    def healthy(self, now=None):
+        return not self.disabled and (now or time.monotonic()) >= self.demoted_until
+
+    def tally(self, now):
+        # Caller holds the MirrorSet lock
+        self.busy += self.connections * (now - self.stamp)
+        self.stamp = now
+
+
+class MirrorSet:
+    # A mirror this far below the best per-connection speed gets demoted
+    SLOW_RATIO = 0.25
+    SLOW_BACKOFF = 30.0
+    MAX_FAILURES = 3
+
+    def __init__(self, registry, urls):
+        self.registry = registry
+        self.lock = threading.Lock()
+        self.mirrors = []
+        for url in urls:
+            self.add(url)
+
+    @property
+    def primary(self):
+        return self.mirrors[0]
+
+    def add(self, url):
+        with self.lock:
+            for m in self.mirrors:
+                if m.url == url:
+                    return m
+            m = Mirror(url, self.registry.get(urlparse(url).hostname or ""))
+            self.mirrors.append(m)
+            return m
+
+    def usable(self):
+        return [m for m in self.mirrors if not m.disabled]
+
+    def has_alternative(self, mirror):
+        now = time.monotonic()
+        return any(m is not mirror and m.healthy(now) for m in self.mirrors)
+
+    def acquire(self):
+        # Reserve a connection on the mirror that's least loaded relative to its speed.
+        # Unmeasured mirrors count as fast as the best one so they get a fair try.
+        now = time.monotonic()
+        with self.lock:
+            candidates = [m for m in self.mirrors if m.healthy(now)]
+            if not candidates:
+                # Everything is backed off: keep going on whatever isn't disabled
+                candidates = self.usable()
+            best = max((m.speed for m in candidates), default=0) or 1.0
+            candidates.sort(key=lambda m: m.connections / (m.speed or best))
+            for m in candidates:
+                if m.host.acquire():
+                    if not m.host.breaker.allow():
+                        # Host is down; nobody connects until its cool-down is over
+                        m.host.release()
+                        continue
+                    m.tally(now)
+                    m.connections += 1
+                    return m
+        return None
+
+    def release(self, mirror):
+        with self.lock:
+            mirror.tally(time.monotonic())
+            mirror.connections = max(0, mirror.connections - 1)
+        mirror.host.release()
+
+    def record(self, mirror, n):
+        with self.lock:
+            mirror.bytes += n
+
+    def succeeded(self, mirror):
+        mirror.failures = 0
+        mirror.host.breaker.success()
+
+    def failed(self, mirror):
+        # Exponential back-off after repeated failures, unless it's the only mirror left
+        mirror.host.breaker.failure()
+        with self.lock:
+            mirror.failures += 1
+            if mirror.failures >= self.MAX_FAILURES and self.has_alternative(mirror):
+                mirror.demoted_until = time.monotonic() + min(60.0, 2.0 ** mirror.failures)
+                return True
+        return False
+
+    def disable(self, mirror, reason):
+        if self.has_alternative(mirror):
+            print(f"Dropping mirror {mirror.url}: {reason}")
+            mirror.disabled = reason
+            return True
+        return False
+
+    def update(self):
+        # Called periodically: per-connection speed per mirror, then demote stragglers.
+        # Returns True if any mirror was demoted.
+        now = time.monotonic()
+        with self.lock:
+            for m in self.mirrors:
+                m.tally(now)
+                delta, busy = m.bytes - m.last_bytes, m.busy - m.last_busy
+                m.last_bytes, m.last_busy = m.bytes, m.busy
+                if busy > 0:
+                    sample = delta / busy
+                    m.speed = sample if not m.speed else 0.5 * m.speed + 0.5 * sample
+            # Idle mirrors keep their last speed as the yardstick
+            measured = [m for m in self.mirrors if m.healthy(now) and m.speed]
+            if len(measured) < 2:
+                return False
+            best = max(m.speed for m in measured)
+            demoted = False
+            for m in measured:
+                if not m.connections:
+                    continue
+                if m.speed < best * self.SLOW_RATIO:
+                    print(f"Mirror {m.url} is slow ({m.speed / 1024:.0f} KB/s per connection), demoting")
+                    m.demoted_until = now + self.SLOW_BACKOFF
+                    # Start fresh when it gets another chance
+                    m.speed = 0.0
+                    demoted = True
+            return demoted
+
+    def congestion_events(self):
+        hosts = {id(m.host): m.host for m in self.mirrors}
+        return sum(h.congestion_events() for h in hosts.values())
+
+    def state(self):
+        # What the checkpoint remembers: which mirrors, their validators, which were dropped
+        return [{'url': m.url, 'etag': m.etag, 'last_modified': m.last_modified, 'disabled': m.disabled} for m in self.mirrors]
+
+    def restore(self, states):
+        for s in states or []:
+            m = self.add(s['url'])
+            m.etag = s.get('etag')
+            m.last_modified = s.get('last_modified')
+            m.disabled = s.get('disabled')
+
+    def describe(self):
+        now = time.monotonic()
+        return [{
+            'url': m.url,
+            'connections': m.connections,
+            'protocol': 'http2' if m.http2 else 'http1',
+            'bytes': m.bytes,
+            'speed': m.speed,
+            'state': 'disabled' if m.disabled else 'active' if m.healthy(now) else 'demoted',
+            'disabled': m.disabled
+        } for m in self.mirrors]
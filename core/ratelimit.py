@@ -0,0 +1,43 @@
+import threading
+import time
+
+# Token-bucket bandwidth limiting. Buckets run in "debt" mode: a caller takes
+# the bytes it just received right away and is told how long to back off,
+# then sleeps outside the lock. Reservations are therefore served in arrival
+# order (fair across segments) and the lock is held for a few arithmetic ops.
+
+
+class TokenBucket:
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.stamp = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        # rate is bytes/s, 0 means unlimited. Takes effect for the next reservation.
+        with self.lock:
+            self.rate = max(0, rate or 0)
+            # Default burst: a quarter second of traffic, at least one 1 MB read
+            self.burst = burst if burst is not None else max(self.rate / 4, 1024 * 1024)
+            self.tokens = min(self.tokens, self.burst) if self.rate else 0
+            self.stamp = time.monotonic()
+
+    def reserve(self, n):
+        # Returns seconds the caller should wait before reading more
+        if self.rate <= 0:
+            # Unlimited fast path, no lock
+            return 0
+        with self.lock:
+            rate = self.rate
+            if rate <= 0:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * rate)
+            self.stamp = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / rate
@@ -0,0 +1,75 @@
+import random
+import threading
+import time
+
+# Retry policy for failed segments, plus a per-host circuit breaker so that an
+# outage doesn't have every segment of every download hammering the same host.
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=10, base_delay=0.5, max_delay=30.0, stall_timeout=8.0, slow_ratio=0.1,
+                 give_up_after=600.0):
+        self.max_attempts = max_attempts # Consecutive failures of one segment without progress
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stall_timeout = stall_timeout # No bytes for this long and the connection is replaced
+        self.slow_ratio = slow_ratio # Below this fraction of the median segment speed counts as slow
+        self.give_up_after = give_up_after # Seconds without any progress before the download fails (None = never)
+
+    def backoff(self, attempt):
+        # Exponential with full jitter, so failed segments don't come back in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    # closed: requests flow. open: nobody connects until the cool-down is over.
+    # half-open: a single trial request decides whether to close or re-open (for longer).
+    THRESHOLD = 5
+    COOLDOWN = 5.0
+    MAX_COOLDOWN = 120.0
+    TRIAL_TIMEOUT = 30.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.cooldown = self.COOLDOWN
+        self.open_until = 0.0
+        self.trial_at = 0.0
+
+    def allow(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                if now < self.open_until:
+                    return False
+                self.state = 'half-open'
+                self.trial_at = now
+                return True
+            # half-open: one trial at a time, another if it never reported back
+            if now - self.trial_at > self.TRIAL_TIMEOUT:
+                self.trial_at = now
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            if self.state != 'closed':
+                print("Host is reachable again, closing circuit")
+            self.state = 'closed'
+            self.failures = 0
+            self.cooldown = self.COOLDOWN
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open':
+                # Trial failed: stay away twice as long
+                self.cooldown = min(self.MAX_COOLDOWN, self.cooldown * 2)
+            elif self.state == 'open' or self.failures < self.THRESHOLD:
+                return
+            self.state = 'open'
+            self.open_until = time.monotonic() + self.cooldown
+            print(f"{self.failures} failures in a row, pausing requests for {self.cooldown:.0f}s")
@@ -0,0 +1,257 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+# Queue and history on disk (SQLite), one row per download. Lookups go through
+# indexes on the normalized URL and the status, so deduplicating a capture or
+# listing a status stays cheap with tens of thousands of rows. Writes are buffered
+# and merged per download, then flushed together in one transaction, so progress
+# updates from every running download cost one commit per flush, not one each.
+# The part files and journals under .tafim_tmp stay the authority on progress;
+# this only remembers what was asked for and where each download got to.
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    norm_url TEXT NOT NULL,
+    save_path TEXT NOT NULL,
+    path TEXT,
+    file TEXT,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    threads INTEGER NOT NULL DEFAULT 32,
+    size INTEGER NOT NULL DEFAULT 0,
+    downloaded INTEGER NOT NULL DEFAULT 0,
+    options TEXT,
+    added REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS downloads_norm_url ON downloads (norm_url);
+CREATE INDEX IF NOT EXISTS downloads_status ON downloads (status);
+"""
+COLUMNS = ('id', 'url', 'norm_url', 'save_path', 'path', 'file', 'status', 'priority', 'threads', 'size', 'downloaded',
+           'options', 'added', 'updated')
+
+# Everything that isn't finished for good: picked up again on the next start
+UNFINISHED = ('idle', 'queued', 'starting', 'downloading', 'restarting', 'verifying', 'finalizing', 'paused', 'error')
+
+BATCH_SIZE = 500 # Pending rows that force a flush
+FLUSH_INTERVAL = 1.0
+
+
+def default_path():
+    return os.path.join(os.path.expanduser("~"), ".tafim", "downloads.db")
+
+
+def normalize_url(url):
+    # Same resource, same key: scheme and host are case-insensitive, default ports
+    # and fragments don't reach the server. Path and query are kept as they are.
+    try:
+        parts = urlsplit(url.strip())
+        host = (parts.hostname or "").rstrip('.')
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    scheme = parts.scheme.lower()
+    if ':' in host:
+        host = f"[{host}]"
+    if port and (scheme, port) not in (('http', 80), ('https', 443)):
+        host = f"{host}:{port}"
+    userinfo = parts.netloc.rpartition('@')[0]
+    if userinfo:
+        host = f"{userinfo}@{host}"
+    return urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+
+class Record:
+    # A download from an earlier session that isn't running: what lists and
+    # summaries need from a Downloader, read from its row
+    speed = 0
+    active_workers = 0
+    mirrors = None
+    from_cache = None
+
+    def __init__(self, row):
+        self.url = row['url']
+        self.save_path = row['path'] or row['save_path']
+        self.filename = row['file'] or os.path.basename(self.save_path)
+        self.status = row['status']
+        self.file_size = row['size']
+        self.downloaded_size = row['downloaded']
+
+    def get_progress(self):
+        return self.downloaded_size / self.file_size if self.file_size else 0
+
+    def get_eta(self):
+        return None
+
+
+class DownloadStore:
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"{self.path} was written by a newer version (schema {version})")
+        self.db.executescript(SCHEMA)
+        self.db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        self.db.commit()
+        # Buffered writes: new rows, changed columns of existing rows, deleted ids
+        self.inserts = {}
+        self.updates = {}
+        self.deletes = set()
+        self.last_flush = time.monotonic()
+
+    def add(self, download_id, url, save_path, threads=32, priority=0, options=None, **fields):
+        now = time.time()
+        row = {'id': download_id, 'url': url, 'norm_url': normalize_url(url), 'save_path': save_path, 'path': None,
+               'file': None, 'status': 'queued', 'priority': priority, 'threads': threads, 'size': 0, 'downloaded': 0,
+               'options': json.dumps(options or {}), 'added': now, 'updated': now}
+        row.update(fields)
+        with self.lock:
+            if self.db is None:
+                return
+            self.inserts[download_id] = row
+            self.updates.pop(download_id, None)
+            self.deletes.discard(download_id)
+            self.flush_if_full()
+
+    def update(self, download_id, **fields):
+        fields['updated'] = time.time()
+        with self.lock:
+            if self.db is None or download_id in self.deletes:
+                return
+            if download_id in self.inserts:
+                self.inserts[download_id].update(fields)
+            else:
+                self.updates.setdefault(download_id, {}).update(fields)
+            self.flush_if_full()
+
+    def delete(self, download_id):
+        with self.lock:
+            if self.db is None:
+                return
+            self.inserts.pop(download_id, None)
+            self.updates.pop(download_id, None)
+            self.deletes.add(download_id)
+            self.flush_if_full()
+
+    def pending(self):
+        return len(self.inserts) + len(self.updates) + len(self.deletes)
+
+    def flush_if_full(self):
+        # Caller holds self.lock
+        if self.pending() >= BATCH_SIZE:
+            self.flush()
+
+    def maybe_flush(self):
+        # Called periodically; a quiet store isn't touched
+        with self.lock:
+            if self.pending() and time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.last_flush = time.monotonic()
+            if self.db is None or not self.pending():
+                return
+            inserts, updates, deletes = self.inserts, self.updates, self.deletes
+            self.inserts, self.updates, self.deletes = {}, {}, set()
+            # Rows changing the same columns go in one executemany
+            groups = {}
+            for download_id, fields in updates.items():
+                keys = tuple(sorted(fields))
+                groups.setdefault(keys, []).append(tuple(fields[k] for k in keys) + (download_id,))
+            try:
+                with self.db:
+                    if inserts:
+                        self.db.executemany(
+                            f"INSERT OR REPLACE INTO downloads ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                            [tuple(row[c] for c in COLUMNS) for row in inserts.values()])
+                    for keys, rows in groups.items():
+                        self.db.executemany(f"UPDATE downloads SET {', '.join(k + ' = ?' for k in keys)} WHERE id = ?", rows)
+                    if deletes:
+                        self.db.executemany("DELETE FROM downloads WHERE id = ?", [(i,) for i in deletes])
+            except sqlite3.Error as e:
+                # Keep running on what's in memory; the next flush tries again with newer data
+                print(f"Warning: could not save the download list: {e}")
+                for download_id, row in inserts.items():
+                    self.inserts.setdefault(download_id, row)
+                for download_id, fields in updates.items():
+                    if download_id not in self.inserts:
+                        self.updates[download_id] = dict(fields, **self.updates.get(download_id, {}))
+                self.deletes |= deletes
+
+    def query(self, sql, params=()):
+        # Reads see everything written so far
+        with self.lock:
+            if self.db is None:
+                return []
+            self.flush()
+            return [self.decode(row) for row in self.db.execute(sql, params)]
+
+    def decode(self, row):
+        row = dict(row)
+        try:
+            row['options'] = json.loads(row['options'] or '{}')
+        except ValueError:
+            row['options'] = {}
+        return row
+
+    def get(self, download_id):
+        rows = self.query("SELECT * FROM downloads WHERE id = ?", (download_id,))
+        return rows[0] if rows else None
+
+    def find(self, url, statuses=None):
+        # Latest download of this URL, of any status or only these; None if there's none
+        where, params = "norm_url = ?", (normalize_url(url),)
+        if statuses:
+            where += f" AND status IN ({', '.join('?' * len(statuses))})"
+            params += tuple(statuses)
+        rows = self.query(f"SELECT * FROM downloads WHERE {where} ORDER BY id DESC LIMIT 1", params)
+        return rows[0] if rows else None
+
+    def unfinished(self):
+        marks = ', '.join('?' * len(UNFINISHED))
+        return self.query(f"SELECT * FROM downloads WHERE status IN ({marks}) ORDER BY id", UNFINISHED)
+
+    def page(self, statuses=None, offset=0, limit=None):
+        # (total, rows) in id order, optionally only these statuses
+        where, params = "", ()
+        if statuses:
+            where = f"WHERE status IN ({', '.join('?' * len(statuses))})"
+            params = tuple(statuses)
+        with self.lock:
+            if self.db is None:
+                return 0, []
+            self.flush()
+            total = self.db.execute(f"SELECT COUNT(*) FROM downloads {where}", params).fetchone()[0]
+            rows = self.db.execute(f"SELECT * FROM downloads {where} ORDER BY id LIMIT ? OFFSET ?",
+                                   params + (-1 if limit is None else limit, offset)).fetchall()
+        return total, [self.decode(row) for row in rows]
+
+    def max_id(self):
+        with self.lock:
+            if self.db is None:
+                return 0
+            self.flush()
+            return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM downloads").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            if self.db is None:
+                return
+            self.flush()
+            self.db.close()
+            self.db = None
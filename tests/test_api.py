@@ -0,0 +1,43 @@
+import shutil
+import tempfile
+import unittest
+
+from core.api import create_api
+from core.manager import DownloadManager
+
+try:
+    import flask
+except ImportError:
+    flask = None
+
+
+@unittest.skipIf(flask is None, "flask is not installed")
+class BulkAddValidationTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        # Nothing is started: every request here is rejected before it's queued
+        self.manager = DownloadManager(max_active=0)
+        self.client = create_api(self.manager, save_dir=self.folder).test_client()
+
+    def tearDown(self):
+        self.manager.shutdown()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_defaults_must_be_an_object(self):
+        for defaults in ("x", [1], 3):
+            r = self.client.post('/downloads', json={'items': ['http://example.com/a.bin'], 'defaults': defaults})
+            self.assertEqual(r.status_code, 400, defaults)
+            self.assertIn('error', r.get_json())
+
+    def test_items_must_be_a_list(self):
+        r = self.client.post('/downloads', json={'items': 'http://example.com/a.bin'})
+        self.assertEqual(r.status_code, 400)
+
+    def test_bad_item_is_reported_in_place(self):
+        r = self.client.post('/downloads', json=[{'url': 'ftp://example.com/a.bin'}, {'url': 'http://example.com/b.bin', 'threads': 'many'}])
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual([list(result) for result in r.get_json()['results']], [['error'], ['error']])
+
+
+if __name__ == '__main__':
+    unittest.main()
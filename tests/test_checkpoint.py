@@ -0,0 +1,115 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from bench.server import BenchServer, expected_sha256
+from core.checkpoint import CRC, RECORD, RECORD_SIZE, Checkpoint
+from core.downloader import Downloader
+
+META = {'url': 'http://example.com/a.bin', 'file_size': 300}
+LAYOUT = [(0, 99, 0, 'pending'), (100, 199, 0, 'pending'), (200, 299, 0, 'pending')]
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.checkpoint = Checkpoint(self.folder, fsync_interval=None)
+        # Compacted layout, then one appended record per segment
+        self.checkpoint.save(META, LAYOUT)
+        self.checkpoint.save(META, [(0, 99, 50, 'downloading'), (100, 199, 100, 'completed'), (200, 299, 7, 'downloading')])
+        self.checkpoint.close()
+
+    def tearDown(self):
+        self.checkpoint.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def append(self, data):
+        with open(self.checkpoint.journal_file, 'ab') as f:
+            f.write(data)
+
+    def currents(self):
+        meta, chunks = Checkpoint(self.folder).load()
+        self.assertEqual(meta, META)
+        return [(c['current'], c['status']) for c in chunks]
+
+    def test_latest_record_wins(self):
+        self.assertEqual(self.currents(), [(50, 'downloading'), (100, 'completed'), (7, 'downloading')])
+
+    def test_torn_tail_is_ignored(self):
+        record = Checkpoint(self.folder).encode(0, (0, 99, 99, 'downloading'))
+        self.append(record[:RECORD_SIZE - 3])
+        self.assertEqual(self.currents(), [(50, 'downloading'), (100, 'completed'), (7, 'downloading')])
+
+    def test_bad_crc_tail_is_ignored(self):
+        body = RECORD.pack(2, 200, 299, 90, 1)
+        self.append(body + CRC.pack(0))
+        self.assertEqual(self.currents()[2], (7, 'downloading'))
+
+    def test_nothing_after_a_bad_record_is_trusted(self):
+        with open(self.checkpoint.journal_file, 'r+b') as f:
+            # Flip a byte inside the first appended record (index 0)
+            f.seek(3 * RECORD_SIZE + 10)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xff]))
+        self.assertEqual(self.currents(), [(0, 'pending'), (0, 'pending'), (0, 'pending')])
+
+    def test_compaction_keeps_the_layout(self):
+        checkpoint = Checkpoint(self.folder, fsync_interval=None, compact_records=4)
+        checkpoint.save(META, LAYOUT)
+        for current in range(1, 10):
+            checkpoint.save(META, [(0, 99, current, 'downloading')] + LAYOUT[1:])
+        checkpoint.close()
+        self.assertLessEqual(os.path.getsize(checkpoint.journal_file), 16 * RECORD_SIZE)
+        self.assertEqual(self.currents(), [(9, 'downloading'), (0, 'pending'), (0, 'pending')])
+
+    def test_missing_journal_means_no_state(self):
+        os.remove(self.checkpoint.journal_file)
+        self.assertIsNone(Checkpoint(self.folder).load())
+
+
+class ResumeFromJournalTest(unittest.TestCase):
+    SIZE = 4 * 1024 * 1024
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.server = BenchServer(self.SIZE, seed=2).start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_torn_record_claiming_more_is_ignored(self):
+        dl = Downloader(self.server.url, self.folder, threads=4)
+        dl.set_speed_limit(2 * 1024 * 1024)
+        dl.start()
+        deadline = time.monotonic() + 10
+        while dl.downloaded_size < self.SIZE // 4 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        dl.pause()
+        time.sleep(0.3)
+        # Only the journal says what's on disk now; its last write was cut short
+        # after claiming segment 0 is done
+        os.remove(dl.blocks_file)
+        first = dict(dl.chunk_info[0])
+        record = dl.checkpoint.encode(0, (0, first['end'], first['end'] + 1, 'completed'))
+        with open(dl.checkpoint.journal_file, 'ab') as f:
+            f.write(record[:-1])
+
+        dl = Downloader(self.server.url, self.folder, threads=4)
+        self.assertTrue(dl.load_state())
+        self.assertEqual(dl.chunk_info[0]['current'], first['current'])
+        dl.start()
+        deadline = time.monotonic() + 30
+        while dl.status not in ("completed", "error") and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(dl.status, "completed")
+        with open(dl.save_path, 'rb') as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(), expected_sha256(self.SIZE, seed=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
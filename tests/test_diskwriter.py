@@ -0,0 +1,124 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from core.diskwriter import DiskWriter
+
+KB = 1024
+
+
+class DiskWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "out.part")
+        with open(self.path, 'wb') as f:
+            f.truncate(64 * KB)
+        # One writer thread, held inside its first write callback until the gate opens
+        self.writer = DiskWriter(threads=1, max_bytes=16 * KB)
+        self.gate = threading.Event()
+        self.reached = []
+        self.output = self.writer.open(self.path, on_written=self.written)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.gate.set()
+        if self.output.fd is not None:
+            self.output.close()
+        self.loop.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def written(self, owner, end):
+        self.reached.append((owner, end))
+        self.gate.wait(5)
+
+    def until(self, condition, what):
+        deadline = time.monotonic() + 5
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail(what)
+            time.sleep(0.01)
+
+    def contents(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def settled(self, future):
+        self.loop.run_until_complete(asyncio.wait_for(future, 5))
+
+    def test_segments_land_at_their_offsets(self):
+        self.gate.set()
+        first, second = object(), object()
+        for i in range(8):
+            self.writer.submit(self.output, first, i * KB, bytes([1]) * KB)
+            self.writer.submit(self.output, second, 32 * KB + i * KB, bytes([2]) * KB)
+        self.assertIsNone(self.output.close())
+        data = self.contents()
+        self.assertEqual(data[:8 * KB], bytes([1]) * 8 * KB)
+        self.assertEqual(data[32 * KB:40 * KB], bytes([2]) * 8 * KB)
+        # Per segment in order, ending where the segment got to
+        ends = [end for owner, end in self.reached if owner is first]
+        self.assertEqual(ends, sorted(ends))
+        self.assertEqual(ends[-1], 8 * KB)
+
+    def test_refetched_piece_lands_after_the_copy_it_replaces(self):
+        owner = object()
+        self.writer.submit(self.output, owner, 0, b'x' * KB) # Held at the gate
+        self.writer.submit(self.output, owner, KB, b'bad' * KB)
+        self.writer.submit(self.output, owner, KB, b'ok!' * KB)
+        self.gate.set()
+        self.output.close()
+        self.assertEqual(self.contents()[KB:4 * KB], b'ok!' * KB)
+
+    def test_full_queue_makes_the_segment_wait(self):
+        owner = object()
+        self.writer.submit(self.output, owner, 0, b'a' * 16 * KB)
+        self.assertTrue(self.writer.full())
+        room = self.writer.room(self.loop)
+        blocked = threading.Thread(target=self.writer.submit, args=(self.output, owner, 16 * KB, b'b' * KB))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        self.assertFalse(room.done())
+        self.gate.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        self.settled(room)
+        self.assertEqual(self.writer.stats()['waits'], 2)
+
+    def test_drained_waits_for_one_segment(self):
+        owner, other = object(), object()
+        self.writer.submit(self.output, owner, 0, b'a' * KB)
+        self.writer.submit(self.output, owner, KB, b'b' * KB)
+        self.assertTrue(self.writer.drained(self.loop, self.output, other).done())
+        drained = self.writer.drained(self.loop, self.output, owner)
+        self.assertFalse(drained.done())
+        self.gate.set()
+        self.settled(drained)
+        self.assertEqual(self.contents()[:2 * KB], b'a' * KB + b'b' * KB)
+
+    def test_discard_drops_what_is_still_queued(self):
+        owner = object()
+        self.writer.submit(self.output, owner, 0, b'a' * KB)
+        self.until(lambda: self.reached, "writer never wrote") # Written, the callback is still running
+        self.writer.submit(self.output, owner, 8 * KB, b'b' * KB)
+        closing = threading.Thread(target=self.output.close, args=(True,))
+        closing.start()
+        self.until(lambda: self.writer.stats()['queued'] == KB, "queued write was not dropped")
+        self.gate.set()
+        closing.join(5)
+        self.assertFalse(closing.is_alive())
+        data = self.contents()
+        self.assertEqual(data[:KB], b'a' * KB)
+        self.assertEqual(data[8 * KB:9 * KB], bytes(KB))
+        self.assertEqual(self.writer.stats()['queued'], 0)
+        # Nothing more is taken once closed
+        self.writer.submit(self.output, owner, 16 * KB, b'c' * KB)
+        self.assertEqual(self.writer.stats()['queued'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
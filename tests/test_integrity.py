@@ -0,0 +1,95 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from bench.server import BenchServer, Faults, content_block, expected_sha256
+from core.downloader import Downloader
+from core.integrity import ResumableHash, libcrypto, new_hasher
+
+SIZE = 4 * 1024 * 1024
+PIECE = 256 * 1024
+SEED = 5
+FAULT_SEED = 1 # Pieces 2 and 9 arrive bad, three requests in all
+
+
+def sha256_of(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def piece_info(size, seed):
+    # What a Metalink with piece hashes would give for the bench file
+    block = content_block(seed)
+    data = (block * -(-size // len(block)))[:size]
+    return {'algo': 'sha256', 'digest': hashlib.sha256(data).hexdigest(), 'piece_algo': 'sha256',
+            'piece_length': PIECE, 'pieces': [hashlib.sha256(data[i:i + PIECE]).hexdigest() for i in range(0, size, PIECE)]}
+
+
+@unittest.skipIf(libcrypto() is None, "no libcrypto to resume digests with")
+class ResumableHashTest(unittest.TestCase):
+    def test_restored_state_continues_the_digest(self):
+        data = os.urandom(300001)
+        hasher = new_hasher('sha256')
+        hasher.update(data[:123457])
+        saved = hasher.snapshot(123457)
+        restored = ResumableHash.restore('sha256', saved)
+        restored.update(data[123457:])
+        self.assertEqual(restored.hexdigest(), hashlib.sha256(data).hexdigest())
+
+    def test_foreign_state_is_refused(self):
+        hasher = new_hasher('sha256')
+        hasher.update(b'x' * 1000)
+        saved = hasher.snapshot(1000)
+        for key, value in (('lib', saved['lib'] + 1), ('algo', 'sha1'), ('state', 'ff' + saved['state'][2:]),
+                           ('state', saved['state'][:20])):
+            with self.subTest(key=key):
+                self.assertIsNone(ResumableHash.restore('sha256', dict(saved, **{key: value})))
+
+
+class PieceRefetchTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        # One flipped byte in about every other response. A single segment keeps the
+        # request sequence, and so the seeded faults, the same on every run.
+        self.server = BenchServer(SIZE, seed=SEED, faults=Faults(corrupt=0.5, seed=FAULT_SEED)).start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def download(self, engine, info):
+        dl = Downloader(self.server.url, self.folder, threads=1, engine=engine)
+        dl.resolve_checksum = lambda: info
+        dl.start()
+        deadline = time.monotonic() + 30
+        while dl.status not in ("completed", "error") and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return dl
+
+    def check_refetched(self, engine):
+        dl = self.download(engine, piece_info(SIZE, SEED))
+        self.assertEqual(dl.status, "completed")
+        self.assertEqual(dl.metrics.errors.get('integrity'), 2)
+        self.assertEqual(self.server.stats()['requests'], 3)
+        self.assertEqual(sha256_of(dl.save_path), expected_sha256(SIZE, seed=SEED))
+
+    def test_bad_piece_is_fetched_again(self):
+        self.check_refetched("thread")
+
+    def test_bad_piece_is_fetched_again_async(self):
+        self.check_refetched("async")
+
+    def test_wrong_file_digest_fails_and_drops_the_state(self):
+        self.server.faults.corrupt = 0
+        info = {'algo': 'sha256', 'digest': '0' * 64}
+        dl = self.download("thread", info)
+        self.assertEqual(dl.status, "error")
+        self.assertFalse(os.path.exists(dl.save_path))
+        self.assertFalse(os.path.exists(dl.checkpoint.meta_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from bench.server import BenchServer, expected_sha256
+from core.manager import DEDUP_STATUSES, DownloadManager
+from core.store import DownloadStore
+
+SIZE = 4 * 1024 * 1024
+
+
+def sha256_of(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class BulkAddTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        # Different content behind the same file name
+        self.servers = [BenchServer(SIZE, seed=seed).start() for seed in (0, 1)]
+        self.manager = DownloadManager(max_active=2)
+
+    def tearDown(self):
+        self.manager.shutdown()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def wait(self, ids, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            statuses = [self.manager.get(i).status for i in ids]
+            if all(s in ("completed", "error", "cancelled") for s in statuses):
+                return statuses
+            time.sleep(0.05)
+        self.fail(f"downloads did not finish: {statuses}")
+
+    def test_same_basename_gets_its_own_file(self):
+        results = self.manager.add_many([
+            {'url': self.servers[0].url + '/dist/file.bin', 'save_path': self.folder, 'threads': 4},
+            {'url': self.servers[1].url + '/mirror/file.bin', 'save_path': self.folder, 'threads': 4},
+        ])
+        ids = [r['id'] for r in results]
+        first, second = (self.manager.get(i) for i in ids)
+        self.assertNotEqual(first.save_path, second.save_path)
+        self.assertNotEqual(first.temp_dir, second.temp_dir)
+        self.assertEqual(os.path.basename(second.save_path), "file (1).bin")
+
+        self.assertEqual(self.wait(ids), ["completed", "completed"])
+        self.assertEqual(sha256_of(first.save_path), expected_sha256(SIZE, seed=0))
+        self.assertEqual(sha256_of(second.save_path), expected_sha256(SIZE, seed=1))
+
+    def test_finished_download_frees_its_name(self):
+        url = self.servers[0].url + '/file.bin'
+        first = self.manager.add(url, self.folder, threads=4)
+        self.assertEqual(self.wait([first]), ["completed"])
+        second = self.manager.add(url, self.folder, threads=4)
+        self.assertEqual(self.manager.get(first).save_path, self.manager.get(second).save_path)
+
+
+class DedupTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.server = BenchServer(SIZE).start()
+        self.store = DownloadStore(os.path.join(self.folder, "downloads.db"))
+        self.manager = DownloadManager(max_active=1, store=self.store)
+
+    def tearDown(self):
+        self.manager.shutdown()
+        self.server.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_cancelled_download_can_be_captured_again(self):
+        url = self.server.url + '/file.bin'
+        download_id = self.manager.add(url, self.folder, threads=4)
+        self.assertEqual(self.manager.find(url, DEDUP_STATUSES), download_id)
+        self.manager.cancel(download_id)
+        self.assertIsNone(self.manager.find(url, DEDUP_STATUSES))
+        # Still in the history
+        self.assertEqual(self.manager.find(url), download_id)
+        self.assertEqual(self.store.find(url)['status'], "cancelled")
+        self.assertIsNone(self.store.find(url, DEDUP_STATUSES))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from bench.server import BenchServer, expected_sha256
+from core.blockmap import BlockMap
+from core.downloader import Downloader
+
+SIZE = 4 * 1024 * 1024
+
+
+def sha256_of(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class BlockMapTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.blocks = BlockMap(os.path.join(self.folder, "blocks.map"), 10 * 100 + 50, 100)
+        self.blocks.open()
+
+    def tearDown(self):
+        self.blocks.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_only_whole_blocks_are_marked(self):
+        self.blocks.mark(0, 250)
+        self.blocks.mark(980, 1050) # The short last block counts at the file end
+        self.assertEqual(self.blocks.runs(), [(0, 199, True), (200, 999, False), (1000, 1049, True)])
+
+    def test_clear_takes_every_block_touched(self):
+        self.blocks.mark(0, 1050)
+        self.blocks.clear(150, 201)
+        self.assertEqual(self.blocks.runs(), [(0, 99, True), (100, 299, False), (300, 1049, True)])
+
+    def test_reopened_map_keeps_its_bits(self):
+        self.blocks.mark(300, 500)
+        self.blocks.close()
+        again = BlockMap(self.blocks.path, self.blocks.file_size, 100)
+        self.assertTrue(again.open())
+        self.assertEqual(again.count(), 2)
+        again.close()
+
+
+class PauseResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.server = BenchServer(SIZE, seed=3).start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def wait(self, dl, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if dl.status in ("completed", "error"):
+                return dl.status
+            time.sleep(0.05)
+        self.fail(f"download did not finish: {dl.status}")
+
+    def pause_midway(self, engine):
+        dl = Downloader(self.server.url, self.folder, threads=4, engine=engine)
+        # Slow enough to pause well before the end
+        dl.set_speed_limit(2 * 1024 * 1024)
+        dl.start()
+        deadline = time.monotonic() + 10
+        while dl.downloaded_size < SIZE // 4 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        dl.pause()
+        time.sleep(0.3)
+        self.assertLess(dl.downloaded_size, SIZE)
+        self.assertTrue(os.path.exists(dl.blocks_file))
+        return dl
+
+    def resume(self, engine):
+        sent = self.server.stats()['bytes_sent']
+        # A fresh instance, as after a restart of the app
+        dl = Downloader(self.server.url, self.folder, threads=4, engine=engine)
+        dl.start()
+        self.assertEqual(self.wait(dl), "completed")
+        self.assertEqual(sha256_of(dl.save_path), expected_sha256(SIZE, seed=3))
+        return self.server.stats()['bytes_sent'] - sent
+
+    def test_resume_fetches_only_the_rest(self):
+        for engine in ("thread", "async"):
+            with self.subTest(engine=engine):
+                paused = self.pause_midway(engine)
+                self.assertLessEqual(self.resume(engine), SIZE - paused.downloaded_size)
+                os.remove(paused.save_path)
+
+    def test_segment_progress_short_of_a_block_is_kept(self):
+        paused = self.pause_midway("thread")
+        dl = Downloader(self.server.url, self.folder, threads=4)
+        dl.load_state()
+        dl.open_blocks(True, os.path.getsize(dl.part_file))
+        self.assertEqual(dl.downloaded_size, paused.downloaded_size)
+        dl.close_blocks()
+        dl.close_state()
+
+    def test_blocks_lost_from_the_part_file_are_fetched_again(self):
+        paused = self.pause_midway("thread")
+        with open(paused.part_file, 'r+b') as f:
+            f.truncate(SIZE // 8)
+        self.resume("thread")
+
+
+if __name__ == '__main__':
+    unittest.main()
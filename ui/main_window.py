@@ -2,28 +2,22 @@ import customtkinter as ctk
 from tkinter import filedialog, messagebox
 import threading
 import os
+import queue
 import sys
 import time
-from plyer import notification
-import pystray
-from PIL import Image, ImageDraw
-from flask import Flask, request
-from flask_cors import CORS
-import logging
 
 # Add parent directory to path to import core
 if not getattr(sys, 'frozen', False):
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from core.downloader import Downloader
+from core.manager import DownloadManager, DEDUP_STATUSES
+from core.store import DownloadStore
+from core.api import DEFAULT_PORT
+# Tray (pystray, Pillow) and the control API (Flask) are imported on their own threads:
+# the window and the engine come up without waiting for them
 
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
 
-api = Flask(__name__)
-CORS(api)
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
-
 # --- ULTRA PREMIUM GLASS DARK PALETTE ---
 COLOR_BG_DARK = "#0A0A0B"        # Deep void
 COLOR_BG_CARD = "#161618"        # Glass Card
@@ -35,6 +29,9 @@ COLOR_SUCCESS = "#2ECC71"
 COLOR_DANGER = "#E74C3C"
 COLOR_BORDER = "#2C2C2E"         # Subtle divider
 
+ROW_HEIGHT = 95 # 75px card + 2 * 10px padding (unscaled)
+TICK_MS = 200 # One shared refresh for every download
+
 class ModernPopup(ctk.CTkToplevel):
     def __init__(self, parent, title, message, url=None, type="capture", callback=None):
         super().__init__(parent)
@@ -99,29 +96,39 @@ class ModernPopup(ctk.CTkToplevel):
                 self.master.active_popups.remove(self.url)
         super().destroy()
 
+class DownloadEntry:
+    # One download in the list. Rows are views that get bound to entries as they scroll into sight.
+    def __init__(self, download_id, downloader):
+        self.download_id = download_id
+        self.downloader = downloader
+        self.url = downloader.url
+        self.save_path = downloader.save_path
+        self.snapshot = None
+        self.dirty = True
+        self.finished = False # Completion already announced
+
+    def take_snapshot(self):
+        dl = self.downloader
+        return (dl.status, dl.downloaded_size, dl.file_size, int(dl.speed))
+
 class DownloadRow(ctk.CTkFrame):
-    def __init__(self, master, app, url, save_path, remove_callback, unit_var):
+    # Reusable row widget: the app keeps only enough of these to fill the viewport
+    def __init__(self, master, app):
         super().__init__(master, fg_color=COLOR_BG_CARD, height=75, corner_radius=14, border_width=1, border_color=COLOR_BORDER)
         self.app = app
-        self.url = url
-        self.save_path = save_path
-        self.remove_callback = remove_callback
-        self.unit_var = unit_var
-        self.downloader = Downloader(url, save_path, threads=app.thread_count.get())
-        self.monitoring = True
+        self.entry = None
+        self.shown = {} # Last value pushed to each widget, so unchanged ones aren't touched
 
+        self.grid_propagate(False) # Fixed height keeps the virtual list's row math exact
         self.grid_columnconfigure(1, weight=1)
         self.grid_columnconfigure(2, weight=1)
         self.create_widgets()
-        self.start()
 
     def create_widgets(self):
         self.icon_lbl = ctk.CTkLabel(self, text="💎", font=("Segoe UI", 24))
         self.icon_lbl.grid(row=0, column=0, padx=(20, 15), pady=18)
 
-        name = self.downloader.filename
-        if len(name) > 40: name = name[:37] + "..."
-        self.name_lbl = ctk.CTkLabel(self, text=name, font=("Segoe UI", 14, "bold"), text_color=COLOR_TEXT_MAIN, anchor="w")
+        self.name_lbl = ctk.CTkLabel(self, text="", font=("Segoe UI", 14, "bold"), text_color=COLOR_TEXT_MAIN, anchor="w")
         self.name_lbl.grid(row=0, column=1, padx=5, sticky="ew")
 
         self.p_bar = ctk.CTkProgressBar(self, height=10, progress_color=COLOR_ACCENT, fg_color="#1C1C1E", corner_radius=5)
@@ -137,90 +144,94 @@ class DownloadRow(ctk.CTkFrame):
         self.btn_f = ctk.CTkFrame(self, fg_color="transparent")
         self.btn_f.grid(row=0, column=5, padx=(10, 20))
 
-        self.p_btn = ctk.CTkButton(self.btn_f, text="⏸", width=34, height=34, corner_radius=10, fg_color="#2C2C2E", text_color=COLOR_TEXT_MAIN, hover_color="#3A3A3C", command=self.toggle)
+        self.p_btn = ctk.CTkButton(self.btn_f, text="⏸", width=34, height=34, corner_radius=10, fg_color="#2C2C2E", text_color=COLOR_TEXT_MAIN, hover_color="#3A3A3C", command=self.primary)
         self.p_btn.pack(side="left", padx=5)
 
-        self.c_btn = ctk.CTkButton(self.btn_f, text="✕", width=34, height=34, corner_radius=10, fg_color="#3D1212", text_color=COLOR_DANGER, hover_color="#5D1A1A", command=self.cancel)
+        self.c_btn = ctk.CTkButton(self.btn_f, text="✕", width=34, height=34, corner_radius=10, fg_color="#3D1212", text_color=COLOR_DANGER, hover_color="#5D1A1A", command=self.secondary)
         self.c_btn.pack(side="left", padx=5)
 
-    def start(self):
-        threading.Thread(target=self.downloader.start, daemon=True).start()
-        self.update()
+    def bind_entry(self, entry):
+        self.entry = entry
+        name = entry.downloader.filename
+        if len(name) > 40: name = name[:37] + "..."
+        self.put("name", name, lambda v: self.name_lbl.configure(text=v))
+        self.render()
+
+    def put(self, key, value, apply):
+        if self.shown.get(key) != value:
+            self.shown[key] = value
+            apply(value)
+
+    def set_bar_mode(self, mode):
+        if mode == "indeterminate":
+            self.p_bar.configure(mode="indeterminate")
+            self.p_bar.start()
+        else:
+            self.p_bar.stop()
+            self.p_bar.configure(mode="determinate")
+
+    def render(self):
+        entry = self.entry
+        entry.dirty = False
+        if entry.snapshot is None: entry.snapshot = entry.take_snapshot()
+        status, done, size, speed = entry.snapshot
+        fmt = self.app.fmt_size
+
+        # Unknown size: indeterminate bar until it finishes
+        unknown = size == 0 and status != "completed"
+        self.put("mode", "indeterminate" if unknown else "determinate", self.set_bar_mode)
+        if unknown:
+            self.put("stats", "Queued" if status == "queued" else f"{fmt(done)} / ??", lambda v: self.stats_lbl.configure(text=v))
+        else:
+            self.put("progress", round(done / size, 3) if size else 1, self.p_bar.set)
+            self.put("stats", "Queued" if status == "queued" else f"{fmt(done)} / {fmt(size)}", lambda v: self.stats_lbl.configure(text=v))
+
+        color = COLOR_SUCCESS if status == "completed" else COLOR_DANGER if status == "error" else COLOR_ACCENT
+        self.put("color", color, lambda v: self.p_bar.configure(progress_color=v))
 
-    def toggle(self):
-        if self.downloader.status == "downloading":
-            self.downloader.pause()
-            self.p_btn.configure(text="▶", text_color=COLOR_SUCCESS)
+        if status == "completed":
+            # Pause becomes Open Folder, Cancel becomes Remove, speed shows the file size
+            self.put("speed", fmt(size or done), lambda v: self.speed_lbl.configure(text=v))
+            self.put("p_btn", "📁", lambda v: self.p_btn.configure(text=v, text_color=COLOR_TEXT_MAIN))
+            self.put("c_btn", "🗑", lambda v: self.c_btn.configure(text=v, fg_color="#2C2C2E", text_color=COLOR_TEXT_MUTE, hover_color="#3A3A3C"))
         else:
-            threading.Thread(target=self.downloader.start, daemon=True).start()
-            self.p_btn.configure(text="⏸", text_color=COLOR_TEXT_MAIN)
-        self.app.refresh_list()
-
-    def set_completed_ui(self):
-        # Change Pause to Open Folder
-        self.p_btn.configure(text="📁", command=lambda: os.startfile(os.path.dirname(self.downloader.save_path)))
-        # Change Cancel to Remove
-        self.c_btn.configure(text="🗑", fg_color="#2C2C2E", text_color=COLOR_TEXT_MUTE, hover_color="#3A3A3C", command=self.remove_from_list)
-        # Update speed to show file size
-        self.speed_lbl.configure(text=self.app.fmt_size(self.downloader.file_size))
-        
-    def remove_from_list(self):
-        self.monitoring = False
-        self.remove_callback(self)
-        self.app.refresh_list()
-
-    def cancel(self):
-        if self.downloader.status not in ["completed", "error"]:
-            if not messagebox.askyesno("Tafim DL", f"Stop and DELETE {self.downloader.filename}?"): return
-        
-        self.downloader.cancel()
-        
+            self.put("speed", self.app.fmt_speed(speed), lambda v: self.speed_lbl.configure(text=v))
+            running = status in ["downloading", "starting", "queued", "restarting", "verifying", "finalizing"]
+            self.put("p_btn", "⏸" if running else "▶", lambda v: self.p_btn.configure(text=v, text_color=COLOR_TEXT_MAIN if v == "⏸" else COLOR_SUCCESS))
+            self.put("c_btn", "✕", lambda v: self.c_btn.configure(text=v, fg_color="#3D1212", text_color=COLOR_DANGER, hover_color="#5D1A1A"))
+
+    def primary(self):
+        if self.entry is None: return
+        dl = self.entry.downloader
+        if dl.status == "completed":
+            os.startfile(os.path.dirname(dl.save_path))
+        elif dl.status in ["downloading", "starting", "queued"]:
+            self.app.manager.pause(self.entry.download_id)
+        else:
+            self.app.manager.resume(self.entry.download_id)
+        self.app.refresh_entry(self.entry)
+
+    def secondary(self):
+        if self.entry is None: return
+        entry = self.entry
+        dl = entry.downloader
+        if dl.status == "completed":
+            self.app.manager.remove(entry.download_id)
+            self.app.remove_dl(entry)
+            return
+
+        if dl.status != "error":
+            if not messagebox.askyesno("Tafim DL", f"Stop and DELETE {dl.filename}?"): return
+
+        self.app.manager.cancel(entry.download_id)
+        self.app.manager.remove(entry.download_id)
+
         # Hard delete the file if it exists
-        if os.path.exists(self.save_path):
-            try: os.remove(self.save_path)
+        if os.path.exists(entry.save_path):
+            try: os.remove(entry.save_path)
             except: pass
-            
-        self.monitoring = False
-        self.remove_callback(self)
-        self.app.refresh_list()
-
-    def update(self):
-        if not self.monitoring: return
-        status = self.downloader.status
-        
-        # Handle unknown size
-        if self.downloader.file_size == 0:
-            if self.p_bar.cget("mode") != "indeterminate":
-                self.p_bar.configure(mode="indeterminate")
-                self.p_bar.start()
-            
-            cur = self.app.fmt_size(self.downloader.downloaded_size)
-            self.stats_lbl.configure(text=f"{cur} / ??")
-        else:
-            if self.p_bar.cget("mode") != "determinate":
-                self.p_bar.stop()
-                self.p_bar.configure(mode="determinate")
-                
-            self.p_bar.set(self.downloader.get_progress())
-            cur = self.app.fmt_size(self.downloader.downloaded_size)
-            tot = self.app.fmt_size(self.downloader.file_size)
-            self.stats_lbl.configure(text=f"{cur} / {tot}")
-        
-        speed = self.app.fmt_speed(self.downloader.speed)
-        self.speed_lbl.configure(text=speed)
 
-        if status == "completed":
-            self.monitoring = False
-            self.p_bar.configure(progress_color=COLOR_SUCCESS)
-            self.set_completed_ui()
-            self.app.on_download_complete(self.downloader.filename, self.downloader.save_path)
-            self.app.refresh_list()
-        elif status == "error":
-            self.monitoring = False
-            self.p_bar.configure(progress_color=COLOR_DANGER)
-            self.app.refresh_list()
-            
-        if self.monitoring: self.after(100, self.update)
+        self.app.remove_dl(entry)
 
 class TafimApp(ctk.CTk):
     def __init__(self):
@@ -233,9 +244,11 @@ class TafimApp(ctk.CTk):
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(0, weight=1)
         
-        self.downloads = []
+        self.downloads = [] # DownloadEntry per download, in order added
+        self.visible = [] # Entries passing the current filter
+        self.rows = [] # Pooled row widgets, just enough to fill the viewport
+        self.first = 0 # Index into self.visible of the top row
         self.active_popups = set()
-        self.processed_urls = set()
 
         self.unit = ctk.StringVar(value="Auto")
         self.notify_on_complete = ctk.BooleanVar(value=True)
@@ -246,22 +259,46 @@ class TafimApp(ctk.CTk):
         except:
             self.last_clip = ""
         self.thread_count = ctk.IntVar(value=32)
+        self.default_dir = os.path.join(os.path.expanduser("~"), "Downloads")
+        self.path_ent = None
+        self.tray = None
+        # The API runs on Flask's threads, which must not touch Tk: it reads these copies
+        # (refreshed every tick) and hands work to the UI through ui_calls, drained in tick()
+        self.api_threads = 32
+        self.api_dir = self.default_dir
+        self.ui_calls = queue.Queue()
+        # Bounded active downloads sharing one global connection budget; queue and history
+        # are kept on disk, and whatever was unfinished last time resumes right away
+        try:
+            store = DownloadStore()
+        except Exception as e:
+            print(f"Download history unavailable: {e}")
+            store = None
+        self.manager = DownloadManager(max_active=3, max_connections=128, store=store)
+        # API first, so a handoff from the browser extension doesn't wait for the window
+        threading.Thread(target=self.serve_api, daemon=True).start()
 
         self.create_sidebar()
         self.create_main()
+        self.load_downloads()
         self.protocol("WM_DELETE_WINDOW", self.hide)
-        self.setup_tray()
-        
-        @api.route('/add')
-        def add():
-            u = request.args.get('url')
-            if u: 
-                # Check duplication here too
-                if u not in self.downloads and u not in self.active_popups:
-                    self.after(100, lambda: self.prompt_capture(u))
-                return "OK"
-            return "ERR"
-        threading.Thread(target=lambda: api.run(port=5555, debug=False, use_reloader=False), daemon=True).start()
+        self.after(TICK_MS, self.tick)
+        # Tray icon once the window is on screen
+        self.after_idle(lambda: threading.Thread(target=self.setup_tray, daemon=True).start())
+
+    def serve_api(self):
+        from core.api import create_api
+
+        # prompt_capture deduplicates on the Tk thread
+        api = create_api(self.manager, capture=lambda u: self.ui_calls.put(lambda: self.prompt_capture(u)),
+                         save_dir=lambda: self.api_dir, threads=lambda: self.api_threads,
+                         on_added=lambda i: self.ui_calls.put(lambda: self.attach_dl(i)))
+        api.run(port=DEFAULT_PORT, debug=False, use_reloader=False)
+
+    def save_dir(self):
+        # Until create_main, there is no path entry yet
+        if self.path_ent is None: return self.default_dir
+        return self.path_ent.get().strip() or self.default_dir
 
     def create_sidebar(self):
         self.side = ctk.CTkFrame(self, width=250, corner_radius=0, fg_color="#0D0D0E", border_width=1, border_color=COLOR_BORDER)
@@ -298,16 +335,92 @@ class TafimApp(ctk.CTk):
             b.configure(fg_color=COLOR_ACCENT if act else "transparent", text_color="white" if act else COLOR_TEXT_MUTE)
         self.refresh_list()
 
+    def matches(self, status):
+        if self.current_filter == "All": return True
+        if self.current_filter == "InPr": return status in ["downloading", "paused", "pending", "queued", "starting", "restarting", "verifying", "finalizing"]
+        if self.current_filter == "File": return status == "completed"
+        return False
+
     def refresh_list(self):
-        for r in self.downloads: r.pack_forget()
-        for r in self.downloads:
-            stat = r.downloader.status
-            show = False
-            if self.current_filter == "All": show = True
-            elif self.current_filter == "InPr" and stat in ["downloading", "paused", "pending"]: show = True
-            elif self.current_filter == "File" and stat == "completed": show = True
-            
-            if show: r.pack(fill="x", padx=15, pady=10)
+        # Re-filter; only the pooled rows get rebound, whatever the number of downloads
+        self.visible = [e for e in self.downloads if self.matches(e.downloader.status)]
+        self.layout()
+
+    def layout(self):
+        self.first = max(0, min(self.first, len(self.visible) - len(self.rows)))
+        for i, row in enumerate(self.rows):
+            idx = self.first + i
+            if idx < len(self.visible):
+                if row.entry is not self.visible[idx]: row.bind_entry(self.visible[idx])
+                elif row.entry.dirty: row.render()
+                # Hidden rows are always at the end, so packing in order keeps the order
+                if not row.winfo_manager(): row.pack(fill="x", padx=15, pady=10)
+            elif row.winfo_manager() or row.entry is not None:
+                row.pack_forget()
+                row.entry = None
+        total = len(self.visible)
+        if total > len(self.rows):
+            self.scroll.set(self.first / total, (self.first + len(self.rows)) / total)
+        else:
+            self.scroll.set(0, 1)
+
+    def on_list_resize(self, event):
+        # As many rows as fit; the pool never grows with the number of downloads
+        scale = ctk.ScalingTracker.get_widget_scaling(self.list)
+        count = max(1, int(event.height / scale // ROW_HEIGHT))
+        while len(self.rows) < count:
+            self.rows.append(DownloadRow(self.list, self))
+        while len(self.rows) > count:
+            self.rows.pop().destroy()
+        self.layout()
+
+    def on_scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            self.first = int(float(amount) * len(self.visible))
+        elif unit == "pages":
+            self.first += int(amount) * len(self.rows)
+        else:
+            self.first += int(amount)
+        self.layout()
+
+    def on_wheel(self, event):
+        widget = self.winfo_containing(event.x_root, event.y_root)
+        # The scrollbar handles its own wheel events
+        path = str(self.list)
+        if widget is None or not (str(widget) == path or str(widget).startswith(path + ".")): return
+        self.first += -1 if event.num == 4 or event.delta > 0 else 1
+        self.layout()
+
+    def tick(self):
+        # Requests from the API threads first, then one pass over every download;
+        # widgets are touched only for visible rows whose data changed
+        self.api_threads = self.thread_count.get()
+        self.api_dir = self.save_dir()
+        while True:
+            try: call = self.ui_calls.get_nowait()
+            except queue.Empty: break
+            try: call()
+            except Exception as e: print(f"UI request failed: {e}")
+        refilter = False
+        for entry in self.downloads:
+            snap = entry.take_snapshot()
+            if snap == entry.snapshot: continue
+            old, entry.snapshot, entry.dirty = entry.snapshot, snap, True
+            if old is None or self.matches(old[0]) != self.matches(snap[0]): refilter = True
+            if snap[0] == "completed" and not entry.finished:
+                entry.finished = True
+                self.on_download_complete(entry.downloader.filename, entry.downloader.save_path)
+        if refilter: self.refresh_list()
+        else:
+            for row in self.rows:
+                if row.entry is not None and row.entry.dirty: row.render()
+        self.after(TICK_MS, self.tick)
+
+    def refresh_entry(self, entry):
+        # Reflect a user action right away instead of on the next tick
+        entry.snapshot = entry.take_snapshot()
+        entry.dirty = True
+        self.refresh_list()
 
     def create_main(self):
         self.main = ctk.CTkFrame(self, corner_radius=0, fg_color=COLOR_BG_DARK)
@@ -329,7 +442,7 @@ class TafimApp(ctk.CTk):
         
         self.path_ent = ctk.CTkEntry(self.opt, width=320, height=34, border_width=0, fg_color="#1C1C1E", corner_radius=10, font=("Segoe UI", 11), text_color=COLOR_TEXT_MUTE)
         self.path_ent.pack(side="left")
-        self.path_ent.insert(0, os.path.join(os.path.expanduser("~"), "Downloads"))
+        self.path_ent.insert(0, self.default_dir)
         ctk.CTkButton(self.opt, text="📁", width=40, height=34, corner_radius=10, fg_color="#1C1C1E", text_color=COLOR_TEXT_MAIN, hover_color="#2C2C2E", command=self.pick_dir).pack(side="left", padx=8)
 
         self.u_menu = ctk.CTkOptionMenu(self.opt, values=["Auto", "KB/s", "MB/s"], variable=self.unit, width=100, height=34, corner_radius=10, fg_color="#1C1C1E", button_color="#2C2C2E", text_color=COLOR_TEXT_MAIN)
@@ -342,8 +455,18 @@ class TafimApp(ctk.CTk):
         self.thread_slider = ctk.CTkSlider(self.opt, from_=1, to=128, number_of_steps=127, variable=self.thread_count, width=120, progress_color=COLOR_ACCENT, button_color=COLOR_ACCENT, command=self.update_thread_lbl)
         self.thread_slider.pack(side="right", padx=5)
 
-        self.list = ctk.CTkScrollableFrame(self.main, fg_color="transparent")
-        self.list.grid(row=2, column=0, sticky="nsew", padx=35, pady=(0, 35))
+        # Virtualized list: a fixed pool of rows in a plain frame, scrolled by rebinding rows to entries
+        self.list_box = ctk.CTkFrame(self.main, fg_color="transparent")
+        self.list_box.grid(row=2, column=0, sticky="nsew", padx=35, pady=(0, 35))
+        self.scroll = ctk.CTkScrollbar(self.list_box, command=self.on_scroll)
+        self.scroll.pack(side="right", fill="y")
+        self.list = ctk.CTkFrame(self.list_box, fg_color="transparent")
+        self.list.pack(side="left", fill="both", expand=True)
+        self.list.pack_propagate(False) # Size comes from the window, not from the rows in it
+        self.list.bind("<Configure>", self.on_list_resize)
+        self.bind_all("<MouseWheel>", self.on_wheel)
+        self.bind_all("<Button-4>", self.on_wheel)
+        self.bind_all("<Button-5>", self.on_wheel)
 
     def pick_dir(self):
         d = filedialog.askdirectory()
@@ -358,19 +481,36 @@ class TafimApp(ctk.CTk):
 
     def start_dl(self, url):
         self.deiconify(); self.lift(); self.focus_force()
-        row = DownloadRow(self.list, self, url, self.path_ent.get().strip(), self.remove_dl, self.unit)
-        self.downloads.append(row)
+        download_id = self.manager.add(url, self.save_dir(), threads=self.thread_count.get())
+        self.attach_dl(download_id)
+
+    def attach_dl(self, download_id):
+        # List entry for a queued download, from the UI or the JSON API
+        dl = self.manager.get(download_id)
+        if dl is None: return
+        self.downloads.append(DownloadEntry(download_id, dl))
+        if self.matches(dl.status):
+            self.visible.append(self.downloads[-1])
+            self.layout()
+
+    def load_downloads(self):
+        # Last session's history plus the downloads the manager restored, oldest first
+        entries = [DownloadEntry(i, dl) for i, dl in self.manager.history() + self.manager.items()]
+        entries.sort(key=lambda e: e.download_id)
+        for entry in entries:
+            entry.finished = entry.downloader.status == "completed" # Announced back then
+        self.downloads.extend(entries)
         self.refresh_list()
 
-    def remove_dl(self, row):
-        row.pack_forget()
-        if row in self.downloads: self.downloads.remove(row)
-        row.destroy()
+    def remove_dl(self, entry):
+        if entry in self.downloads: self.downloads.remove(entry)
+        self.refresh_list()
 
     def prompt_capture(self, url):
-        # Deduplication
+        # Deduplication: open popups, then the store's URL index (running downloads and history).
+        # A cancelled or failed download doesn't count, so the URL can be captured again.
         if url in self.active_popups: return
-        if any(d.url == url for d in self.downloads): return 
+        if self.manager.find(url, DEDUP_STATUSES) is not None: return
         
         self.active_popups.add(url)
         ModernPopup(self, "Tafim Catch", "A new file stream was detected. Download with Tafim Pro?", url, "capture", self.accept_capture)
@@ -425,15 +565,21 @@ class TafimApp(ctk.CTk):
     def hide(self): self.withdraw()
     
     def setup_tray(self):
+        # Background thread: pystray and Pillow load here, after the window is up
+        import pystray
+        from PIL import Image, ImageDraw
         menu = pystray.Menu(pystray.MenuItem("Restore Tafim", self.deiconify), pystray.MenuItem("Exit Pro", self.full_quit))
         img = Image.new('RGB', (64, 64), (52, 152, 219))
         draw = ImageDraw.Draw(img)
         draw.polygon([(32,5), (45,30), (35,30), (45,60), (20,30), (30,30)], fill=(255, 255, 255))
         self.tray = pystray.Icon("TafimPro", img, "Tafim Downloader Pro", menu)
-        threading.Thread(target=self.tray.run, daemon=True).start()
+        self.tray.run()
 
     def full_quit(self):
-        self.tray.stop(); self.quit(); sys.exit(0)
+        if self.tray is not None: self.tray.stop()
+        # Checkpoints running downloads and saves the queue, so they resume on the next start
+        self.manager.shutdown()
+        self.quit(); sys.exit(0)
 
     def fmt_size(self, s):
         if s < 1024: return f"{s} B"